@@ -0,0 +1,166 @@
+"""
+Benchmark of the pre-processing on synthetic crops.
+The vectorized functions are compared to the per pixel loops they replace, the benchmark fails if their
+results are different. The contours are checked against the original loop of create_contours_above_image
+(legacy indexing, on square crops) and against the same loop with the indexing fixed.
+
+    python benchmarks/bench_pre_processing.py --crops 200 --height 256 --width 320
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_FOLDER))
+
+import pre_processing
+
+
+def legacy_contours_loop(p_ground_truth, p_depth):
+    """
+    Per pixel loop of create_contours_above_image before its vectorization, unchanged : the images are
+    indexed as [col, row]. Reference of move_contours_to_depth_discontinuities with the legacy indexing.
+    :param p_ground_truth: ground truth image (square)
+    :param p_depth: depth image
+    :return: new ground truth image
+    """
+    shapes_width, shapes_heigth = p_ground_truth.shape[0], p_ground_truth.shape[1]
+    copy_edges = p_ground_truth.copy()
+    for row, col in np.argwhere(copy_edges > 0):
+        if 1 <= col:
+            if copy_edges[col, row] > 0 and p_depth[col - 1, row] != p_depth[col, row]:
+                copy_edges[col - 1, row] = 255
+                copy_edges[col, row] = 0
+        if col < shapes_width - 1:
+            if copy_edges[col, row] > 0 and p_depth[col + 1, row] != p_depth[col, row]:
+                copy_edges[col + 1, row] = 255
+                copy_edges[col, row] = 0
+        if 1 <= row:
+            if copy_edges[col, row] > 0 and p_depth[col, row - 1] != p_depth[col, row]:
+                copy_edges[col, row - 1] = 255
+                copy_edges[col, row] = 0
+        if row < shapes_heigth - 1:
+            if copy_edges[col, row] > 0 and p_depth[col, row + 1] != p_depth[col, row]:
+                copy_edges[col, row + 1] = 255
+                copy_edges[col, row] = 0
+    return copy_edges
+
+
+def move_contours_loop(p_ground_truth, p_depth):
+    """
+    Per pixel loop of create_contours_above_image with the indexing fixed ([row, col]),
+    reference of move_contours_to_depth_discontinuities
+    :param p_ground_truth: ground truth image
+    :param p_depth: depth image
+    :return: new ground truth image
+    """
+    height, width = p_ground_truth.shape
+    copy_edges = p_ground_truth.copy()
+    for row, col in np.argwhere(copy_edges > 0):
+        if 1 <= row:
+            if copy_edges[row, col] > 0 and p_depth[row - 1, col] != p_depth[row, col]:
+                copy_edges[row - 1, col] = 255
+                copy_edges[row, col] = 0
+        if row < height - 1:
+            if copy_edges[row, col] > 0 and p_depth[row + 1, col] != p_depth[row, col]:
+                copy_edges[row + 1, col] = 255
+                copy_edges[row, col] = 0
+        if 1 <= col:
+            if copy_edges[row, col] > 0 and p_depth[row, col - 1] != p_depth[row, col]:
+                copy_edges[row, col - 1] = 255
+                copy_edges[row, col] = 0
+        if col < width - 1:
+            if copy_edges[row, col] > 0 and p_depth[row, col + 1] != p_depth[row, col]:
+                copy_edges[row, col + 1] = 255
+                copy_edges[row, col] = 0
+    return copy_edges
+
+
+def generate_crop(p_rng, p_height, p_width):
+    """
+    Generate a synthetic crop : a depth made of blocks (the bricks) and a ground truth with random values
+    on a part of the pixels
+    :param p_rng: random generator
+    :param p_height: height of the crop
+    :param p_width: width of the crop
+    :return: ground truth and depth (uint8)
+    """
+    block_size = p_rng.randint(2, 16)
+    blocks = p_rng.randint(0, 8, size=(p_height // block_size + 1, p_width // block_size + 1))
+    depth = np.kron(blocks, np.ones((block_size, block_size), dtype=blocks.dtype))[:p_height, :p_width]
+    ground_truth = p_rng.randint(1, 256, size=(p_height, p_width))
+    ground_truth[p_rng.random_sample((p_height, p_width)) > p_rng.uniform(0.05, 0.9)] = 0
+    return ground_truth.astype(np.uint8), depth.astype(np.uint8)
+
+
+def compare_functions(p_functions, p_crops, p_results):
+    """
+    Time functions on the same crops and check that they give the same results
+    :param p_functions: (name, function) of the reference function then of the function checked
+    :param p_crops: list of (ground truth, depth)
+    :param p_results: results of each function, the results of these functions are added
+    :return:
+    """
+    outputs = {}
+    for name, function in p_functions:
+        start_time = time.perf_counter()
+        outputs[name] = [function(ground_truth, depth) for ground_truth, depth in p_crops]
+        elapsed_time = time.perf_counter() - start_time
+        p_results[name] = {"total_ms": 1000.0 * elapsed_time, "ms_by_crop": 1000.0 * elapsed_time / len(p_crops)}
+    (reference_name, _), (name, _) = p_functions
+    for expected, output in zip(outputs[reference_name], outputs[name]):
+        assert np.array_equal(expected, output), "%s is different from %s" % (name, reference_name)
+
+
+def run_benchmark(p_nb_crops, p_height, p_width, p_seed):
+    """
+    Check that the vectorized functions give the results of the loops and measure their time
+    :param p_nb_crops: number of crops
+    :param p_height: height of the crops
+    :param p_width: width of the crops
+    :param p_seed: seed of the benchmark
+    :return: results of each function
+    """
+    rng = np.random.RandomState(p_seed)
+    crops = [generate_crop(rng, p_height, p_width) for _ in range(p_nb_crops)]
+    # The legacy loop only works on square crops
+    square_crops = [generate_crop(rng, p_height, p_height) for _ in range(p_nb_crops)]
+    results = OrderedDict()
+    compare_functions((("contours_loop", move_contours_loop),
+                       ("contours_vectorized", pre_processing.move_contours_to_depth_discontinuities)),
+                      crops,
+                      results)
+    compare_functions((("legacy_contours_loop", legacy_contours_loop),
+                       ("legacy_contours_vectorized",
+                        lambda p_ground_truth, p_depth: pre_processing.move_contours_to_depth_discontinuities(
+                            p_ground_truth, p_depth, p_legacy_indexing=True))),
+                      square_crops,
+                      results)
+
+    print("=============================================")
+    print("* %s crops of %sx%s and %sx%s, results identical" % (p_nb_crops, p_width, p_height, p_height, p_height))
+    print("%-28s %12s %14s" % ("Function", "Total (ms)", "ms/crop"))
+    for name, result in results.items():
+        print("%-28s %12.1f %14.3f" % (name, result["total_ms"], result["ms_by_crop"]))
+    print("=============================================")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the pre-processing")
+    parser.add_argument("--crops", type=int, default=50, help="number of crops")
+    parser.add_argument("--height", type=int, default=256, help="height of the crops")
+    parser.add_argument("--width", type=int, default=320, help="width of the crops")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the benchmark")
+    parser.add_argument("--json", default=None, help="file where the results are written")
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmark(arguments.crops, arguments.height, arguments.width, arguments.seed)
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as json_file:
+            json.dump({"arguments": vars(arguments), "results": benchmark_results}, json_file, indent=2)
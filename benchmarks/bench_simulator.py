@@ -0,0 +1,302 @@
+"""
+Benchmark of the scene construction and capture code of the simulator.
+Without blender the bpy and bmesh modules are replaced by benchmarks/fake_blender.py : the renders only write
+empty files, the benchmark measures the python side of the pipeline and counts the calls to blender.
+
+    python benchmarks/bench_simulator.py --levels 10 --cubes-by-level 6 --scenarios 5
+    python benchmarks/bench_simulator.py --output-queue-size 8   (outputs written by the output writer)
+    python benchmarks/bench_simulator.py --blender            (same benchmark inside blender, if it is on PATH)
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_FOLDER))
+sys.path.insert(0, BENCHMARKS_FOLDER)
+
+try:
+    import bpy
+    REAL_BLENDER = True
+except ImportError:
+    import fake_blender
+    fake_blender.install()
+    REAL_BLENDER = False
+
+import layout_planner
+import output_writer
+import scenario_format
+import simulator
+
+BENCHMARK_CONFIG = {"nbLevel": 10,
+                    "nbCubeByLevel": 6,
+                    "nbConfigurationAvailable": len(layout_planner.LAYOUT_SLOTS),
+                    "height": 0.75,
+                    "width": 0.25,
+                    "weight": 0.25,
+                    "separator": 0.01,
+                    "pattern_layer": "Cube_%s_%s",
+                    "pattern_name_file_save": "%s_%s",
+                    "max_texture_use": 6,
+                    "deformation": True,
+                    "use_gpu": False,
+                    "scriptGeneration": False,
+                    "renderProfile": "draft",
+                    "captureMode": simulator.CAPTURE_MODE_STEP,
+                    "labelRenderMode": simulator.LABEL_RENDER_MODE_CYCLES,
+                    "renderCropRegions": False,
+                    "nb_sub_divide_image": 4,
+                    "sub_height_image": 256,
+                    "sub_width_image": 256}
+NB_TEXTURE_FILES = 20
+SCENARIO_FILES = ("scenario.txt", "scenario_data.txt", "config.json", scenario_format.SCENARIO_FILE)
+
+g_stages = OrderedDict()
+
+
+def count_calls():
+    """
+    :return: number of calls to the fake blender modules, None with the real blender
+    """
+    return None if REAL_BLENDER else sum(fake_blender.CALLS.values())
+
+
+@contextmanager
+def measure(p_name):
+    """
+    Add the time and the calls to blender of a block to the totals of a stage
+    :param p_name: name of the stage
+    :return:
+    """
+    calls_before = count_calls()
+    start_time = time.perf_counter()
+    yield
+    stage = g_stages.setdefault(p_name, {"time": 0.0, "calls": 0, "runs": 0})
+    stage["time"] += time.perf_counter() - start_time
+    stage["runs"] += 1
+    if calls_before is not None:
+        stage["calls"] += count_calls() - calls_before
+
+
+def setup_simulator(p_config, p_work_folder):
+    """
+    Set the globals that the main block of the simulator defines from the configuration
+    :param p_config: configuration
+    :param p_work_folder: folder of the textures and of the rendered data
+    :return: scene and camera
+    """
+    texture_folder = os.path.join(p_work_folder, "textures")
+    os.makedirs(texture_folder)
+    simulator.g_texture_files = ["texture_%02d.jpg" % index for index in range(NB_TEXTURE_FILES)]
+    for texture_file in simulator.g_texture_files:
+        # The simulator builds the paths with the windows separator
+        open(texture_folder + "\\" + texture_file, 'wb').close()
+    simulator.root_path_texture = texture_folder
+    simulator.root_path_data = os.path.join(p_work_folder, "data", "")
+    os.makedirs(simulator.root_path_data)
+    simulator.g_debugMode = False
+    simulator.g_nb_objects = p_config["nbCubeByLevel"] * p_config["nbLevel"] * 2
+    simulator.nbLevel = p_config["nbLevel"]
+    simulator.g_material_pool.clear()
+    output_queue_size = p_config.get("outputQueueSize", 0)
+    simulator.g_output_writer = output_writer.OutputWriter(output_queue_size) if output_queue_size > 0 else None
+
+    scene = bpy.context.scene if REAL_BLENDER else fake_blender.reset()
+    scene.render.resolution_x = 1280
+    scene.render.resolution_y = 1024
+    scene.render.resolution_percentage = 100
+    simulator.apply_render_profile(scene, simulator.get_render_profile(p_config))
+    return scene, scene.objects["Camera"]
+
+
+def collect_scenario_files(p_folder_scenario, p_replay_folder):
+    """
+    Move the files of a scenario to a folder of the replay benchmark.
+    Outside windows the simulator writes them next to the scenario folder, with a backslash in their name.
+    :param p_folder_scenario: folder of the scenario
+    :param p_replay_folder: root folder of the replay benchmark
+    :return:
+    """
+    destination = os.path.join(p_replay_folder, p_folder_scenario)
+    os.makedirs(destination)
+    for file_name in SCENARIO_FILES:
+        source = simulator.root_path_data + p_folder_scenario + "\\" + file_name
+        if os.path.exists(source):
+            shutil.move(source, os.path.join(destination, file_name))
+
+
+def run_scenario(p_index, p_config, p_scene, p_camera):
+    """
+    Run the stages of an iteration of the simulator for one scenario
+    :param p_index: index of the scenario
+    :param p_config: configuration
+    :param p_scene: scene
+    :param p_camera: camera
+    :return: number of bricks of the scenario
+    """
+    folder_scenario = "output_%d_benchmark" % p_index
+    os.makedirs(simulator.root_path_data + folder_scenario + "\\", exist_ok=True)
+    scenario_seed = random.randint(0, 2 ** 31 - 1)
+
+    with measure("generate_configuration"):
+        objects_params = []
+        configuration_generation = []
+        for layer in range(p_config["nbLevel"]):
+            layer_configuration = random.randint(0, p_config["nbConfigurationAvailable"] - 1)
+            configuration_generation.append(layer_configuration)
+            objects_params = layout_planner.generate_configuration(layer_configuration, layer, p_config,
+                                                                   objects_params)
+        textures_choose = simulator.generate_texture_array(p_config)
+
+    with measure("save_scenario_data"):
+        simulator.save_scenario_data(p_path=simulator.root_path_data,
+                                     p_folder_scenario=folder_scenario,
+                                     p_objects_params=objects_params,
+                                     p_generation_configuration=configuration_generation,
+                                     p_textures_choose=textures_choose,
+                                     p_config=dict(p_config, scenarioSeed=scenario_seed))
+
+    with measure("generate_object"):
+        for index_object in range(len(objects_params)):
+            simulator.generate_object(p_data=objects_params[index_object],
+                                      p_scene=p_scene,
+                                      p_config=p_config,
+                                      p_index_object=len(objects_params) - index_object,
+                                      p_iteration=p_index,
+                                      p_textures_choose=textures_choose,
+                                      p_scenario_seed=scenario_seed)
+        simulator.un_select_all_object(p_scene)
+
+    with measure("picture_capture"):
+        simulator.picture_capture(p_camera=p_camera,
+                                  p_path=simulator.root_path_data,
+                                  p_nb_level=p_config["nbLevel"],
+                                  p_folder_scenario=folder_scenario,
+                                  p_config=p_config,
+                                  p_scene=p_scene,
+                                  p_scenario_seed=scenario_seed)
+
+    with measure("reset_data"):
+        simulator.reset_data(p_scene)
+        simulator.purge_orphan_data()
+    return len(objects_params)
+
+
+def run_benchmark(p_config, p_nb_scenarios, p_seed):
+    """
+    Run the benchmark and print the time and the calls to blender of each stage
+    :param p_config: configuration
+    :param p_nb_scenarios: number of scenarios
+    :param p_seed: seed of the benchmark
+    :return: results of each stage
+    """
+    random.seed(p_seed)
+    work_folder = tempfile.mkdtemp(prefix="simulator_benchmark_")
+    try:
+        scene, camera = setup_simulator(p_config, work_folder)
+        replay_folder = os.path.join(work_folder, "replay")
+        nb_bricks = 0
+        for index in range(p_nb_scenarios):
+            nb_bricks += run_scenario(index, p_config, scene, camera)
+            collect_scenario_files("output_%d_benchmark" % index, replay_folder)
+
+        folders = scenario_format.discover_replay_folders(replay_folder)
+        with measure("replay_parsing"):
+            scenarios = scenario_format.load_scenarios(folders)
+        with measure("replay_parsing_legacy"):
+            legacy_scenarios = [scenario_format.read_legacy_scenario(folder) for folder in folders]
+        assert [scenario["bricks"] for scenario in scenarios] == [scenario["bricks"]
+                                                                  for scenario in legacy_scenarios]
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    print("=============================================")
+    print("* %s, %s scenarios, %s levels, %s bricks by level, %s bricks" % (
+        "blender" if REAL_BLENDER else "fake blender", p_nb_scenarios, p_config["nbLevel"],
+        p_config["nbCubeByLevel"], nb_bricks))
+    print("%-24s %12s %14s %14s %18s" % ("Stage", "Total (ms)", "ms/scenario", "us/brick", "calls/scenario"))
+    results = OrderedDict()
+    for name, stage in g_stages.items():
+        results[name] = {"total_ms": 1000.0 * stage["time"],
+                         "ms_by_scenario": 1000.0 * stage["time"] / p_nb_scenarios,
+                         "us_by_brick": 1e6 * stage["time"] / nb_bricks,
+                         "calls_by_scenario": None if REAL_BLENDER else stage["calls"] / float(p_nb_scenarios)}
+        print("%-24s %12.1f %14.2f %14.1f %18s" % (name,
+                                                   results[name]["total_ms"],
+                                                   results[name]["ms_by_scenario"],
+                                                   results[name]["us_by_brick"],
+                                                   "n/a" if REAL_BLENDER
+                                                   else "%.1f" % results[name]["calls_by_scenario"]))
+    if not REAL_BLENDER:
+        print("* Most frequent calls :")
+        for name, count in fake_blender.CALLS.most_common(10):
+            print("    %-40s %10.1f / scenario" % (name, count / float(p_nb_scenarios)))
+    print("=============================================")
+    return results
+
+
+def run_in_blender(p_blender_executable, p_arguments):
+    """
+    Run this benchmark inside blender
+    :param p_blender_executable: blender executable
+    :param p_arguments: arguments of the benchmark
+    :return: exit code of blender
+    """
+    return subprocess.call([p_blender_executable, "--background", "--factory-startup",
+                            "--python-exit-code", "1",
+                            "--python", os.path.realpath(__file__), "--"] + p_arguments)
+
+
+def parse_arguments():
+    """
+    Parse the arguments, inside blender they are given after the "--" separator
+    :return: parsed arguments and the arguments given to the benchmark
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the simulator")
+    parser.add_argument("--levels", type=int, default=BENCHMARK_CONFIG["nbLevel"], help="number of levels (nbLevel)")
+    parser.add_argument("--cubes-by-level", type=int, default=BENCHMARK_CONFIG["nbCubeByLevel"],
+                        help="number of bricks by level (nbCubeByLevel)")
+    parser.add_argument("--scenarios", type=int, default=5, help="number of scenarios")
+    parser.add_argument("--no-deformation", action="store_true", help="bricks without subdivision nor deformation")
+    parser.add_argument("--capture-mode", default=simulator.CAPTURE_MODE_STEP,
+                        choices=(simulator.CAPTURE_MODE_STEP, simulator.CAPTURE_MODE_ANIMATION))
+    parser.add_argument("--seed", type=int, default=0, help="seed of the benchmark")
+    parser.add_argument("--output-queue-size", type=int, default=0,
+                        help="size of the queue of the output writer (%s is a good value), "
+                             "0 to write the outputs synchronously like the simulator by default"
+                             % output_writer.DEFAULT_QUEUE_SIZE)
+    parser.add_argument("--json", default=None, help="file where the results are written")
+    parser.add_argument("--blender", nargs="?", const="blender", default=None,
+                        help="run the benchmark inside blender (executable, default : blender)")
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+    return parser.parse_args(argv), argv
+
+
+if __name__ == '__main__':
+    arguments, benchmark_argv = parse_arguments()
+    if arguments.blender is not None and not REAL_BLENDER:
+        blender_executable = shutil.which(arguments.blender)
+        if blender_executable is None:
+            print("ERROR : %s not found" % arguments.blender)
+            sys.exit(-1)
+        blender_argv = [argument for argument in benchmark_argv if argument not in ("--blender", arguments.blender)]
+        sys.exit(run_in_blender(blender_executable, blender_argv))
+
+    config = dict(BENCHMARK_CONFIG,
+                  nbLevel=arguments.levels,
+                  nbCubeByLevel=arguments.cubes_by_level,
+                  deformation=not arguments.no_deformation,
+                  captureMode=arguments.capture_mode,
+                  outputQueueSize=arguments.output_queue_size)
+    results = run_benchmark(config, arguments.scenarios, arguments.seed)
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as json_file:
+            json.dump({"config": config, "scenarios": arguments.scenarios, "results": results}, json_file, indent=2)
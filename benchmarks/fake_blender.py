@@ -0,0 +1,458 @@
+"""
+Lightweight fake of the bpy and bmesh modules, enough to run the scene construction and capture
+code of the simulator without blender. The calls to the operators and to the methods of the data
+are counted in CALLS, the renders write empty files (1 pixel images in PNG) where blender would write the images.
+"""
+import os
+import struct
+import sys
+import types
+import zlib
+from collections import Counter
+
+import numpy as np
+
+CALLS = Counter()
+
+
+def png_chunk(p_type, p_body):
+    return struct.pack(">I4s", len(p_body), p_type) + p_body + struct.pack(">I", zlib.crc32(p_type + p_body))
+
+
+# 1x1 grayscale PNG saved without compression, the output writer of the simulator can compress it
+EMPTY_PNG = (b"\x89PNG\r\n\x1a\n"
+             + png_chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+             + png_chunk(b"IDAT", zlib.compress(b"\x00\x00", 0))
+             + png_chunk(b"IEND", b""))
+
+
+def record(p_name):
+    CALLS[p_name] += 1
+
+
+class Bag:
+    """
+    Object that accepts any attribute : the unknown attributes and items are created on the fly
+    and the calls are counted with the path of the attribute
+    """
+
+    def __init__(self, p_path):
+        object.__setattr__(self, "_path", p_path)
+        object.__setattr__(self, "_items", {})
+
+    def __getattr__(self, p_name):
+        if p_name.startswith("__"):
+            raise AttributeError(p_name)
+        child = Bag(self._path + "." + p_name)
+        object.__setattr__(self, p_name, child)
+        return child
+
+    def __getitem__(self, p_key):
+        if p_key not in self._items:
+            self._items[p_key] = Bag(self._path + "[]")
+        return self._items[p_key]
+
+    def __setitem__(self, p_key, p_value):
+        self._items[p_key] = p_value
+
+    def __call__(self, *args, **kwargs):
+        record(self._path)
+        return Bag(self._path + "()")
+
+
+class ID(Bag):
+    """
+    Data-block with custom properties and a number of users
+    """
+
+    def __init__(self, p_type, p_name):
+        super().__init__(p_type)
+        self.name = p_name
+        self.use_fake_user = False
+        object.__setattr__(self, "_properties", {})
+
+    def __getitem__(self, p_key):
+        return self._properties[p_key]
+
+    def __setitem__(self, p_key, p_value):
+        self._properties[p_key] = p_value
+
+    def __contains__(self, p_key):
+        return p_key in self._properties
+
+    def get(self, p_key, p_default=None):
+        return self._properties.get(p_key, p_default)
+
+    def count_users(self):
+        return 0
+
+    @property
+    def users(self):
+        return self.count_users() + (1 if self.use_fake_user else 0)
+
+
+class Datablock(ID):
+    def __init__(self, p_name):
+        super().__init__("ID", p_name)
+
+
+class Vertices:
+    def __init__(self, p_coordinates):
+        self.coordinates = p_coordinates
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def foreach_get(self, p_attribute, p_buffer):
+        record("MeshVertices.foreach_get")
+        p_buffer[:] = self.coordinates.ravel()
+
+    def foreach_set(self, p_attribute, p_buffer):
+        record("MeshVertices.foreach_set")
+        self.coordinates = np.asarray(p_buffer, dtype=np.float32).reshape(-1, 3).copy()
+
+
+class Mesh(ID):
+    def __init__(self, p_name):
+        super().__init__("Mesh", p_name)
+        self.vertices = Vertices(np.zeros((0, 3), dtype=np.float32))
+        self.materials = []
+
+    def copy(self):
+        record("Mesh.copy")
+        mesh = data.meshes.new(self.name)
+        mesh.vertices = Vertices(self.vertices.coordinates.copy())
+        mesh.materials = list(self.materials)
+        return mesh
+
+    def count_users(self):
+        return sum(1 for scene_object in data.objects if scene_object.data is self)
+
+
+class Object(ID):
+    def __init__(self, p_name, p_data=None, p_type=None):
+        super().__init__("Object", p_name)
+        self.data = p_data
+        self.type = p_type or ("MESH" if isinstance(p_data, Mesh) else "EMPTY")
+        self.select = False
+        self.hide_render = False
+        self.location = [0.0, 0.0, 0.0]
+        self.pass_index = 0
+
+    def count_users(self):
+        return sum(1 for scene in data.scenes if self in scene.objects.objects)
+
+
+class NodeCollection:
+    def __init__(self):
+        self.nodes = []
+
+    def new(self, p_type):
+        record("Nodes.new")
+        node = Bag("Node")
+        node.bl_idname = p_type
+        node.name = p_type
+        node.mute = False
+        self.nodes.append(node)
+        return node
+
+    def remove(self, p_node):
+        record("Nodes.remove")
+        self.nodes.remove(p_node)
+
+    def __getitem__(self, p_key):
+        if isinstance(p_key, int):
+            return self.nodes[p_key]
+        for node in self.nodes:
+            if node.name == p_key:
+                return node
+        raise KeyError(p_key)
+
+    def __contains__(self, p_name):
+        return any(node.name == p_name for node in self.nodes)
+
+    def __iter__(self):
+        return iter(list(self.nodes))
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class NodeTree(Bag):
+    def __init__(self, p_default_nodes=()):
+        super().__init__("NodeTree")
+        self.nodes = NodeCollection()
+        for node_type in p_default_nodes:
+            self.nodes.new(node_type)
+
+
+class Material(ID):
+    def __init__(self, p_name):
+        super().__init__("Material", p_name)
+        self.node_tree = NodeTree(("ShaderNodeBsdfDiffuse", "ShaderNodeOutputMaterial"))
+
+    def count_users(self):
+        return sum(mesh.materials.count(self) for mesh in data.meshes)
+
+
+class Image(ID):
+    def __init__(self, p_name):
+        super().__init__("Image", p_name)
+        self.type = "IMAGE"
+
+    def count_users(self):
+        return sum(1 for material in data.materials for node in material.node_tree.nodes
+                   if node.__dict__.get("image") is self)
+
+
+class SceneObjects:
+    def __init__(self):
+        self.objects = []
+        self.active = None
+
+    def link(self, p_object):
+        record("SceneObjects.link")
+        self.objects.append(p_object)
+
+    def unlink(self, p_object):
+        record("SceneObjects.unlink")
+        self.objects.remove(p_object)
+
+    def get(self, p_name, p_default=None):
+        for scene_object in self.objects:
+            if scene_object.name == p_name:
+                return scene_object
+        return p_default
+
+    def __getitem__(self, p_name):
+        scene_object = self.get(p_name)
+        if scene_object is None:
+            raise KeyError(p_name)
+        return scene_object
+
+    def __iter__(self):
+        return iter(list(self.objects))
+
+    def __len__(self):
+        return len(self.objects)
+
+
+class Scene(ID):
+    def __init__(self, p_name):
+        super().__init__("Scene", p_name)
+        self.objects = SceneObjects()
+        self.node_tree = NodeTree(("Render Layers", "Composite"))
+        self.use_nodes = False
+        self.frame_start = 1
+        self.frame_end = 250
+        self.frame_current = 1
+
+
+class IDCollection:
+    """
+    Collection of bpy.data, the names are made unique like blender does (name.001)
+    """
+
+    def __init__(self, p_name, p_class):
+        self.name = p_name
+        self.id_class = p_class
+        self.items = []
+
+    def unique_name(self, p_name):
+        names = set(item.name for item in self.items)
+        name = p_name
+        index = 0
+        while name in names:
+            index += 1
+            name = "%s.%03d" % (p_name, index)
+        return name
+
+    def new(self, name, *args):
+        record("bpy.data.%s.new" % self.name)
+        item = self.id_class(self.unique_name(name), *args)
+        self.items.append(item)
+        return item
+
+    def load(self, p_path):
+        record("bpy.data.%s.load" % self.name)
+        item = self.id_class(self.unique_name(os.path.basename(p_path)))
+        self.items.append(item)
+        return item
+
+    def remove(self, p_item):
+        record("bpy.data.%s.remove" % self.name)
+        self.items.remove(p_item)
+
+    def get(self, p_name, p_default=None):
+        for item in self.items:
+            if item.name == p_name:
+                return item
+        return p_default
+
+    def __getitem__(self, p_key):
+        if isinstance(p_key, int):
+            return self.items[p_key]
+        item = self.get(p_key)
+        if item is None:
+            raise KeyError(p_key)
+        return item
+
+    def __contains__(self, p_name):
+        return self.get(p_name) is not None
+
+    def __iter__(self):
+        return iter(list(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Context:
+    def __init__(self, p_scene):
+        self.scene = p_scene
+
+    @property
+    def active_object(self):
+        return self.scene.objects.active
+
+    @property
+    def object(self):
+        return self.scene.objects.active
+
+
+def delete_selected_objects():
+    record("bpy.ops.object.delete")
+    for scene_object in context.scene.objects:
+        if scene_object.select:
+            context.scene.objects.unlink(scene_object)
+            data.objects.remove(scene_object)
+            if context.scene.objects.active is scene_object:
+                context.scene.objects.active = None
+
+
+def touch(p_path):
+    with open(p_path, 'wb') as output_file:
+        if p_path.endswith(".png"):
+            output_file.write(EMPTY_PNG)
+
+
+def render(animation=False, write_still=False, scene=None, **kwargs):
+    """
+    Write empty files (1 pixel images in PNG) where blender would write the images of the render and of
+    the output nodes of the compositor
+    """
+    record("bpy.ops.render.render")
+    render_scene = context.scene
+    if animation:
+        frames = range(render_scene.frame_start, render_scene.frame_end + 1)
+    else:
+        frames = [render_scene.frame_current]
+    for frame in frames:
+        if animation:
+            touch(render_scene.render.filepath + "%04d.png" % frame)
+        elif write_still:
+            # Blender also appends the frame number to the name of a still
+            touch(render_scene.render.filepath + "%04d.png" % frame)
+        if render_scene.use_nodes:
+            for node in render_scene.node_tree.nodes:
+                if node.bl_idname == "CompositorNodeOutputFile" and not node.mute:
+                    extension = ".exr" if node.format.file_format == 'OPEN_EXR' else ".png"
+                    touch(os.path.join(node.base_path, node.file_slots[0].path + "%04d%s" % (frame, extension)))
+
+
+class BMFaceSeq(list):
+    def __init__(self, p_faces=()):
+        super().__init__(p_faces)
+        self.layers = Bag("BMFaceSeq.layers")
+
+
+class BMesh(Bag):
+    def __init__(self):
+        super().__init__("BMesh")
+        self.coordinates = np.zeros((0, 3))
+        self.verts = []
+        self.edges = []
+        self.faces = BMFaceSeq()
+
+    def to_mesh(self, p_mesh):
+        record("BMesh.to_mesh")
+        p_mesh.vertices = Vertices(self.coordinates.astype(np.float32))
+
+    def free(self):
+        record("BMesh.free")
+
+
+def create_cube(p_bmesh, size=2.0, **kwargs):
+    record("bmesh.ops.create_cube")
+    p_bmesh.coordinates = np.array([(x, y, z) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)],
+                                   dtype=np.float64) * size / 2.0
+    p_bmesh.faces = BMFaceSeq(Bag("BMFace") for _ in range(6))
+    for face in p_bmesh.faces:
+        face.loops = [Bag("BMLoop") for _ in range(4)]
+
+
+def subdivide_edges(p_bmesh, cuts=1, **kwargs):
+    """
+    Vertices of a cube subdivided with a grid fill : the points of a (cuts + 2)^3 lattice on the surface
+    """
+    record("bmesh.ops.subdivide_edges")
+    minimum, maximum = p_bmesh.coordinates.min(axis=0), p_bmesh.coordinates.max(axis=0)
+    steps = np.linspace(0.0, 1.0, cuts + 2)
+    grid = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), axis=-1).reshape(-1, 3)
+    surface = grid[np.any((grid == 0.0) | (grid == 1.0), axis=1)]
+    p_bmesh.coordinates = minimum + surface * (maximum - minimum)
+
+
+def scale(p_bmesh, vec=(1.0, 1.0, 1.0), **kwargs):
+    record("bmesh.ops.scale")
+    p_bmesh.coordinates = p_bmesh.coordinates * np.asarray(vec, dtype=np.float64)
+
+
+data = None
+context = None
+
+
+def reset():
+    """
+    Start from a new blend file : a scene with a camera and a render layer
+    :return: the scene
+    """
+    global data, context
+    data = types.SimpleNamespace()
+    for name, id_class in (("objects", Object), ("meshes", Mesh), ("materials", Material),
+                           ("textures", Datablock), ("images", Image), ("actions", Datablock),
+                           ("lamps", Datablock), ("cameras", Datablock), ("libraries", Datablock),
+                           ("scenes", Scene)):
+        setattr(data, name, IDCollection(name, id_class))
+    scene = data.scenes.new("Scene")
+    scene.render.layers["RenderLayer"] = Bag("RenderLayer")
+    context = Context(scene)
+    camera = data.objects.new("Camera", data.cameras.new("Camera"), "CAMERA")
+    scene.objects.link(camera)
+    bpy_module = sys.modules.get("bpy")
+    if bpy_module is not None:
+        bpy_module.data = data
+        bpy_module.context = context
+    CALLS.clear()
+    return scene
+
+
+def install():
+    """
+    Register the fake bpy and bmesh modules, they must be installed before the import of the simulator
+    :return:
+    """
+    bpy_module = types.ModuleType("bpy")
+    bpy_module.ops = Bag("bpy.ops")
+    bpy_module.ops.object.delete = delete_selected_objects
+    bpy_module.ops.render.render = render
+    bpy_module.app = Bag("bpy.app")
+    bpy_module.app.handlers.render_post = []
+    bpy_module.types = Bag("bpy.types")
+    sys.modules["bpy"] = bpy_module
+
+    bmesh_module = types.ModuleType("bmesh")
+    bmesh_module.new = BMesh
+    bmesh_module.ops = types.SimpleNamespace(create_cube=create_cube, subdivide_edges=subdivide_edges, scale=scale)
+    sys.modules["bmesh"] = bmesh_module
+    reset()
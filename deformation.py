@@ -0,0 +1,189 @@
+import itertools
+import zlib
+
+import numpy as np
+
+# Order of the deformation options (same as the options of simulator.add_deformations)
+OPTION_DISPLACE = 0
+OPTION_CAST_CYLINDER = 1
+OPTION_CAST_SPHERE = 2
+OPTION_BEVEL = 3
+OPTION_TWIST = 4
+OPTION_BEND = 5
+OPTION_TAPER = 6
+OPTION_ISOTROPIC_SCALING = 7
+OPTION_ANISOTROPIC_SCALING = 8
+
+NOISE_TABLE_SIZE = 256
+
+
+def get_brick_seed(p_scenario_seed, p_brick_name):
+    """
+    Get the seed of the deformations of a brick
+    :param p_scenario_seed: seed of the scenario
+    :param p_brick_name: name of the brick
+    :return: seed
+    """
+    return (p_scenario_seed + zlib.crc32(p_brick_name.encode())) % (2 ** 32)
+
+
+def lattice_noise(p_points, p_permutation, p_values):
+    """
+    Smooth value noise : random values on an integer lattice interpolated with a smoothstep
+    :param p_points: array (n, 3) of points
+    :param p_permutation: permutation of the lattice hash
+    :param p_values: array (NOISE_TABLE_SIZE, channels) of random values
+    :return: array (n, channels) of noise values
+    """
+    cell = np.floor(p_points).astype(np.int64)
+    fraction = p_points - cell
+    fade = fraction * fraction * (3.0 - 2.0 * fraction)
+    mask = NOISE_TABLE_SIZE - 1
+    result = np.zeros((len(p_points), p_values.shape[1]))
+    for corner in itertools.product((0, 1), repeat=3):
+        corner_cell = cell + corner
+        hashed = p_permutation[(p_permutation[(p_permutation[corner_cell[:, 0] & mask]
+                                               + corner_cell[:, 1]) & mask]
+                                + corner_cell[:, 2]) & mask]
+        weight = np.prod(np.where(corner, fade, 1.0 - fade), axis=1)
+        result += weight[:, None] * p_values[hashed]
+    return result
+
+
+def displace_vertices(p_coordinates, p_rng, p_noise_scale, p_noise_depth, p_strength, p_mid_level):
+    """
+    Move the vertices along the XYZ axis with a colored noise (same as a DISPLACE modifier in RGB_TO_XYZ
+    with a CLOUDS texture)
+    :param p_coordinates: array (n, 3) of vertex coordinates
+    :param p_rng: random generator of the brick
+    :param p_noise_scale: size of the noise
+    :param p_noise_depth: number of octaves of the noise
+    :param p_strength: strength of the displacement
+    :param p_mid_level: value of the noise that doesn't move the vertex
+    :return: displaced coordinates
+    """
+    permutation = p_rng.permutation(NOISE_TABLE_SIZE)
+    values = p_rng.random_sample((NOISE_TABLE_SIZE, 3))
+    points = p_coordinates / p_noise_scale
+    color = np.zeros_like(p_coordinates)
+    amplitude = 1.0
+    total_amplitude = 0.0
+    for _ in range(p_noise_depth + 1):
+        color += amplitude * lattice_noise(points, permutation, values)
+        total_amplitude += amplitude
+        amplitude *= 0.5
+        points = points * 2.0
+    return p_coordinates + (color / total_amplitude - p_mid_level) * p_strength
+
+
+def cast_vertices(p_coordinates, p_factor, p_radius, p_use_axis, p_cylinder):
+    """
+    Move the vertices toward a sphere or a cylinder (same as a CAST modifier with use_radius_as_size)
+    :param p_coordinates: array (n, 3) of vertex coordinates
+    :param p_factor: factor of the cast
+    :param p_radius: only the vertices within this distance of the center are moved, and size of the shape
+    :param p_use_axis: (x, y, z) axis moved
+    :param p_cylinder: cast to a cylinder around the Z axis instead of a sphere
+    :return: casted coordinates
+    """
+    offset = p_coordinates.copy()
+    if p_cylinder:
+        offset[:, 2] = 0.0
+    distance = np.linalg.norm(offset, axis=1)
+    moved = (distance > 0.0) & (distance <= p_radius)
+    target = offset[moved] / distance[moved, None] * p_radius
+    delta = p_factor * (target - offset[moved])
+    delta[:, ~np.asarray(p_use_axis)] = 0.0
+    if p_cylinder:
+        delta[:, 2] = 0.0
+    result = p_coordinates.copy()
+    result[moved] += delta
+    return result
+
+
+def twist_vertices(p_coordinates, p_angle):
+    """
+    Twist the vertices around the Z axis (same as a SIMPLE_DEFORM modifier in TWIST)
+    :param p_coordinates: array (n, 3) of vertex coordinates
+    :param p_angle: angle of twist by unit of Z
+    :return: twisted coordinates
+    """
+    theta = p_coordinates[:, 2] * p_angle
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    result = p_coordinates.copy()
+    result[:, 0] = p_coordinates[:, 0] * cos_theta - p_coordinates[:, 1] * sin_theta
+    result[:, 1] = p_coordinates[:, 0] * sin_theta + p_coordinates[:, 1] * cos_theta
+    return result
+
+
+def bend_vertices(p_coordinates, p_angle):
+    """
+    Bend the vertices around the Z axis (same as a SIMPLE_DEFORM modifier in BEND)
+    :param p_coordinates: array (n, 3) of vertex coordinates
+    :param p_angle: angle of bend by unit of X
+    :return: bent coordinates
+    """
+    if abs(p_angle) <= 1e-7:
+        return p_coordinates.copy()
+    theta = p_coordinates[:, 0] * p_angle
+    radius = 1.0 / p_angle
+    result = p_coordinates.copy()
+    result[:, 0] = -(p_coordinates[:, 1] - radius) * np.sin(theta)
+    result[:, 1] = (p_coordinates[:, 1] - radius) * np.cos(theta) + radius
+    return result
+
+
+def taper_vertices(p_coordinates, p_factor):
+    """
+    Taper the vertices along the Z axis (same as a SIMPLE_DEFORM modifier in TAPER)
+    :param p_coordinates: array (n, 3) of vertex coordinates
+    :param p_factor: factor of taper by unit of Z
+    :return: tapered coordinates
+    """
+    scale = 1.0 + p_coordinates[:, 2] * p_factor
+    result = p_coordinates.copy()
+    result[:, 0] *= scale
+    result[:, 1] *= scale
+    return result
+
+
+def deform_vertices(p_coordinates, p_rng, p_scale_min, p_scale_max, p_options):
+    """
+    Apply the deformations chosen by the options to the vertices of a brick.
+    The scaling is applied first, like the modifiers that were evaluated on the scaled mesh.
+    :param p_coordinates: array (n, 3) of vertex coordinates
+    :param p_rng: random generator of the brick
+    :param p_scale_min: minimum of the random scaling
+    :param p_scale_max: maximum of the random scaling
+    :param p_options: deformations enabled (see the OPTION_ constants)
+    :return: deformed coordinates
+    """
+    # Draw all the parameters first so that the random sequence doesn't depend on the mesh
+    noise_scale = p_rng.uniform(0.04, 0.08)
+    noise_depth = int(p_rng.uniform(1, 3))
+    cylinder_factor = p_rng.uniform(-0.05, 0.25)
+    sphere_factor = p_rng.uniform(-0.1, 0.1)
+    twist_angle = p_rng.uniform(7, 10) * np.pi / 180
+    bend_angle = p_rng.uniform(0, 30) * np.pi / 180
+    taper_factor = p_rng.uniform(0.1, 0.8)
+    isotropic_scale = p_rng.uniform(p_scale_min, p_scale_max)
+    anisotropic_scale = p_rng.uniform(p_scale_min, p_scale_max, 3)
+
+    coordinates = p_coordinates
+    if p_options[OPTION_ISOTROPIC_SCALING]:
+        coordinates = coordinates * isotropic_scale
+    if p_options[OPTION_ANISOTROPIC_SCALING]:
+        coordinates = coordinates * anisotropic_scale
+    if p_options[OPTION_DISPLACE]:
+        coordinates = displace_vertices(coordinates, p_rng, noise_scale, noise_depth, 0.006, 0.005)
+    if p_options[OPTION_CAST_CYLINDER]:
+        coordinates = cast_vertices(coordinates, cylinder_factor, 0.05, (True, True, True), True)
+    if p_options[OPTION_CAST_SPHERE]:
+        coordinates = cast_vertices(coordinates, sphere_factor, 0.05, (False, True, False), False)
+    if p_options[OPTION_TWIST]:
+        coordinates = twist_vertices(coordinates, twist_angle)
+    if p_options[OPTION_BEND]:
+        coordinates = bend_vertices(coordinates, bend_angle)
+    if p_options[OPTION_TAPER]:
+        coordinates = taper_vertices(coordinates, taper_factor)
+    return coordinates
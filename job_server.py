@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import random
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib import request
+from urllib.error import HTTPError
+
+import scenario_format
+
+COMPLETED_FILE = "completed.jsonl"
+DEFAULT_PORT = 8765
+DEFAULT_LEASE_TIMEOUT = 600
+JOB_POLL_INTERVAL = 5
+
+
+class LeaseExpiredError(Exception):
+    """
+    The lease of the job run by a worker has expired, the job may have been given to another worker
+    """
+
+
+def build_jobs(p_config):
+    """
+    Build the jobs of a run from its configuration.
+    In iteration mode a job is an iteration and its seed, in replay mode a job is a scenario of pathReplay
+    (serialized, the workers don't need to access the folder of the campaign)
+    :param p_config: configuration of the run
+    :return: list of jobs
+    """
+    jobs = []
+    if p_config.get("replayMode"):
+        for folder in scenario_format.discover_replay_folders(p_config["pathReplay"]):
+            scenario = scenario_format.load_scenario(folder)
+            jobs.append({"id": folder,
+                         "scenario": scenario,
+                         "output_folder": os.path.basename(os.path.normpath(folder))})
+    else:
+        base_seed = p_config.get("seed")
+        if base_seed is None:
+            base_seed = random.randint(0, 2 ** 31 - 1)
+        for iteration in range(p_config["iterationNumber"]):
+            jobs.append({"id": str(iteration), "iteration": iteration, "seed": base_seed + iteration})
+    return jobs
+
+
+class JobQueue:
+    """
+    Jobs waiting for a worker, jobs leased by a worker and completed jobs.
+    A lease must be renewed by the heartbeats of the worker, the job of an expired lease is given to another worker.
+    The completed jobs are recorded in completed.jsonl, they are skipped when the server is started again.
+    """
+
+    def __init__(self, p_jobs, p_state_folder, p_lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        self.lock = threading.Lock()
+        self.lease_timeout = p_lease_timeout
+        self.completed_path = os.path.join(p_state_folder, COMPLETED_FILE)
+        self.completed = set()
+        if os.path.isfile(self.completed_path):
+            with open(self.completed_path) as completed_file:
+                for line in completed_file:
+                    try:
+                        self.completed.add(json.loads(line)["job"])
+                    except ValueError:
+                        continue
+        self.jobs = {job["id"]: job for job in p_jobs}
+        self.pending = deque(job["id"] for job in p_jobs if job["id"] not in self.completed)
+        # lease id -> (job id, worker, deadline)
+        self.leases = {}
+
+    def requeue_expired_leases(self):
+        """
+        Put back at the front of the queue the jobs whose lease has not been renewed in time
+        """
+        now = time.time()
+        for lease_id, (job_id, worker, deadline) in list(self.leases.items()):
+            if deadline < now:
+                print("* Lease of %s expired (worker %s), job requeued" % (job_id, worker))
+                del self.leases[lease_id]
+                self.pending.appendleft(job_id)
+
+    def lease(self, p_worker):
+        """
+        Give the next job to a worker
+        :param p_worker: name of the worker
+        :return: job and lease id, or no job and done=True if all the jobs are completed
+        """
+        with self.lock:
+            self.requeue_expired_leases()
+            if not self.pending:
+                return {"job": None, "done": not self.leases}
+            job_id = self.pending.popleft()
+            lease_id = uuid.uuid4().hex
+            self.leases[lease_id] = (job_id, p_worker, time.time() + self.lease_timeout)
+            print("* Job %s leased to %s" % (job_id, p_worker))
+            return {"job": self.jobs[job_id], "lease": lease_id, "lease_timeout": self.lease_timeout}
+
+    def heartbeat(self, p_lease_id):
+        """
+        Renew a lease
+        :param p_lease_id: lease id
+        :return: False if the lease has expired
+        """
+        with self.lock:
+            self.requeue_expired_leases()
+            if p_lease_id not in self.leases:
+                return False
+            job_id, worker, _ = self.leases[p_lease_id]
+            self.leases[p_lease_id] = (job_id, worker, time.time() + self.lease_timeout)
+            return True
+
+    def complete(self, p_lease_id, p_job_id, p_worker, p_record):
+        """
+        Record the completion of a job
+        :param p_lease_id: lease id
+        :param p_job_id: job id
+        :param p_worker: name of the worker
+        :param p_record: record of the completion sent by the worker
+        :return: False if the job was already completed
+        """
+        with self.lock:
+            self.leases.pop(p_lease_id, None)
+            if p_job_id in self.completed or p_job_id not in self.jobs:
+                return False
+            # The job may have been requeued after a late heartbeat, the first completion is kept
+            for lease_id, (job_id, _, _) in list(self.leases.items()):
+                if job_id == p_job_id:
+                    del self.leases[lease_id]
+            if p_job_id in self.pending:
+                self.pending.remove(p_job_id)
+            self.completed.add(p_job_id)
+            with open(self.completed_path, 'a') as completed_file:
+                completed_file.write(json.dumps({"job": p_job_id,
+                                                 "worker": p_worker,
+                                                 "time": time.time(),
+                                                 "record": p_record}) + "\n")
+            print("* Job %s completed by %s (%s/%s)" % (p_job_id, p_worker, len(self.completed), len(self.jobs)))
+            return True
+
+    def status(self):
+        """
+        :return: number of jobs in each state and workers that hold a lease
+        """
+        with self.lock:
+            self.requeue_expired_leases()
+            return {"jobs": len(self.jobs),
+                    "pending": len(self.pending),
+                    "leased": len(self.leases),
+                    "completed": len(self.completed),
+                    "workers": sorted(set(worker for _, worker, _ in self.leases.values()))}
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the job server :
+    POST /lease {"worker"}, POST /heartbeat {"lease"}, POST /complete {"lease", "job", "worker", "record"},
+    GET /status
+    """
+
+    def send_json(self, p_code, p_data):
+        body = json.dumps(p_data).encode()
+        self.send_response(p_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(200, self.server.queue.status())
+        else:
+            self.send_json(404, {"error": "unknown path"})
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode() or "{}")
+        queue = self.server.queue
+        if self.path == "/lease":
+            self.send_json(200, queue.lease(data.get("worker")))
+        elif self.path == "/heartbeat":
+            if queue.heartbeat(data.get("lease")):
+                self.send_json(200, {"ok": True})
+            else:
+                self.send_json(410, {"error": "lease expired"})
+        elif self.path == "/complete":
+            accepted = queue.complete(data.get("lease"), data.get("job"), data.get("worker"), data.get("record"))
+            self.send_json(200, {"accepted": accepted})
+        else:
+            self.send_json(404, {"error": "unknown path"})
+
+    def log_message(self, p_format, *p_args):
+        # The requests are not printed, the heartbeats would flood the output
+        pass
+
+
+class JobHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in a thread (http.server.ThreadingHTTPServer needs python 3.7,
+    the python of blender 2.7x is older)
+    """
+    daemon_threads = True
+
+
+def create_server(p_queue, p_host="", p_port=DEFAULT_PORT):
+    """
+    Create the HTTP server of a job queue
+    :param p_queue: job queue
+    :param p_host: address of the server
+    :param p_port: port of the server, 0 to choose a free port
+    :return: server, serve_forever must be called to handle the requests
+    """
+    server = JobHTTPServer((p_host, p_port), JobRequestHandler)
+    server.queue = p_queue
+    return server
+
+
+class JobClient:
+    """
+    Client of the job server used by the workers (only uses urllib, it works with the python of blender)
+    """
+
+    def __init__(self, p_url, p_worker=None):
+        self.url = p_url.rstrip("/")
+        self.worker = p_worker or "%s-%s" % (socket.gethostname(), os.getpid())
+
+    def post(self, p_path, p_data):
+        http_request = request.Request(self.url + p_path,
+                                       data=json.dumps(p_data).encode(),
+                                       headers={"Content-Type": "application/json"})
+        with request.urlopen(http_request) as response:
+            return json.loads(response.read().decode())
+
+    def lease(self):
+        return self.post("/lease", {"worker": self.worker})
+
+    def heartbeat(self, p_lease_id):
+        try:
+            self.post("/heartbeat", {"lease": p_lease_id})
+            return True
+        except HTTPError as error:
+            if error.code == 410:
+                return False
+            raise
+
+    def complete(self, p_lease_id, p_job_id, p_record):
+        return self.post("/complete", {"lease": p_lease_id, "job": p_job_id, "worker": self.worker,
+                                       "record": p_record})["accepted"]
+
+    def status(self):
+        with request.urlopen(self.url + "/status") as response:
+            return json.loads(response.read().decode())
+
+
+def run_worker(p_client, p_run_job, p_poll_interval=JOB_POLL_INTERVAL):
+    """
+    Lease and run jobs until the server has no more job
+    :param p_client: client of the job server
+    :param p_run_job: function (job, lease id) -> record of the completion, None if the job has been stopped
+    because its lease has expired (the job is not completed, another worker runs it)
+    :param p_poll_interval: waiting time when all the remaining jobs are leased by other workers
+    :return: number of jobs completed
+    """
+    nb_jobs = 0
+    while True:
+        response = p_client.lease()
+        if response["job"] is None:
+            if response["done"]:
+                return nb_jobs
+            time.sleep(p_poll_interval)
+            continue
+        record = p_run_job(response["job"], response["lease"])
+        if record is None:
+            continue
+        p_client.complete(response["lease"], response["job"]["id"], record)
+        nb_jobs += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Job server that hands out the scenarios of a run to the workers")
+    parser.add_argument("config", help="path of the configuration file of the run")
+    parser.add_argument("--host", default="", help="address of the server (default : all the interfaces)")
+    parser.add_argument("--port", type=int, default=None,
+                        help="port of the server (default : jobServerPort of the configuration or %s)" % DEFAULT_PORT)
+    parser.add_argument("--state", default=None,
+                        help="folder of completed.jsonl (default : root_path_data of the configuration)")
+    arguments = parser.parse_args()
+
+    with open(arguments.config) as f:
+        config = json.load(f)
+    state_folder = arguments.state or config["root_path_data"]
+    if not os.path.exists(state_folder):
+        os.makedirs(state_folder)
+    queue = JobQueue(build_jobs(config), state_folder, config.get("jobLeaseTimeout", DEFAULT_LEASE_TIMEOUT))
+    server = create_server(queue, arguments.host, arguments.port or config.get("jobServerPort", DEFAULT_PORT))
+    print("=============================================")
+    print("* Jobs : ", queue.status())
+    print("* Listening on port : ", server.server_address[1])
+    print("=============================================")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("* Status : ", queue.status())
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import scenario_format
+
+SIMULATOR_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "simulator.py")
+SHARD_FOLDER_PATTERN = "shard_%02d"
+REPLAY_JOURNAL_FILE = "replay_journal.jsonl"
+REPLAY_RECORDS_FOLDER = "replay_records"
+POLL_INTERVAL = 0.5
+# Each worker holds its own copy of the scene, the default number of workers is limited to bound the memory
+DEFAULT_MAX_WORKERS = 4
+
+
+def compute_shards(p_iteration_number, p_nb_workers):
+    """
+    Split the iteration range into disjoint slices, one for each worker
+    :param p_iteration_number: total number of iteration
+    :param p_nb_workers: number of workers
+    :return: list of (offset, number of iteration) for each worker. Empty slices are dropped
+    """
+    shards = []
+    offset = 0
+    for index_worker in range(p_nb_workers):
+        count = p_iteration_number // p_nb_workers
+        if index_worker < p_iteration_number % p_nb_workers:
+            count += 1
+        if count > 0:
+            shards.append((offset, count))
+        offset += count
+    return shards
+
+
+def create_shard_config(p_config, p_offset, p_count, p_seed, p_shard_folder):
+    """
+    Create the configuration of a worker from the configuration of the run
+    :param p_config: configuration of the run
+    :param p_offset: first iteration of the worker
+    :param p_count: number of iteration of the worker
+    :param p_seed: seed of the worker
+    :param p_shard_folder: folder where the worker will store its scenarios
+    :return: configuration of the worker
+    """
+    shard_config = dict(p_config)
+    shard_config["iterationMode"] = True
+    shard_config["replayMode"] = False
+    shard_config["iterationNumber"] = p_count
+    shard_config["iterationOffset"] = p_offset
+    shard_config["seed"] = p_seed
+    # root_path_data is used as a prefix of the scenario folders, it must end with a separator
+    shard_config["root_path_data"] = os.path.join(p_shard_folder, "")
+    return shard_config
+
+
+def start_worker(p_blender_executable, p_config_path, p_log_path, p_nb_threads, p_extra_arguments=()):
+    """
+    Start a headless blender worker running the simulator
+    :param p_blender_executable: blender executable
+    :param p_config_path: configuration file of the worker
+    :param p_log_path: file where the output of the worker is redirected
+    :param p_nb_threads: number of render threads of the worker
+    :param p_extra_arguments: additional arguments given to the simulator
+    :return: the worker process
+    """
+    # The worker has its own handle of the log file, the one of the launcher is closed
+    with open(p_log_path, 'w') as log_file:
+        return subprocess.Popen([p_blender_executable,
+                                 "--background",
+                                 # By default cycles starts one thread per cpu in each worker
+                                 "--threads", str(p_nb_threads),
+                                 # Without this option blender exits with 0 when the script fails
+                                 "--python-exit-code", "1",
+                                 "--python", SIMULATOR_SCRIPT,
+                                 "--",
+                                 "--config", p_config_path] + list(p_extra_arguments),
+                                stdout=log_file,
+                                stderr=subprocess.STDOUT)
+
+
+def merge_shard_folders(p_root_path_data, p_shard_folders):
+    """
+    Move the finished scenario folders (the ones that contain OK.txt) of each shard into the root data folder
+    Unfinished scenarios are left in their shard folder
+    :param p_root_path_data: root data folder
+    :param p_shard_folders: folders of the shards
+    :return: number of scenario merged
+    """
+    nb_merged = 0
+    for shard_folder in p_shard_folders:
+        if not os.path.isdir(shard_folder):
+            continue
+        for folder_scenario in sorted(os.listdir(shard_folder)):
+            source = os.path.join(shard_folder, folder_scenario)
+            destination = os.path.join(p_root_path_data, folder_scenario)
+            if not os.path.isfile(os.path.join(source, "OK.txt")):
+                continue
+            if os.path.exists(destination):
+                print("WARNING : %s already exists, scenario kept in %s" % (destination, shard_folder))
+                continue
+            shutil.move(source, destination)
+            nb_merged += 1
+    return nb_merged
+
+
+def run_sharded(p_config, p_nb_workers, p_nb_threads, p_blender_executable):
+    """
+    Run the iteration mode of the simulator on several blender workers and merge their results
+    :param p_config: configuration of the run
+    :param p_nb_workers: number of workers
+    :param p_nb_threads: number of render threads of each worker
+    :param p_blender_executable: blender executable
+    :return: True if all the workers are finished without error
+    """
+    root_path_data = p_config["root_path_data"]
+    base_seed = p_config.get("seed")
+    if base_seed is None:
+        base_seed = random.randint(0, 2 ** 31 - 1)
+    workers = []
+    shard_folders = []
+    for index_shard, (offset, count) in enumerate(compute_shards(p_config["iterationNumber"], p_nb_workers)):
+        shard_folder = os.path.join(root_path_data, SHARD_FOLDER_PATTERN % index_shard)
+        if not os.path.exists(shard_folder):
+            os.makedirs(shard_folder)
+        shard_config = create_shard_config(p_config, offset, count, base_seed + index_shard, shard_folder)
+        config_path = os.path.join(shard_folder, "config.json")
+        with open(config_path, 'w') as json_file:
+            json.dump(shard_config, json_file)
+        print("* Worker %s : iterations %s to %s (seed %s)" % (index_shard, offset, offset + count - 1,
+                                                              shard_config["seed"]))
+        workers.append(start_worker(p_blender_executable,
+                                    config_path,
+                                    os.path.join(shard_folder, "worker.log"),
+                                    p_nb_threads))
+        shard_folders.append(shard_folder)
+
+    start_time = time.time()
+    success = True
+    for index_shard, worker in enumerate(workers):
+        return_code = worker.wait()
+        if return_code != 0:
+            print("ERROR : worker %s finished with code %s, see %s" % (index_shard, return_code,
+                                                                     os.path.join(shard_folders[index_shard],
+                                                                                  "worker.log")))
+            success = False
+    print("* All workers finished in %.1f s" % (time.time() - start_time))
+    print("* Scenarios merged : ", merge_shard_folders(root_path_data, shard_folders))
+    return success
+
+
+def read_replay_journal(p_journal_path):
+    """
+    Read the journal of the replays
+    :param p_journal_path: path of the journal
+    :return: dictionary scenario folder replayed -> record of the replay
+    """
+    records = {}
+    if not os.path.isfile(p_journal_path):
+        return records
+    with open(p_journal_path) as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record["replay_folder"]] = record
+    return records
+
+
+def build_replay_work_list(p_path_replay, p_journal_path):
+    """
+    Build the list of the scenario folders to replay, the folders already in the journal are skipped
+    :param p_path_replay: folder that contains the scenarios to replay
+    :param p_journal_path: path of the journal of the replays
+    :return: list of (scenario folder, name of the output folder)
+    """
+    completed = read_replay_journal(p_journal_path)
+    work_list = []
+    output_names = set()
+    for folder in scenario_format.discover_replay_folders(p_path_replay):
+        # The output folder keeps the name of the scenario, a replay interrupted by a timeout
+        # is resumed in the same folder by the next run
+        output_name = os.path.basename(os.path.normpath(folder))
+        if output_name in output_names:
+            output_name = "%s-%d" % (output_name, len(work_list))
+        output_names.add(output_name)
+        if folder in completed:
+            continue
+        work_list.append((folder, output_name))
+    return work_list
+
+
+def run_replay_pool(p_config, p_config_path, p_nb_workers, p_nb_threads, p_blender_executable, p_timeout=None):
+    """
+    Replay the scenarios of pathReplay on a pool of blender workers, one scenario by worker process.
+    The replays are recorded in a journal (written only by this process), the next run skips them.
+    :param p_config: configuration of the run
+    :param p_config_path: configuration file of the run, given to the workers
+    :param p_nb_workers: number of workers
+    :param p_nb_threads: number of render threads of each worker
+    :param p_blender_executable: blender executable
+    :param p_timeout: maximum duration of the replay of a scenario in seconds, None for no limit
+    :return: True if all the scenarios have been replayed
+    """
+    root_path_data = p_config["root_path_data"]
+    journal_path = os.path.join(root_path_data, REPLAY_JOURNAL_FILE)
+    records_folder = os.path.join(root_path_data, REPLAY_RECORDS_FOLDER)
+    if not os.path.exists(records_folder):
+        os.makedirs(records_folder)
+    work_list = build_replay_work_list(p_config["pathReplay"], journal_path)
+    print("* Scenarios to replay : ", len(work_list))
+    own_folders = [folder for folder, output_name in work_list
+                   if os.path.realpath(os.path.join(root_path_data, output_name)) == os.path.realpath(folder)]
+    if own_folders:
+        # The workers refuse to replay a scenario into its own folder
+        print("ERROR : the scenarios of pathReplay would be replayed into their own folder, "
+              "pathReplay must not be a folder of root_path_data : ", own_folders[0])
+        return False
+
+    nb_failed = 0
+    running = []
+    start_time = time.time()
+    while work_list or running:
+        while work_list and len(running) < p_nb_workers:
+            folder, output_name = work_list.pop(0)
+            record_path = os.path.join(records_folder, output_name + ".json")
+            if os.path.exists(record_path):
+                os.remove(record_path)
+            worker = start_worker(p_blender_executable,
+                                  p_config_path,
+                                  os.path.join(records_folder, output_name + ".log"),
+                                  p_nb_threads,
+                                  ["--replay-folder", folder,
+                                   "--output-folder", output_name,
+                                   "--record", record_path])
+            running.append((worker, folder, record_path, time.time()))
+        time.sleep(POLL_INTERVAL)
+        still_running = []
+        for worker, folder, record_path, worker_start_time in running:
+            return_code = worker.poll()
+            if return_code is None:
+                if p_timeout is not None and time.time() - worker_start_time > p_timeout:
+                    worker.kill()
+                    worker.wait()
+                    print("ERROR : replay of %s stopped after %s s" % (folder, p_timeout))
+                    nb_failed += 1
+                else:
+                    still_running.append((worker, folder, record_path, worker_start_time))
+                continue
+            if return_code != 0 or not os.path.isfile(record_path):
+                print("ERROR : replay of %s finished with code %s" % (folder, return_code))
+                nb_failed += 1
+                continue
+            with open(record_path) as record_file:
+                record = json.load(record_file)
+            with open(journal_path, 'a') as journal_file:
+                journal_file.write(json.dumps(record) + "\n")
+            print("* Replayed %s in %.1f s" % (folder, record["duration"]))
+        running = still_running
+    print("* All replays finished in %.1f s, %s failed" % (time.time() - start_time, nb_failed))
+    return nb_failed == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the simulator on several headless blender workers")
+    parser.add_argument("config", help="path of the configuration file")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of workers (default : nbWorkers of the configuration or the number of cpu, "
+                             "at most %s)" % DEFAULT_MAX_WORKERS)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of render threads of each worker (default : threadsByWorker of the "
+                             "configuration or the number of cpu divided by the number of workers)")
+    parser.add_argument("--blender", default=None,
+                        help="blender executable (default : blenderExecutable of the configuration or blender)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="maximum duration of the replay of a scenario in seconds "
+                             "(default : replayTimeout of the configuration)")
+    arguments = parser.parse_args()
+
+    with open(arguments.config) as f:
+        config = json.load(f)
+    nb_workers = arguments.workers or config.get("nbWorkers") or min(os.cpu_count(), DEFAULT_MAX_WORKERS)
+    # The workers share the cpu instead of starting each one thread per cpu
+    nb_threads = arguments.threads or config.get("threadsByWorker") or max(1, os.cpu_count() // nb_workers)
+    blender_executable = arguments.blender or config.get("blenderExecutable", "blender")
+    print("=============================================")
+    print("* Number of workers : ", nb_workers)
+    print("* Render threads by worker : ", nb_threads)
+    print("* Blender : ", blender_executable)
+    print("=============================================")
+    if config["replayMode"]:
+        success = run_replay_pool(config, arguments.config, nb_workers, nb_threads, blender_executable,
+                                  arguments.timeout or config.get("replayTimeout"))
+    else:
+        success = run_sharded(config, nb_workers, nb_threads, blender_executable)
+    if not success:
+        sys.exit(-1)
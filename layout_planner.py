@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import random
+
+import numpy as np
+
+# Relative slots of the bricks of each configuration of layer.
+# Each slot is (coefficients of x, coefficients of y, rotation needed), the coefficients multiply
+# (width, height, separator) of the configuration.
+LAYOUT_SLOTS = (
+    # Configuration 0 : 4 vertical bricks and 2 horizontal bricks
+    (
+        ((-1, 0, 0), (-3, 0, 0), False),
+        ((-1, 0, 0), (-1, 0, 1), False),
+        ((-1, 0, 0), (1, 0, 2), False),
+        ((-1, 0, 0), (3, 0, 3), False),
+        ((0, 1, 1), (-2, 0, 1), True),
+        ((0, 1, 1), (-2, 2, 2), True),
+    ),
+    # Configuration 1
+    (
+        ((-2, 0, 0), (0, -1, 1), True),
+        ((-2, 0, 0), (0, 1, 2), True),
+        ((1, 0, 1), (0, -1.5, 0), False),
+        ((1, 0, 1), (2, -1.5, 1), False),
+        ((1, 0, 1), (4, -1.5, 2), False),
+        ((1, 0, 1), (6, -1.5, 3), False),
+    ),
+    # Configuration 2
+    (
+        ((-2, 0, 0), (1, -1.5, 1), True),
+        ((1, 0, 1), (0, -1.5, 0), False),
+        ((1, 0, 1), (2, -1.5, 1), False),
+        ((-1, 0, 0), (0, 0.5, 2), False),
+        ((-1, 0, 0), (2, 0.5, 3), False),
+        ((0, 1, 1), (1, 0.5, 2), True),
+    ),
+    # Configuration 3
+    (
+        ((-1, 0, 0), (0, -1.5, 0), False),
+        ((-1, 0, 0), (2, -1.5, 1), False),
+        ((0, 1, 1), (1, -1.5, 1), True),
+        ((-2, 0, 0), (1, 0.5, 2), True),
+        ((1, 0, 1), (0, 0.5, 2), False),
+        ((1, 0, 1), (2, 0.5, 3), False),
+    ),
+    # Configuration 4
+    (
+        ((-2, 0, 0), (1, -1.5, 1), True),
+        ((0, 0, 1), (1, -1.5, 1), True),
+        ((2, 0, 2), (1, -1.5, 1), True),
+        ((-2, 0, 0), (1, 0.5, 2), True),
+        ((0, 0, 1), (1, 0.5, 2), True),
+        ((2, 0, 2), (1, 0.5, 2), True),
+    ),
+    # Configuration 5
+    (
+        ((-1, 0, 0), (0, -1.5, 0), False),
+        ((-2, 0, 0), (3, -1.5, 1), True),
+        ((0, 0, 0.5), (3, -1.5, 1), True),
+        ((-1, 0, 0), (2, 0.5, 2), False),
+        ((0, 1, 1), (1, -1.5, 1), True),
+        ((0, 1, 1), (1, 0.5, 2), True),
+    ),
+    # Configuration 6
+    (
+        ((-2, 0, 0), (1, -1.5, 1), True),
+        ((-2, 0, 0), (1, 0.5, 2), True),
+        ((1, 0, 0), (0, -1.5, 0), False),
+        ((0, 0, 0), (3, -1.5, 1), True),
+        ((2, 0, 0.5), (3, -1.5, 1), True),
+        ((1, 0, 0), (2, 0.5, 2), False),
+    ),
+    # Configuration 7
+    (
+        ((-2, 0, 0), (1, -1.5, 1), True),
+        ((0, 0, 1), (1, -1.5, 1), True),
+        ((2, 0, 2), (1, -1.5, 1), True),
+        ((-1, 0, 0), (0, 0.5, 2), False),
+        ((-1, 0, 0), (2, 0.5, 3), False),
+        ((0, 1, 1), (1, 0.5, 2), True),
+    ),
+    # Configuration 8
+    (
+        ((-2, 0, 0), (1, -1.5, 1), True),
+        ((0, 0, 1), (1, -1.5, 1), True),
+        ((2, 0, 2), (1, -1.5, 1), True),
+        ((-2, 0, 0), (1, 0.5, 2), True),
+        ((1, 0, 1), (0, 0.5, 2), False),
+        ((1, 0, 1), (2, 0.5, 3), False),
+    ),
+    # Configuration 9
+    (
+        ((-2, 0, 0), (1, -1.5, 1), True),
+        ((1, 0, 1), (0, -1.5, 0), False),
+        ((1, 0, 1), (2, -1.5, 1), False),
+        ((-2, 0, 0), (1, 0.5, 2), True),
+        ((0, 0, 1), (1, 0.5, 2), True),
+        ((2, 0, 2), (1, 0.5, 2), True),
+    ),
+    # Configuration 10
+    (
+        ((-1, 0, 0), (0, -1.5, 0), False),
+        ((-1, 0, 0), (2, -1.5, 1), False),
+        ((0, 1, 1), (1, -1.5, 1), True),
+        ((-2, 0, 0), (1, 0.5, 2), True),
+        ((0, 0, 1), (1, 0.5, 2), True),
+        ((2, 0, 2), (1, 0.5, 2), True),
+    ),
+)
+# Height of the first layer of each configuration : coefficients of (weight, 1)
+LAYOUT_Z = tuple((1, 2) if configuration == 10 else (2, 0) for configuration in range(len(LAYOUT_SLOTS)))
+NB_SLOTS_BY_LAYER = 6
+
+LAYOUT_X = np.array([[slot[0] for slot in slots] for slots in LAYOUT_SLOTS], dtype=np.float64)
+LAYOUT_Y = np.array([[slot[1] for slot in slots] for slots in LAYOUT_SLOTS], dtype=np.float64)
+LAYOUT_ROTATION = np.array([[slot[2] for slot in slots] for slots in LAYOUT_SLOTS], dtype=bool)
+LAYOUT_Z_COEFFICIENTS = np.array(LAYOUT_Z, dtype=np.float64)
+
+BRICK_DTYPE = np.dtype([("scenario", np.int32),
+                        ("layer", np.int16),
+                        ("slot", np.int16),
+                        ("x", np.float64),
+                        ("y", np.float64),
+                        ("z", np.float64),
+                        ("rotation", bool),
+                        ("configuration", np.int16),
+                        ("texture_slot", np.int16)])
+
+
+def get_slot_position(p_configuration, p_layer, p_slot, p_config):
+    """
+    Compute the position of a slot of a configuration
+    :param p_configuration: configuration of the layer
+    :param p_layer: layer_level
+    :param p_slot: index of the slot in the configuration
+    :param p_config: configuration
+    :return: (x, y, z)
+    """
+    width = p_config["width"]
+    height = p_config["height"]
+    weight = p_config["weight"]
+    separator = p_config["separator"]
+    coefficients_x, coefficients_y, _ = LAYOUT_SLOTS[p_configuration][p_slot]
+    z_weight, z_constant = LAYOUT_Z[p_configuration]
+    return (coefficients_x[0] * width + coefficients_x[1] * height + coefficients_x[2] * separator,
+            coefficients_y[0] * width + coefficients_y[1] * height + coefficients_y[2] * separator,
+            z_weight * weight + z_constant + p_layer * (2 * weight + separator))
+
+
+def generate_configuration(p_configuration: int,
+                           p_layer: int,
+                           p_config,
+                           p_objects_params):
+    """
+    Generate a configuration (placement of object) for the current configuration choose
+    :param p_configuration: configuration choose
+    :param p_layer: layer_level
+    :param p_config:  configuration
+    :param p_objects_params : array that contains object configuration
+    :return:
+    """
+    layer_name = p_config["pattern_layer"]
+    max_use_texture = p_config["max_texture_use"] - 1
+    for index_slot, (_, _, rotation_needed) in enumerate(LAYOUT_SLOTS[p_configuration]):
+        cube_x, cube_y, cube_z = get_slot_position(p_configuration, p_layer, index_slot, p_config)
+        p_objects_params.append((layer_name % (p_layer, index_slot),
+                                 cube_x,
+                                 cube_y,
+                                 cube_z,
+                                 rotation_needed,
+                                 p_configuration,
+                                 random.randint(0, max_use_texture)))
+    return p_objects_params
+
+
+def plan_scenarios(p_config, p_nb_scenarios, p_nb_level, p_nb_texture_files, p_seed=None):
+    """
+    Plan the bricks of several scenarios at once
+    :param p_config: configuration
+    :param p_nb_scenarios: number of scenarios
+    :param p_nb_level: number of level of each scenario
+    :param p_nb_texture_files: number of texture files available for the bricks
+    :param p_seed: seed of the plan
+    :return: dictionary with the bricks (structured array, NB_SLOTS_BY_LAYER bricks by layer ordered by scenario
+    and layer), the configurations (p_nb_scenarios, p_nb_level), the textures (p_nb_scenarios, max_texture_use)
+    and the seeds of the scenarios
+    """
+    rng = np.random.RandomState(p_seed)
+    weight = p_config["weight"]
+    separator = p_config["separator"]
+    configurations = rng.randint(0, p_config["nbConfigurationAvailable"], (p_nb_scenarios, p_nb_level))
+    textures = rng.randint(0, p_nb_texture_files, (p_nb_scenarios, p_config["max_texture_use"]))
+    texture_slots = rng.randint(0, p_config["max_texture_use"], (p_nb_scenarios, p_nb_level, NB_SLOTS_BY_LAYER))
+    seeds = rng.randint(0, 2 ** 31 - 1, p_nb_scenarios)
+
+    dimensions = np.array([p_config["width"], p_config["height"], separator], dtype=np.float64)
+    layers = np.arange(p_nb_level)[None, :, None]
+    z_coefficients = LAYOUT_Z_COEFFICIENTS[configurations]
+
+    bricks = np.zeros(p_nb_scenarios * p_nb_level * NB_SLOTS_BY_LAYER, dtype=BRICK_DTYPE)
+    shape = (p_nb_scenarios, p_nb_level, NB_SLOTS_BY_LAYER)
+    bricks["scenario"] = np.broadcast_to(np.arange(p_nb_scenarios)[:, None, None], shape).ravel()
+    bricks["layer"] = np.broadcast_to(layers, shape).ravel()
+    bricks["slot"] = np.broadcast_to(np.arange(NB_SLOTS_BY_LAYER), shape).ravel()
+    bricks["x"] = (LAYOUT_X[configurations] @ dimensions).ravel()
+    bricks["y"] = (LAYOUT_Y[configurations] @ dimensions).ravel()
+    bricks["z"] = np.broadcast_to(z_coefficients[..., 0:1] * weight + z_coefficients[..., 1:2]
+                                  + layers * (2 * weight + separator), shape).ravel()
+    bricks["rotation"] = LAYOUT_ROTATION[configurations].ravel()
+    bricks["configuration"] = np.broadcast_to(configurations[..., None], shape).ravel()
+    bricks["texture_slot"] = texture_slots.ravel()
+    return {"bricks": bricks,
+            "configurations": configurations,
+            "textures": textures,
+            "seeds": seeds}
+
+
+def save_plan(p_path, p_plan):
+    """
+    Save a plan in a numpy archive
+    :param p_path: path of the archive
+    :param p_plan: plan (see plan_scenarios)
+    :return:
+    """
+    np.savez(p_path, **p_plan)
+
+
+def load_plan(p_path):
+    """
+    Load a plan saved by save_plan
+    :param p_path: path of the archive
+    :return: plan (see plan_scenarios)
+    """
+    with np.load(p_path) as archive:
+        return {key: archive[key] for key in archive.files}
+
+
+def get_planned_scenario(p_plan, p_index_scenario, p_config):
+    """
+    Get the data of a scenario of the plan in the format used by the simulator
+    :param p_plan: plan (see plan_scenarios)
+    :param p_index_scenario: index of the scenario in the plan
+    :param p_config: configuration
+    :return: (objects params, configuration of each layer, textures choose, seed of the scenario)
+    """
+    nb_level = p_plan["configurations"].shape[1]
+    nb_bricks = nb_level * NB_SLOTS_BY_LAYER
+    bricks = p_plan["bricks"][p_index_scenario * nb_bricks:(p_index_scenario + 1) * nb_bricks]
+    layer_name = p_config["pattern_layer"]
+    objects_params = [(layer_name % (int(brick["layer"]), int(brick["slot"])),
+                       float(brick["x"]),
+                       float(brick["y"]),
+                       float(brick["z"]),
+                       bool(brick["rotation"]),
+                       int(brick["configuration"]),
+                       int(brick["texture_slot"]))
+                      for brick in bricks]
+    return (objects_params,
+            p_plan["configurations"][p_index_scenario].tolist(),
+            p_plan["textures"][p_index_scenario].tolist(),
+            int(p_plan["seeds"][p_index_scenario]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plan the scenarios of a campaign outside of blender")
+    parser.add_argument("config", help="path of the configuration file")
+    parser.add_argument("output", help="path of the plan (.npz)")
+    parser.add_argument("--scenarios", type=int, default=None,
+                        help="number of scenarios (default : iterationNumber of the configuration)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the plan (default : seed of the configuration)")
+    arguments = parser.parse_args()
+
+    with open(arguments.config) as f:
+        config = json.load(f)
+    root_path_texture = config["root_path"] + config["root_path_texture_directory"]
+    nb_texture_files = len([pos_img for pos_img in os.listdir(root_path_texture) if pos_img.endswith('.jpg')])
+    nb_scenarios = arguments.scenarios or config["iterationNumber"]
+    plan = plan_scenarios(config,
+                          nb_scenarios,
+                          config["nbLevel"],
+                          nb_texture_files,
+                          arguments.seed if arguments.seed is not None else config.get("seed"))
+    save_plan(arguments.output, plan)
+    print("* %s scenarios planned (%s bricks) : %s" % (nb_scenarios, len(plan["bricks"]), arguments.output))
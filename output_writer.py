@@ -0,0 +1,110 @@
+import os
+import queue
+import struct
+import threading
+import zlib
+
+DEFAULT_QUEUE_SIZE = 8
+# zlib level of the PNG files recompressed by the writer, 1 is the level of the default compression of blender (15%)
+DEFAULT_PNG_COMPRESSION_LEVEL = 1
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def recompress_png(p_source_path, p_destination_path, p_level=DEFAULT_PNG_COMPRESSION_LEVEL):
+    """
+    Compress the image data of a PNG file saved without compression by blender and write it to its final name.
+    The filtered scanlines of the IDAT chunks are only inflated and deflated again, the pixels are not decoded.
+    zlib releases the GIL, blender can render the next step at the same time.
+    :param p_source_path: PNG file written by blender
+    :param p_destination_path: final path of the file, the source is removed
+    :param p_level: zlib compression level
+    :return:
+    """
+    with open(p_source_path, 'rb') as source_file:
+        data = source_file.read()
+    if data[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        raise ValueError("%s is not a PNG file" % p_source_path)
+    chunks = []
+    image_data = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        position += 12 + length
+        if chunk_type == b"IDAT":
+            # The image data can be split in several chunks, it is written in one chunk
+            if not image_data:
+                chunks.append((chunk_type, None))
+            image_data.append(body)
+        else:
+            chunks.append((chunk_type, body))
+    compressed_data = zlib.compress(zlib.decompress(b"".join(image_data)), p_level)
+    with open(p_destination_path, 'wb') as destination_file:
+        destination_file.write(PNG_SIGNATURE)
+        for chunk_type, body in chunks:
+            if body is None:
+                body = compressed_data
+            destination_file.write(struct.pack(">I4s", len(body), chunk_type))
+            destination_file.write(body)
+            destination_file.write(struct.pack(">I", zlib.crc32(chunk_type + body) & 0xffffffff))
+    os.remove(p_source_path)
+
+
+class OutputWriter:
+    """
+    Thread that compresses and writes the outputs of the renders while blender renders the next step.
+    The tasks are run in the order of their submission. The queue is bounded, the render waits when the writes
+    are late, so the memory used by the pending pixel buffers is limited.
+    When a task fails the next tasks are skipped and the exception is raised by the next call of submit or flush.
+    The tasks must not use bpy, it can only be used by the main thread.
+    """
+
+    def __init__(self, p_queue_size=DEFAULT_QUEUE_SIZE):
+        self.tasks = queue.Queue(p_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="output_writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    task()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.tasks.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, p_task):
+        """
+        Add a task to the queue, wait if the queue is full
+        :param p_task: function without parameter
+        :return:
+        """
+        self.raise_error()
+        self.tasks.put(p_task)
+
+    def flush(self):
+        """
+        Wait until all the submitted tasks are done
+        :return:
+        """
+        self.tasks.join()
+        self.raise_error()
+
+    def close(self):
+        """
+        Run the remaining tasks and stop the thread
+        :return:
+        """
+        self.tasks.put(None)
+        self.thread.join()
+        self.raise_error()
@@ -1,11 +1,29 @@
 import json
 import os
+# The EXR files are only decoded by opencv when this variable is set before its import
+os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
 import cv2
 import numpy as np
-import datetime
+from concurrent.futures import ProcessPoolExecutor
 from math import floor
 import random
 from builtins import any as b_any
+from collections import OrderedDict
+
+CROP_REGIONS_FILE_SUFFIX = "_crops.json"
+# Suffixes of the files rendered for each capture, in the order of the tuples (depth, image, ground truth)
+RENDER_PASS_SUFFIXES = ("_distance_map", "_image", "_object_index")
+# The raw depth maps and object indexes can be saved in EXR or numpy (depthOutputFormat of the simulator)
+RENDER_PASS_EXTENSIONS = (".png", ".exr", ".npy")
+# The depths above this value are the background, they are ignored by the normalization like in blender
+BACKGROUND_DEPTH = 10000.0
+# Number of decoded files kept by subdivide_image for the crops of a folder (decode_cache_size of the configuration)
+DEFAULT_DECODE_CACHE_SIZE = 8
+# Transformations applied to each crop, in the order of the files returned by apply_transformation_and_save
+TRANSFORMATION_IDS = ("original", "flipv", "fliph", "flipvh", "rot90", "rot180", "rot270")
+FLIP_CODES = {"flipv": 0, "fliph": 1, "flipvh": -1}
+# The rotations are counterclockwise
+ROTATE_CODES = {"rot90": cv2.ROTATE_90_COUNTERCLOCKWISE, "rot180": cv2.ROTATE_180, "rot270": cv2.ROTATE_90_CLOCKWISE}
 
 
 def create_folder(p_folder_to_create):
@@ -14,8 +32,8 @@ def create_folder(p_folder_to_create):
     :param p_folder_to_create:
     :return:
     """
-    if not os.path.exists(p_folder_to_create):
-        os.makedirs(p_folder_to_create)
+    # The workers of the parallel pre-processing can create the same folder
+    os.makedirs(p_folder_to_create, exist_ok=True)
 
 
 def rename_real_image_with_configuration(p_root_path_real_data, p_config):
@@ -35,37 +53,151 @@ def rename_real_image_with_configuration(p_root_path_real_data, p_config):
                                   os.path.join(root, files[i][0:-4] + "_" + str(configuration) + "_.png"))
 
 
-def copy_resources_from_data_folder_only_if_ready(p_root_path_data, p_config):
+def collect_ready_folders(p_root_path_data):
+    """
+    Find the step folders of the scenarios finished by the simulator (the scenarios with an OK.txt file)
+    :param p_root_path_data: folder of the data of the simulator
+    :return: list of (folder, files of the folder)
+    """
     is_ok_found = False
     root_found = ''
+    ready_folders = []
+    for root, dirs, files in os.walk(p_root_path_data):
+        if is_ok_found and root_found in root:
+            if (b_any("distance_map" in x for x in files)
+                    or b_any("_image" in x for x in files)
+                    or b_any("object_index" in x for x in files)):
+                ready_folders.append((root, files))
+        else:
+            if "OK.txt" in str(files):
+                # The file is found it means that we can process images
+                is_ok_found = True
+                root_found = root
+            else:
+                is_ok_found = False
+    return ready_folders
+
+
+def subdivide_image_with_seed(p_path_image, p_list_files, p_config, p_seed):
+    """
+    subdivide_image in a worker process, the random generators are seeded for each folder
+    (the forked workers would have the same random state)
+    :param p_path_image: folder of the rendered files
+    :param p_list_files: files of the folder
+    :param p_config: configuration
+    :param p_seed: seed of the folder
+    :return: see subdivide_image
+    """
+    random.seed(p_seed)
+    np.random.seed(p_seed)
+    print("Currently : {}".format(p_path_image))
+    return subdivide_image(p_path_image, p_list_files, p_config)
+
+
+def copy_resources_from_data_folder_only_if_ready(p_root_path_data, p_config):
     folder_list = {}
     if not os.path.exists(p_root_path_data):
         print("error, the folder doesn't exist :", p_root_path_data)
         exit(-1)
     else:
-        for root, dirs, files in os.walk(p_root_path_data):
-            if is_ok_found and root_found in root:
-                if (b_any("distance_map" in x for x in files)
-                        or b_any("_image" in x for x in files)
-                        or b_any("object_index" in x for x in files)):
-                    print("Currently : {}".format(root))
-                    result_folder, array_path_images = subdivide_image(root, files, p_config)
-                    if result_folder not in folder_list:
-                        folder_list[result_folder] = []
-                        folder_list[result_folder].append(array_path_images)
-                    else:
-                        folder_list[result_folder].append(array_path_images)
-
-            else:
-                if "OK.txt" in str(files):
-                    # The file is found it means that we can process images
-                    is_ok_found = True
-                    root_found = root
-                else:
-                    is_ok_found = False
+        ready_folders = collect_ready_folders(p_root_path_data)
+        nb_workers = p_config.get("nb_workers_pre_processing", 1)
+        if nb_workers > 1:
+            seeds = [random.randint(0, 2 ** 32 - 1) for _ in ready_folders]
+            with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+                results = list(executor.map(subdivide_image_with_seed,
+                                            [root for root, files in ready_folders],
+                                            [files for root, files in ready_folders],
+                                            [p_config] * len(ready_folders),
+                                            seeds,
+                                            chunksize=max(1, len(ready_folders) // (4 * nb_workers))))
+        else:
+            results = []
+            for root, files in ready_folders:
+                print("Currently : {}".format(root))
+                results.append(subdivide_image(root, files, p_config))
+        for result_folder, array_path_images in results:
+            if result_folder not in folder_list:
+                folder_list[result_folder] = []
+            folder_list[result_folder].append(array_path_images)
         prepare_data_for_learning(folder_list, p_config)
 
 
+def convert_raw_render_pass(p_raw_pass, p_object_index, p_config):
+    """
+    Convert a raw depth map or raw object indexes to the 8 bits BGR image of the legacy PNG files :
+    the depth is normalized between its min and its max, the object indexes are divided by the number of objects
+    :param p_raw_pass: metric depth or object indexes (2D array)
+    :param p_object_index: True if the array contains object indexes
+    :param p_config: configuration (nbCubeByLevel and nbLevel give the number of objects)
+    :return: 8 bits BGR image
+    """
+    raw_pass = np.asarray(p_raw_pass, dtype=np.float32)
+    if p_object_index:
+        values = raw_pass * (255.0 / (p_config["nbCubeByLevel"] * p_config["nbLevel"] * 2))
+    else:
+        foreground = raw_pass[raw_pass < BACKGROUND_DEPTH]
+        if foreground.size == 0:
+            values = np.zeros(raw_pass.shape, dtype=np.float32)
+        else:
+            min_depth, max_depth = foreground.min(), foreground.max()
+            values = (raw_pass - min_depth) * (255.0 / max(max_depth - min_depth, 1e-6))
+    return cv2.cvtColor(np.clip(values, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+
+def read_render_pass(p_path, p_config):
+    """
+    Read a rendered file, the raw depth maps and object indexes (EXR or numpy) are converted to the legacy
+    8 bits images. The numpy files are memory-mapped.
+    :param p_path: path of the file
+    :param p_config: configuration
+    :return: 8 bits BGR image
+    """
+    extension = os.path.splitext(p_path)[1]
+    if extension == ".npy":
+        raw_pass = np.load(p_path, mmap_mode='r')
+    elif extension == ".exr":
+        # The EXR files of the simulator have the same value in the 3 channels
+        raw_pass = cv2.imread(p_path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+        if raw_pass.ndim == 3:
+            raw_pass = raw_pass[:, :, 0]
+    else:
+        return cv2.imread(p_path)
+    return convert_raw_render_pass(raw_pass, "object_index" in os.path.basename(p_path), p_config)
+
+
+def read_render_pass_cached(p_decode_cache, p_path, p_config):
+    """
+    read_render_pass with a cache of the decoded files, the least recently used file is removed
+    when the cache has more than decode_cache_size files
+    :param p_decode_cache: OrderedDict path -> decoded image, one cache by folder
+    :param p_path: path of the file
+    :param p_config: configuration
+    :return: 8 bits BGR image, it must not be modified
+    """
+    if p_path in p_decode_cache:
+        p_decode_cache.move_to_end(p_path)
+        return p_decode_cache[p_path]
+    image = read_render_pass(p_path, p_config)
+    p_decode_cache[p_path] = image
+    if len(p_decode_cache) > p_config.get("decode_cache_size", DEFAULT_DECODE_CACHE_SIZE):
+        p_decode_cache.popitem(last=False)
+    return image
+
+
+def find_render_pass_file(p_path_image, p_name):
+    """
+    Find the file of a render pass whatever its format
+    :param p_path_image: folder of the file
+    :param p_name: name of the file without extension
+    :return: name of the file
+    """
+    for extension in RENDER_PASS_EXTENSIONS:
+        if os.path.isfile(os.path.join(p_path_image, p_name + extension)):
+            return p_name + extension
+    return p_name + RENDER_PASS_EXTENSIONS[0]
+
+
 def subdivide_image(p_path_image, p_list_files, p_config):
     hour_folder_name = p_path_image[-24:-18]
     create_folder(os.path.join(p_config["folder_pre_processing"], hour_folder_name, "images"))
@@ -74,7 +206,13 @@ def subdivide_image(p_path_image, p_list_files, p_config):
     nb_sub_divide = p_config["nb_sub_divide_image"]
     folder_path = os.path.join(p_config["folder_pre_processing"],
                                hour_folder_name)
-    template_image = cv2.imread(os.path.join(p_path_image, p_list_files[0]))
+    crops_files = [f for f in p_list_files if f.endswith(CROP_REGIONS_FILE_SUFFIX)]
+    if crops_files:
+        # The simulator has only rendered the crops
+        return folder_path, subdivide_rendered_crops(p_path_image, crops_files, folder_path, p_config)
+    # Each file is decoded once for all the crops, the crops are views of the decoded images
+    decode_cache = OrderedDict()
+    template_image = read_render_pass_cached(decode_cache, os.path.join(p_path_image, p_list_files[0]), p_config)
     height, width = template_image.shape[0], template_image.shape[1]
     array_path_image = []
     for j in range(nb_sub_divide):
@@ -85,34 +223,109 @@ def subdivide_image(p_path_image, p_list_files, p_config):
             # Make a loop on all the file
             ori_file_name = p_list_files[i]
             configuration = ori_file_name.split("_")[2]
-            image_loaded = cv2.imread(os.path.join(p_path_image, ori_file_name))
+            image_loaded = read_render_pass_cached(decode_cache, os.path.join(p_path_image, ori_file_name), p_config)
             height, width = image_loaded.shape[0], image_loaded.shape[1]
             if p_config["sub_height_image"] < height and p_config["sub_width_image"] < width:
                 sub_image = image_loaded[
                             random_start_height:random_start_height + p_config["sub_height_image"],
                             random_start_width:random_start_width + p_config["sub_width_image"]]
-                sub_folder = ''
-                object_index = False
-                if "distance_map" in ori_file_name:
-                    sub_folder = "depth"
-                    object_index = False
-                elif "object_index" in ori_file_name:
-                    sub_folder = "ground_truth"
-                    object_index = True
-                elif "_image" in ori_file_name:
-                    sub_folder = "images"
-                    object_index = False
-
+                sub_folder, object_index = get_sub_folder(ori_file_name)
                 files_names = apply_transformation_and_save(os.path.join(folder_path,
                                                                          sub_folder),
                                                             sub_image,
                                                             configuration,
-                                                            object_index)
+                                                            object_index,
+                                                            get_crop_name(p_path_image, j, ori_file_name),
+                                                            p_config.get("virtual_augmentation", False))
                 files_list.append(files_names)
         array_path_image.append(create_tuple_data(files_list))
     return folder_path, array_path_image
 
 
+def get_sub_folder(p_file_name):
+    """
+    Get the folder where the crops of a rendered file are saved
+    :param p_file_name: name of the rendered file
+    :return: (sub folder, True if the file contains object indexes)
+    """
+    if "distance_map" in p_file_name:
+        return "depth", False
+    elif "object_index" in p_file_name:
+        return "ground_truth", True
+    elif "_image" in p_file_name:
+        return "images", False
+    return '', False
+
+
+def get_crop_name(p_path_image, p_crop_index, p_file_name):
+    """
+    Name of the files of a crop, derived from the scenario, the rendered file, the crop and the pass.
+    The same crop has the same name when the pre-processing is run again.
+    "_" separates the configuration in the names of the files, it is replaced by "-".
+    :param p_path_image: step folder of the rendered file
+    :param p_crop_index: index of the crop in the step folder
+    :param p_file_name: name of the rendered file
+    :return: name of the crop
+    """
+    # The name of the step folder is a timestamp with a resolution of one second, the stem of the rendered file
+    # (step and configuration) identifies the step in the scenario
+    file_stem = os.path.splitext(p_file_name)[0]
+    for suffix in RENDER_PASS_SUFFIXES:
+        if suffix in file_stem:
+            file_stem = file_stem[:file_stem.rindex(suffix)]
+            break
+    scenario_folder = os.path.dirname(os.path.normpath(p_path_image))
+    return "-".join((os.path.basename(scenario_folder),
+                     file_stem,
+                     str(p_crop_index),
+                     get_sub_folder(p_file_name)[0])).replace("_", "-")
+
+
+def subdivide_rendered_crops(p_path_image, p_crops_files, p_folder_path, p_config):
+    """
+    Process the crops rendered by the simulator (the regions are saved by the simulator in the crops files)
+    :param p_path_image: folder of the rendered crops
+    :param p_crops_files: crops files of the folder
+    :param p_folder_path: folder where the results are saved
+    :param p_config: configuration
+    :return: same array of tuple as subdivide_image
+    """
+    array_path_image = []
+    crop_index = 0
+    decode_cache = OrderedDict()
+    for crops_file_name in p_crops_files:
+        with open(os.path.join(p_path_image, crops_file_name)) as crops_file:
+            crops_data = json.load(crops_file)
+        # The simulator renders the bounding box of the crops once when the crops overlap too much
+        source = crops_data.get("source")
+        for crop in crops_data["crops"]:
+            files_list = []
+            for suffix in RENDER_PASS_SUFFIXES:
+                if source is None:
+                    ori_file_name = find_render_pass_file(p_path_image, crop["name"] + suffix)
+                    sub_image = read_render_pass(os.path.join(p_path_image, ori_file_name), p_config)
+                else:
+                    ori_file_name = find_render_pass_file(p_path_image, source["name"] + suffix)
+                    source_image = read_render_pass_cached(decode_cache,
+                                                           os.path.join(p_path_image, ori_file_name),
+                                                           p_config)
+                    top, left = crop["top"] - source["top"], crop["left"] - source["left"]
+                    sub_image = source_image[top:top + crop["height"], left:left + crop["width"]]
+                configuration = ori_file_name.split("_")[2]
+                sub_folder, object_index = get_sub_folder(ori_file_name)
+                files_names = apply_transformation_and_save(os.path.join(p_folder_path,
+                                                                         sub_folder),
+                                                            sub_image,
+                                                            configuration,
+                                                            object_index,
+                                                            get_crop_name(p_path_image, crop_index, ori_file_name),
+                                                            p_config.get("virtual_augmentation", False))
+                files_list.append(files_names)
+            array_path_image.append(create_tuple_data(files_list))
+            crop_index += 1
+    return array_path_image
+
+
 def create_tuple_data(p_files_list):
     array_tuple = []
     for j in range(len(p_files_list[0])):
@@ -121,116 +334,50 @@ def create_tuple_data(p_files_list):
     return array_tuple
 
 
-def apply_transformation_and_save(p_path_image, p_sub_image, p_configuration, p_object_index):
+def apply_transformation(p_image, p_transformation_id):
+    """
+    Apply a transformation to an image, the flips and the rotations are exact (no interpolation).
+    In virtual augmentation mode the loader of the training applies the transformations of the files list.
+    :param p_image: image
+    :param p_transformation_id: transformation (see TRANSFORMATION_IDS)
+    :return: transformed image, the rotations of 90 and 270 degrees swap the width and the height
+    """
+    if p_transformation_id == "original":
+        return p_image
+    if p_transformation_id in FLIP_CODES:
+        return cv2.flip(p_image, FLIP_CODES[p_transformation_id])
+    if p_transformation_id in ROTATE_CODES:
+        return cv2.rotate(p_image, ROTATE_CODES[p_transformation_id])
+    raise ValueError("unknown transformation : %s" % p_transformation_id)
+
+
+def apply_transformation_and_save(p_path_image,
+                                  p_sub_image,
+                                  p_configuration,
+                                  p_object_index,
+                                  p_crop_name,
+                                  p_virtual_augmentation=False):
     """
     Apply transformation on sub image in order to generate from 1 image different configuration
     :param p_path_image: path of the image for the storage
     :param p_sub_image: sub image (width, and heigth defined on the parameters)
     :param p_configuration configuration
     :param p_object_index if the object is an object index
-    :return:
+    :param p_crop_name: name of the crop (see get_crop_name), the files are named
+    <crop name>_<transformation>_<configuration>_.png
+    :param p_virtual_augmentation: only save the original image, the transformations are listed
+    in the files list (see create_file_deep_learning_v2)
+    :return: paths of the files, in the order of TRANSFORMATION_IDS
     """
 
     if p_object_index:
         p_sub_image = cv2.Canny(p_sub_image, 0, 200)
 
     files_paths = []
-    # Original Image
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    # save the original image
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), p_sub_image)
-
-    # Flip Image
-
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    flip_vertically = cv2.flip(p_sub_image, 0)
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), flip_vertically)
-
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    flip_horizontally = cv2.flip(p_sub_image, 1)
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), flip_horizontally)
-
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    flip_both = cv2.flip(p_sub_image, -1)
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), flip_both)
-
-    # Rotation
-    rows, cols = p_sub_image.shape[0], p_sub_image.shape[1]
-
-    # rotation 90
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    transformation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), 90, 1)
-    dst = cv2.warpAffine(p_sub_image, transformation_matrix, (cols, rows))
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), dst)
-
-    # rotation 180
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    transformation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), 180, 1)
-    dst = cv2.warpAffine(p_sub_image, transformation_matrix, (cols, rows))
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), dst)
-
-    # rotation 270
-    file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-        p_configuration) + "_" + ".png"
-    transformation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), 270, 1)
-    dst = cv2.warpAffine(p_sub_image, transformation_matrix, (cols, rows))
-    exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    while exists:
-        file_name = str(random.randint(0, 10000)) + "_" + datetime.datetime.now().strftime("%H%M%S%f") + "_" + str(
-            p_configuration) + "_" + ".png"
-        exists = os.path.isfile(os.path.join(p_path_image, file_name))
-    if not exists:
-        files_paths.append(os.path.join(p_path_image, file_name))
-        cv2.imwrite(os.path.join(p_path_image, file_name), dst)
-
+    for transformation_id in TRANSFORMATION_IDS[:1] if p_virtual_augmentation else TRANSFORMATION_IDS:
+        file_path = os.path.join(p_path_image, "%s_%s_%s_.png" % (p_crop_name, transformation_id, p_configuration))
+        cv2.imwrite(file_path, apply_transformation(p_sub_image, transformation_id))
+        files_paths.append(file_path)
     return files_paths
 
 
@@ -280,9 +427,12 @@ def prepare_data_for_learning(p_folder_array, p_config):
         sub_array_validation = create_sub_array(sub_array_validation_keys, p_folder_array)
         sub_array_test = create_sub_array(sub_array_test_keys, p_folder_array)
 
-        sub_array_training = generate_contours_above_image(sub_array_training)
-        sub_array_validation = generate_contours_above_image(sub_array_validation)
-        sub_array_test = generate_contours_above_image(sub_array_test)
+        # The contours of the datasets generated before the fix of the indexing of create_contours_above_image
+        # are reproduced with contoursLegacyIndexing
+        legacy_indexing = p_config.get("contoursLegacyIndexing", False)
+        sub_array_training = generate_contours_above_image(sub_array_training, legacy_indexing)
+        sub_array_validation = generate_contours_above_image(sub_array_validation, legacy_indexing)
+        sub_array_test = generate_contours_above_image(sub_array_test, legacy_indexing)
 
         create_file_deep_learning_v2("training", sub_array_training, p_config)
         create_file_deep_learning_v2("validation", sub_array_validation, p_config)
@@ -291,12 +441,12 @@ def prepare_data_for_learning(p_folder_array, p_config):
         
 
 
-def generate_contours_above_image(p_array_files) : 
+def generate_contours_above_image(p_array_files, p_legacy_indexing=False) : 
     print("Generate contours Above function")
     result_array = []
     for i in range(len(p_array_files)):
         depth, image, ground_truth = p_array_files[i]
-        result = create_contours_above_image(depth, ground_truth)
+        result = create_contours_above_image(depth, ground_truth, p_legacy_indexing)
         if result == 0:
             result_array.append(p_array_files[i])
         if i % 1000 == 0:
@@ -305,58 +455,155 @@ def generate_contours_above_image(p_array_files) :
 
 
 def create_file_deep_learning_v2(p_name_txt_file, p_array_files, p_config):
+    """
+    Write the files list of a dataset : the number of lines, then one line by sample
+    depth;image;ground_truth;configuration. In virtual augmentation mode the files are the original crops,
+    each crop has one line by transformation with the transformation at the end of the line.
+    :param p_name_txt_file: name of the dataset
+    :param p_array_files: tuples (depth, image, ground truth) of the dataset
+    :param p_config: configuration
+    :return:
+    """
+    transformation_ids = TRANSFORMATION_IDS if p_config.get("virtual_augmentation", False) else (None,)
     with open(os.path.join(p_config["folder_pre_processing"], p_name_txt_file + '.txt'),
               'w') as file_txt:
-        file_txt.write(len(p_array_files) + "\n")
+        file_txt.write(str(len(p_array_files) * len(transformation_ids)) + "\n")
         for i in range(len(p_array_files)):
             depth, image, ground_truth = p_array_files[i]
-            file_txt.write(
-                depth.replace("\\", "\\\\") + ";" +
-                image.replace("\\", "\\\\") + ";" +
-                ground_truth.replace("\\", "\\\\") + ";" +
-                str(image).split("_")[2] + "\n")
-    file_txt.close()
-    
+            line = (depth.replace("\\", "\\\\") + ";" +
+                    image.replace("\\", "\\\\") + ";" +
+                    ground_truth.replace("\\", "\\\\") + ";" +
+                    str(image).split("_")[2])
+            for transformation_id in transformation_ids:
+                if transformation_id is None:
+                    file_txt.write(line + "\n")
+                else:
+                    file_txt.write(line + ";" + transformation_id + "\n")
+
 
+def find_depth_moves(p_depth, p_directions):
+    """
+    Find the direction where each pixel is moved : its first neighbor, in the order of the directions,
+    that has another depth
+    :param p_depth: depth image
+    :param p_directions: (row offset, column offset) of the neighbors, in the order they are tested
+    :return: one mask by direction, a pixel is in the mask of the direction where it is moved
+    """
+    height, width = p_depth.shape
+    remaining = np.ones(p_depth.shape, dtype=bool)
+    moves = []
+    for row_offset, col_offset in p_directions:
+        rows = slice(max(0, -row_offset), height - max(0, row_offset))
+        cols = slice(max(0, -col_offset), width - max(0, col_offset))
+        neighbor_rows = slice(rows.start + row_offset, rows.stop + row_offset)
+        neighbor_cols = slice(cols.start + col_offset, cols.stop + col_offset)
+        move = np.zeros_like(remaining)
+        move[rows, cols] = remaining[rows, cols] & (p_depth[neighbor_rows, neighbor_cols] != p_depth[rows, cols])
+        remaining &= ~move
+        moves.append(move)
+    return moves
+
+
+def shift_mask(p_mask, p_row_offset, p_col_offset):
+    """
+    Move a mask by an offset, the pixels moved out of the image are lost
+    :param p_mask: mask
+    :param p_row_offset: row offset
+    :param p_col_offset: column offset
+    :return: shifted mask
+    """
+    height, width = p_mask.shape
+    shifted = np.zeros_like(p_mask)
+    rows = slice(max(0, p_row_offset), height + min(0, p_row_offset))
+    cols = slice(max(0, p_col_offset), width + min(0, p_col_offset))
+    shifted[rows, cols] = p_mask[rows.start - p_row_offset:rows.stop - p_row_offset,
+                                 cols.start - p_col_offset:cols.stop - p_col_offset]
+    return shifted
 
-def create_contours_above_image(p_path_depth, p_path_ground_truth):
+
+def move_pixels_to_depth_discontinuities(p_image, p_depth, p_candidates, p_directions):
+    """
+    Vectorized form of a loop that processes the candidate pixels one by one in row-major order : a candidate
+    that is not 0 when it is processed is moved to its first neighbor with another depth (see find_depth_moves),
+    the neighbor is set to 255 and the pixel to 0.
+    A candidate that is 0 is processed if a pixel processed before it has been moved onto it, the pixels moved
+    onto a candidate are propagated until no candidate is added.
+    :param p_image: image (2D array)
+    :param p_depth: depth image with the same shape
+    :param p_candidates: mask of the pixels processed by the loop
+    :param p_directions: (row offset, column offset) of the neighbors, in the order they are tested
+    :return: new image
+    """
+    moves = find_depth_moves(p_depth, p_directions)
+    # In row-major order the neighbors below and on the right are processed after the pixel
+    later = [direction > (0, 0) for direction in p_directions]
+    active = p_candidates & (p_image > 0)
+    while True:
+        moved_from_before = np.zeros_like(active)
+        for move, (row_offset, col_offset), is_later in zip(moves, p_directions, later):
+            if is_later:
+                moved_from_before |= shift_mask(move & active, row_offset, col_offset)
+        new_active = active | (p_candidates & moved_from_before)
+        if np.array_equal(new_active, active):
+            break
+        active = new_active
+    moved_from_after = np.zeros_like(active)
+    moved = np.zeros_like(active)
+    for move, (row_offset, col_offset), is_later in zip(moves, p_directions, later):
+        moved |= move & active
+        if not is_later:
+            moved_from_after |= shift_mask(move & active, row_offset, col_offset)
+
+    result = p_image.copy()
+    result[moved_from_before] = 255
+    result[moved] = 0
+    result[moved_from_after] = 255
+    return result
+
+
+def move_contours_to_depth_discontinuities(p_ground_truth, p_depth, p_legacy_indexing=False):
+    """
+    Move each pixel of the ground truth to its first neighbor (up, down, left then right) that has
+    another depth. The pixels are moved as if they were processed one by one in row-major order :
+    a moved pixel is set to 255 and its previous position to 0, a pixel moved onto a position that is
+    processed later is erased if this position is moved too.
+    The legacy indexing reproduces the loop used before the vectorization, it indexed the images as [col, row] :
+    the pixels of the transposed ground truth were processed, in column-major order, with the neighbors tested
+    in the order left, right, up then down. It only works on square images.
+    :param p_ground_truth: ground truth image (2D array)
+    :param p_depth: depth image with the same shape
+    :param p_legacy_indexing: reproduce the [col, row] indexing of the loop
+    :return: new ground truth image
+    """
+    if not p_legacy_indexing:
+        return move_pixels_to_depth_discontinuities(p_ground_truth,
+                                                    p_depth,
+                                                    p_ground_truth > 0,
+                                                    ((-1, 0), (1, 0), (0, -1), (0, 1)))
+    if p_ground_truth.shape[0] != p_ground_truth.shape[1]:
+        raise ValueError("The legacy indexing of the contours only works on square images, not %sx%s"
+                         % p_ground_truth.shape[::-1])
+    # In the transposed images the order of the loop is row-major, the processed pixels are still the ones
+    # of the ground truth that are not 0
+    return move_pixels_to_depth_discontinuities(p_ground_truth.T,
+                                                p_depth.T,
+                                                p_ground_truth > 0,
+                                                ((0, -1), (0, 1), (-1, 0), (1, 0))).T
+
+
+def create_contours_above_image(p_path_depth, p_path_ground_truth, p_legacy_indexing=False):
     img = cv2.imread(p_path_ground_truth, 0)
     img_depth = cv2.imread(p_path_depth, 0)
-    shapes_width, shapes_heigth = img.shape[0], img.shape[1]
-    copy_edges = img.copy()
-    sub_matrix = np.argwhere(copy_edges > 0)
-	
-    if len(sub_matrix) > (shapes_width * shapes_heigth - 1000):
+    nb_pixels = np.count_nonzero(img)
+
+    if nb_pixels > (img.shape[0] * img.shape[1] - 1000):
         return -1
-    
-    if len(sub_matrix) < 25 :
+
+    if nb_pixels < 25:
         return -1
-    #print(sub_matrix)	
-    for i in range(len(sub_matrix)):
-        row, col = sub_matrix[i]
-        if 1 <= col:
-            if copy_edges[col, row] > 0 and img_depth[col - 1, row] != img_depth[col, row]:
-                copy_edges[col - 1, row] = 255
-                copy_edges[col, row] = 0
-
-        if col < shapes_width - 1 :
-            if copy_edges[col, row] > 0 and img_depth[col + 1, row] != img_depth[col, row]:
-                copy_edges[col + 1, row] = 255
-                copy_edges[col, row] = 0
-
-        if 1 <= row:
-            if copy_edges[col, row] > 0 and img_depth[col, row - 1] != img_depth[col, row]:
-                copy_edges[col, row - 1] = 255
-                copy_edges[col, row] = 0
-
-        if row < shapes_heigth - 1:
-            if copy_edges[col, row] > 0 and img_depth[col, row + 1] != img_depth[col, row]:
-                copy_edges[col, row + 1] = 255
-                copy_edges[col, row] = 0
-    cv2.imwrite(p_path_depth, copy_edges)
+    cv2.imwrite(p_path_depth, move_contours_to_depth_discontinuities(img, img_depth, p_legacy_indexing))
     return 0
 
-
 if __name__ == '__main__':
     # Load configuration JSON file that contains all the configuration for the scenarii
     with open('config.json') as f:
@@ -0,0 +1,136 @@
+import atexit
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+# Profiling is disabled until enable is called, the stages only cost a test of this flag
+g_enabled = False
+g_trace_file = None
+# stage -> [calls, wall time, cpu time], for the run and for the current iteration
+g_run_stages = {}
+g_iteration_stages = {}
+
+
+def enable(p_trace_path):
+    """
+    Enable the profiling, the stages of each iteration are written to a JSON Lines trace
+    and a summary is printed at the end of the run
+    :param p_trace_path: path of the trace
+    :return:
+    """
+    global g_enabled, g_trace_file
+    g_trace_file = open(p_trace_path, 'a')
+    g_enabled = True
+    atexit.register(close)
+
+
+def is_enabled():
+    """
+    :return: True if the profiling is enabled
+    """
+    return g_enabled
+
+
+def add_stage_time(p_stages, p_name, p_wall_time, p_cpu_time):
+    """
+    Add a call of a stage to its totals
+    :param p_stages: totals of the stages
+    :param p_name: name of the stage
+    :param p_wall_time: wall time of the call
+    :param p_cpu_time: cpu time of the call
+    :return:
+    """
+    stage_times = p_stages.setdefault(p_name, [0, 0.0, 0.0])
+    stage_times[0] += 1
+    stage_times[1] += p_wall_time
+    stage_times[2] += p_cpu_time
+
+
+@contextmanager
+def stage(p_name):
+    """
+    Measure the wall and cpu time of a stage of the pipeline.
+    The stages can be nested, the time of a stage includes the time of its inner stages.
+    :param p_name: name of the stage
+    :return:
+    """
+    if not g_enabled:
+        yield
+        return
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall_time, cpu_time = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        add_stage_time(g_run_stages, p_name, wall_time, cpu_time)
+        add_stage_time(g_iteration_stages, p_name, wall_time, cpu_time)
+
+
+def profiled(p_name):
+    """
+    Decorator that measures each call of a function as a stage
+    :param p_name: name of the stage
+    :return: decorator
+    """
+    def decorator(p_function):
+        @functools.wraps(p_function)
+        def wrapper(*args, **kwargs):
+            if not g_enabled:
+                return p_function(*args, **kwargs)
+            with stage(p_name):
+                return p_function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_iteration(p_iteration, p_wall_time, p_cpu_time, p_counts):
+    """
+    Write the stages of an iteration to the trace
+    :param p_iteration: iteration
+    :param p_wall_time: wall time of the whole iteration
+    :param p_cpu_time: cpu time of the whole iteration
+    :param p_counts: counts of the iteration (vertices, datablocks...)
+    :return:
+    """
+    global g_iteration_stages
+    if not g_enabled:
+        return
+    add_stage_time(g_run_stages, "iteration", p_wall_time, p_cpu_time)
+    stages = {name: {"calls": calls, "wall": wall_time, "cpu": cpu_time}
+              for name, (calls, wall_time, cpu_time) in g_iteration_stages.items()}
+    g_trace_file.write(json.dumps({"iteration": p_iteration,
+                                   "time": time.time(),
+                                   "wall": p_wall_time,
+                                   "cpu": p_cpu_time,
+                                   "stages": stages,
+                                   "counts": p_counts}) + "\n")
+    g_trace_file.flush()
+    g_iteration_stages = {}
+
+
+def print_summary():
+    """
+    Print the time spent in each stage during the run
+    :return:
+    """
+    if not g_run_stages:
+        return
+    print("=============================================")
+    print("%-28s %8s %12s %12s %12s" % ("Stage", "Calls", "Wall (s)", "Mean (ms)", "CPU (s)"))
+    for name, (calls, wall_time, cpu_time) in sorted(g_run_stages.items(), key=lambda item: -item[1][1]):
+        print("%-28s %8d %12.3f %12.3f %12.3f" % (name, calls, wall_time, 1000.0 * wall_time / calls, cpu_time))
+    print("=============================================")
+
+
+def close():
+    """
+    Print the summary and close the trace
+    :return:
+    """
+    global g_enabled
+    if not g_enabled:
+        return
+    print_summary()
+    g_trace_file.close()
+    g_enabled = False
@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import json
+import os
+
+SCENARIO_FILE = "scenario.jsonl"
+SCENARIO_FORMAT = "simulator-scenario"
+SCENARIO_FORMAT_VERSION = 1
+BRICK_FIELDS = ("name", "position_x", "position_y", "position_z", "rotation_needed", "configuration",
+                "index_texture")
+LEGACY_SCENARIO_FILES = ("scenario.txt", "scenario_data.txt", "config.json")
+# Keys of the configuration that are specific to a scenario, they are not part of the hash
+SCENARIO_CONFIG_KEYS = ("scenarioSeed", "boxTexture")
+
+
+def get_config_hash(p_config):
+    """
+    Hash of a configuration, independent of the order of its keys.
+    The scenarios generated by the same run have the same hash.
+    :param p_config: configuration
+    :return: sha1 of the configuration
+    """
+    config = {key: value for key, value in p_config.items() if key not in SCENARIO_CONFIG_KEYS}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def save_scenario(p_path, p_objects_params, p_generation_configuration, p_textures_choose, p_seed, p_config):
+    """
+    Save a scenario in the JSON Lines format : a header, then one line for each brick.
+    The file is written under a temporary name then renamed, an interrupted save leaves no partial scenario.
+    :param p_path: path of the file
+    :param p_objects_params: params of the bricks (see BRICK_FIELDS)
+    :param p_generation_configuration: configuration of each layer, None if it is unknown
+    :param p_textures_choose: id of the textures
+    :param p_seed: seed of the scenario
+    :param p_config: configuration of the scenario
+    :return:
+    """
+    header = {"format": SCENARIO_FORMAT,
+              "version": SCENARIO_FORMAT_VERSION,
+              "seed": p_seed,
+              "config_hash": get_config_hash(p_config),
+              "configurations": None if p_generation_configuration is None else list(p_generation_configuration),
+              "textures": list(p_textures_choose),
+              "fields": BRICK_FIELDS,
+              "nb_bricks": len(p_objects_params),
+              "config": p_config}
+    temporary_path = p_path + ".tmp"
+    with open(temporary_path, 'w') as scenario_file:
+        scenario_file.write(json.dumps(header) + "\n")
+        for item in p_objects_params:
+            scenario_file.write(json.dumps([item[0], float(item[1]), float(item[2]), float(item[3]),
+                                            bool(item[4]), int(item[5]), int(item[6])]) + "\n")
+        scenario_file.flush()
+        os.fsync(scenario_file.fileno())
+    os.replace(temporary_path, p_path)
+
+
+def read_scenario(p_path):
+    """
+    Read a scenario saved by save_scenario
+    :param p_path: path of the file
+    :return: dictionary with the seed, config_hash, configurations, textures, config and bricks
+    (list of tuples, see BRICK_FIELDS) of the scenario
+    """
+    with open(p_path) as scenario_file:
+        header = json.loads(scenario_file.readline())
+        if header.get("format") != SCENARIO_FORMAT:
+            raise ValueError("%s is not a scenario file" % p_path)
+        if header["version"] > SCENARIO_FORMAT_VERSION:
+            raise ValueError("%s has the version %s of the scenario format, the version %s is supported"
+                             % (p_path, header["version"], SCENARIO_FORMAT_VERSION))
+        bricks = [tuple(json.loads(line)) for line in scenario_file if line.strip()]
+    if len(bricks) != header["nb_bricks"]:
+        raise ValueError("%s is truncated : %s bricks instead of %s" % (p_path, len(bricks), header["nb_bricks"]))
+    scenario = {key: header[key] for key in ("version", "seed", "config_hash", "configurations", "textures",
+                                             "config")}
+    scenario["bricks"] = bricks
+    return scenario
+
+
+def read_legacy_scenario(p_folder):
+    """
+    Read a scenario saved in the text files of the first versions of the simulator
+    (scenario.txt, scenario_data.txt and config.json)
+    :param p_folder: folder of the scenario
+    :return: same dictionary as read_scenario, the configurations of the layers are not saved in this format
+    """
+    bricks = []
+    with open(os.path.join(p_folder, "config.json")) as config_file:
+        config = json.load(config_file)
+    with open(os.path.join(p_folder, "scenario.txt")) as scenario_txt_file:
+        next(scenario_txt_file)
+        for line in scenario_txt_file:
+            data = line.strip()[1:-1].split(",")
+            bricks.append((data[0],
+                           float(data[1]),
+                           float(data[2]),
+                           float(data[3]),
+                           data[4].strip().lower() in ("true", "1"),
+                           int(data[5]),
+                           int(data[6])))
+    textures = []
+    with open(os.path.join(p_folder, "scenario_data.txt")) as scenario_data_file:
+        next(scenario_data_file)
+        for line in scenario_data_file:
+            textures = list(map(int, line.strip()[2:-2].split(",")))
+    return {"version": 0,
+            "seed": config.get("scenarioSeed", 0),
+            "config_hash": get_config_hash(config),
+            "configurations": None,
+            "textures": textures,
+            "config": config,
+            "bricks": bricks}
+
+
+def is_scenario_folder(p_folder, p_files=None):
+    """
+    Check if a folder contains a scenario, in the JSON Lines format or in the legacy text files
+    :param p_folder: folder
+    :param p_files: names of the files of the folder if they are already known
+    :return: True if the folder contains a scenario
+    """
+    if p_files is None:
+        p_files = os.listdir(p_folder)
+    p_files = set(p_files)
+    return SCENARIO_FILE in p_files or all(file_name in p_files for file_name in LEGACY_SCENARIO_FILES)
+
+
+def load_scenario(p_folder):
+    """
+    Load the scenario of a folder, the legacy text files are read if the folder has no scenario.jsonl
+    :param p_folder: folder of the scenario
+    :return: see read_scenario, with the folder of the scenario
+    """
+    path = os.path.join(p_folder, SCENARIO_FILE)
+    if os.path.isfile(path):
+        scenario = read_scenario(path)
+    else:
+        scenario = read_legacy_scenario(p_folder)
+    scenario["folder"] = p_folder
+    return scenario
+
+
+def load_scenarios(p_folders):
+    """
+    Load the scenarios of several folders in one pass
+    :param p_folders: folders of the scenarios
+    :return: list of scenarios (see load_scenario)
+    """
+    return [load_scenario(folder) for folder in p_folders]
+
+
+def discover_replay_folders(p_root_folder):
+    """
+    Find all the folders that contain a scenario under a root folder
+    :param p_root_folder: root folder
+    :return: sorted list of the folders of the scenarios
+    """
+    folders = []
+    for root, dirs, files in os.walk(p_root_folder):
+        if is_scenario_folder(root, files):
+            folders.append(root)
+            # The step folders of a scenario don't contain scenarios
+            dirs[:] = []
+    return sorted(folders)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the legacy scenario files to the JSON Lines format")
+    parser.add_argument("root", help="folder that contains the scenarios")
+    arguments = parser.parse_args()
+
+    nb_converted = 0
+    for folder in discover_replay_folders(arguments.root):
+        if os.path.isfile(os.path.join(folder, SCENARIO_FILE)):
+            continue
+        legacy_scenario = read_legacy_scenario(folder)
+        save_scenario(os.path.join(folder, SCENARIO_FILE),
+                      legacy_scenario["bricks"],
+                      legacy_scenario["configurations"],
+                      legacy_scenario["textures"],
+                      legacy_scenario["seed"],
+                      legacy_scenario["config"])
+        nb_converted += 1
+    print("* Scenarios converted : ", nb_converted)
@@ -1,40 +1,122 @@
-from distutils.util import strtobool
-
 import bpy
 import datetime
 import bmesh
-import math
 from math import radians
 import random
 import os
+import shutil
+import sys
+import time
 import json
-from collections import Counter
+import argparse
+import functools
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+# Blender doesn't add the folder of the script to the module search path
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+import deformation
+import layout_planner
+import output_writer
+import profiling
+import scenario_format
+from layout_planner import generate_configuration
 
 VIRTUAL_OBJECT = "VIRTUAL_OBJECT"
 CONFIGURATION_OBJECT = "CONFIGURATION_OBJECT"
+STATIC_OBJECT = "STATIC_OBJECT"
+BRICK_SUBDIVISION_CUTS = 50
+DEFAULT_MATERIAL_POOL_SIZE = 64
+COMPOSITOR_DEPTH_NORMALIZE = "SIMULATOR_DEPTH_NORMALIZE"
+COMPOSITOR_DEPTH_OUTPUT = "SIMULATOR_DEPTH_OUTPUT"
+COMPOSITOR_INDEX_DIVIDE = "SIMULATOR_INDEX_DIVIDE"
+COMPOSITOR_INDEX_OUTPUT = "SIMULATOR_INDEX_OUTPUT"
+COMPOSITOR_LABEL_COMBINE = "SIMULATOR_LABEL_COMBINE"
+COMPOSITOR_LABEL_VIEWER = "SIMULATOR_LABEL_VIEWER"
+VIEWER_IMAGE_NAME = "Viewer Node"
+# Formats of the depth map and of the object indexes : normalized 16 bits PNG (legacy), metric float EXR
+# or numpy arrays (float32 depth and uint16 object indexes) read from the render result
+DEPTH_OUTPUT_PNG = "png"
+DEPTH_OUTPUT_EXR = "exr"
+DEPTH_OUTPUT_NPY = "npy"
+DEPTH_OUTPUT_EXTENSIONS = {DEPTH_OUTPUT_PNG: ".png", DEPTH_OUTPUT_EXR: ".exr", DEPTH_OUTPUT_NPY: ".npy"}
+# Compression of the PNG files saved by blender (percentage), with an output writer blender saves them without
+# compression and the writer compresses them while the next step is rendered
+BLENDER_PNG_COMPRESSION = 15
+CAPTURE_MODE_STEP = "step"
+CAPTURE_MODE_ANIMATION = "animation"
+ANIMATION_FRAMES_FOLDER = "frames"
+ANIMATION_FRAME_NAME = "frame"
+RENDER_METRICS_FILE = "render_metrics.jsonl"
+CROP_NAME_SUFFIX = "_crop%d"
+CROP_REGIONS_FILE_SUFFIX = "_crops.json"
+# Fixed cost of a render (synchronization of the scene, BVH build, compositing) in rendered pixels,
+# it can be measured with the render metrics of a crop and of the whole image
+DEFAULT_RENDER_OVERHEAD_PIXELS = 1280 * 720 // 4
+# Label render modes : "cycles" render the labels with the image, "fast" render the image then the labels
+# without path tracing, "labels_only" only render the labels without path tracing
+LABEL_RENDER_MODE_CYCLES = "cycles"
+LABEL_RENDER_MODE_FAST = "fast"
+LABEL_RENDER_MODE_LABELS_ONLY = "labels_only"
+LABEL_PASS_FRAME_SUFFIX = "_label_pass"
+PROGRESS_FILE = "progress.jsonl"
+# Keys of the configuration of the run that replace the ones of the scenario in replay mode
+# (a campaign can be rendered again with new render settings)
+REPLAY_OVERRIDE_KEYS = ("renderProfile", "renderProfiles", "use_gpu", "labelRenderMode", "renderCropRegions",
+                        "captureMode", "memoryBudgetMB", "depthOutputFormat", "renderOverheadPixels")
+RENDER_PROFILE_PROPERTY = "RENDER_PROFILE"
+# Render quality profiles, "final" keeps the settings used before the profiles
+RENDER_PROFILES = {
+    "draft": {"samples": 32,
+              "max_bounces": 4,
+              "lamp_max_bounces": 16,
+              "adaptive_threshold": 0.1,
+              "denoising": True},
+    "standard": {"samples": 128,
+                 "max_bounces": 8,
+                 "lamp_max_bounces": 128,
+                 "adaptive_threshold": 0.02,
+                 "denoising": True},
+    "final": {"samples": 256,
+              "max_bounces": 12,
+              "lamp_max_bounces": 1024,
+              "adaptive_threshold": 0,
+              "denoising": False},
+}
+DEFAULT_RENDER_PROFILE = "final"
+STATIC_OBJECT_NAMES = ("LEFT_BORDER", "RIGHT_BORDER", "BOTTOM_BORDER", "TOP_BORDER", "GROUND",
+                       "POTENCE", "ARM_POTENCE", "I_CORE", "I_BRANCH_1", "I_BRANCH_2",
+                       "Lamp1", "Lamp2")
 g_nb_objects = None
 g_texture_files = None
 g_texture_files_box = None
 g_debugMode = None
 g_folder_scenario = "NOT_DEFINED"
+g_material_pool = OrderedDict()
+g_material_pool_size = DEFAULT_MATERIAL_POOL_SIZE
+g_plan = None
+# Writes the outputs of the renders in the background, the outputs are written synchronously if it is None
+g_output_writer = None
+g_png_compression_level = output_writer.DEFAULT_PNG_COMPRESSION_LEVEL
+# Lease of the job run in worker mode (see job_worker_runner), None in the other modes
+g_job_lease = None
 
 
+@profiling.profiled("add_texture_to_object")
 def add_texture_to_object(p_object_name,
-                          p_index_object,
-                          p_iteration_object,
                           p_texture_path,
                           p_material_type="ShaderNodeBsdfDiffuse"):
+    """
+    Assign to the first material slot of the object the material of the texture
+    :param p_object_name: name of the object
+    :param p_texture_path: path of the texture
+    :param p_material_type: type of the BSDF node of the material
+    :return:
+    """
     if os.path.exists(os.path.realpath(p_texture_path)):
-        # ---------------------------------------------------------------
-        # adding the chosen texture
-        # ---------------------------------------------------------------
-        # Get material
         obj = bpy.data.objects.get(p_object_name)
-        material_name = p_object_name + "_" + str(p_index_object) + "_" + str(p_iteration_object) + "_material"
-        mat = bpy.data.materials.get(material_name)
-        if mat is None:
-            # create material
-            mat = bpy.data.materials.new(name=material_name)
+        mat = get_pooled_material(p_texture_path, p_material_type)
 
         # Assign it to object
         if obj.data.materials:
@@ -44,119 +126,398 @@ def add_texture_to_object(p_object_name,
             # no slots
             obj.data.materials.append(mat)
 
-        mat.use_nodes = True
-        nt = mat.node_tree
-        nodes = nt.nodes
-        links = nt.links
-
-        # clear
-        while nodes:
-            nodes.remove(nodes[0])
 
-        output = nodes.new("ShaderNodeOutputMaterial")
-        material_node = nodes.new(p_material_type)
-        links.new(output.inputs['Surface'], material_node.outputs['BSDF'])
-
-        # chargement et application de l'image de texture
-        texture = nodes.new("ShaderNodeTexImage")
-        uvmap = nodes.new("ShaderNodeUVMap")
-        im = bpy.data.images.get(os.path.basename(os.path.realpath(p_texture_path)))
-        if im is None:
-            im = bpy.data.images.load(os.path.realpath(p_texture_path))
-        texture.image = im
-        uvmap.uv_map = "UVMap"
-        links.new(material_node.inputs['Color'], texture.outputs['Color'])
-        links.new(texture.inputs['Vector'], uvmap.outputs['UV'])
+def get_pooled_material(p_texture_path, p_material_type):
+    """
+    Get the material of a texture from the material pool.
+    The material is only created if it's not in the pool, the least recently used material is evicted
+    from the pool when the pool is full (and deleted if no object use it anymore)
+    :param p_texture_path: path of the texture
+    :param p_material_type: type of the BSDF node of the material
+    :return: material
+    """
+    key = (os.path.realpath(p_texture_path), p_material_type)
+    mat = g_material_pool.get(key)
+    if mat is not None:
+        g_material_pool.move_to_end(key)
+        return mat
+
+    # The pool is made room for before the new material is added, the new material has no user yet
+    # and would be deleted by the eviction
+    while g_material_pool and len(g_material_pool) >= g_material_pool_size:
+        _, evicted_material = g_material_pool.popitem(last=False)
+        evicted_material.use_fake_user = False
+        if evicted_material.users == 0:
+            bpy.data.materials.remove(evicted_material)
+    mat = create_texture_material(p_texture_path, p_material_type)
+    # The fake user keep the material while it's in the pool, even if no object use it
+    mat.use_fake_user = True
+    g_material_pool[key] = mat
+    return mat
+
+
+def create_texture_material(p_texture_path, p_material_type):
+    """
+    Create a material that use a texture
+    :param p_texture_path: path of the texture
+    :param p_material_type: type of the BSDF node of the material
+    :return: material
+    """
+    # ---------------------------------------------------------------
+    # adding the chosen texture
+    # ---------------------------------------------------------------
+    material_name = os.path.splitext(os.path.basename(p_texture_path))[0] + "_" + p_material_type + "_material"
+    mat = bpy.data.materials.new(name=material_name)
+    mat.use_nodes = True
+    nt = mat.node_tree
+    nodes = nt.nodes
+    links = nt.links
+
+    # clear
+    while nodes:
+        nodes.remove(nodes[0])
+
+    output = nodes.new("ShaderNodeOutputMaterial")
+    material_node = nodes.new(p_material_type)
+    links.new(output.inputs['Surface'], material_node.outputs['BSDF'])
+
+    # chargement et application de l'image de texture
+    texture = nodes.new("ShaderNodeTexImage")
+    uvmap = nodes.new("ShaderNodeUVMap")
+    texture.image = load_image(p_texture_path)
+    uvmap.uv_map = "UVMap"
+    links.new(material_node.inputs['Color'], texture.outputs['Color'])
+    links.new(texture.inputs['Vector'], uvmap.outputs['UV'])
+    return mat
+
+
+def load_image(p_texture_path):
+    """
+    Get the image of a texture, the image is only loaded the first time
+    :param p_texture_path: path of the texture
+    :return: blender image
+    """
+    im = bpy.data.images.get(os.path.basename(os.path.realpath(p_texture_path)))
+    if im is None:
+        im = bpy.data.images.load(os.path.realpath(p_texture_path))
+    return im
 
 
+@profiling.profiled("add_deformations")
 def add_deformations(p_duplicated_object,
                      p_scene,
                      p_scale_min,
                      p_scale_max,
-                     p_options):
-    # active l'instance en cours
-    p_scene.objects.active = p_duplicated_object
-
-    # applique des déformations
-    if p_options[0]:  # random.uniform(0, 100) > 60:
-        displace = p_duplicated_object.modifiers.new(name='displace', type='DISPLACE')
-        displace.strength = 0.008
-        displace.mid_level = 0.005
-        displace.direction = 'RGB_TO_XYZ'
-
-        displace.strength = 0.006
-        displace.direction = 'RGB_TO_XYZ'
-        displace_texture = bpy.data.textures.new('displace_texture', type='STUCCI')
-        displace_texture.noise_type = 'HARD_NOISE'
-        displace_texture.stucci_type = 'WALL_OUT'
-        displace_texture.noise_scale = 0.08
-        displace_texture.turbulence = 180
-        displace_texture.noise_basis = 'IMPROVED_PERLIN'
-
-        displace_texture = bpy.data.textures.new('displace_texture', type='CLOUDS')
-        displace_texture.noise_type = 'HARD_NOISE'
-        displace_texture.cloud_type = 'COLOR'
-        displace_texture.noise_scale = random.uniform(0.04, 0.08)  # stick
-        displace_texture.noise_depth = random.uniform(1, 3)
-        displace_texture.noise_basis = 'VORONOI_F2'
-
-        displace.texture = displace_texture
-
-    if p_options[1]:
-        cast_cylinder = p_duplicated_object.modifiers.new(name='cast_cylinder', type='CAST')
-        cast_cylinder.cast_type = 'CYLINDER'
-        cast_cylinder.use_x = True
-        cast_cylinder.use_y = True
-        cast_cylinder.use_z = True
-        cast_cylinder.radius = 0.05
-        cast_cylinder.use_radius_as_size = True
-        cast_cylinder.factor = random.uniform(-0.05, 0.25)
-
-    if p_options[2]:
-        cast_sphere = p_duplicated_object.modifiers.new(name='cast_sphere', type='CAST')
-        cast_sphere.cast_type = 'SPHERE'
-        cast_sphere.use_x = False
-        cast_sphere.use_y = True
-        cast_sphere.use_z = False
-        cast_sphere.radius = 0.05
-        cast_sphere.use_radius_as_size = True
-        cast_sphere.factor = random.uniform(-0.1, 0.1)
-
-    if p_options[3]:
+                     p_options,
+                     p_seed):
+    """
+    Deform the mesh of a brick. The vertices are read and written in one call and deformed with numpy
+    (see deformation.deform_vertices), the same seed always gives the same deformations.
+    :param p_duplicated_object: brick
+    :param p_scene: scene
+    :param p_scale_min: minimum of the random scaling
+    :param p_scale_max: maximum of the random scaling
+    :param p_options: deformations enabled
+    :param p_seed: seed of the deformations of the brick
+    :return:
+    """
+    mesh = p_duplicated_object.data
+    coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coordinates)
+    coordinates = deformation.deform_vertices(coordinates.reshape(-1, 3).astype(np.float64),
+                                              np.random.RandomState(p_seed),
+                                              p_scale_min,
+                                              p_scale_max,
+                                              p_options)
+    mesh.vertices.foreach_set("co", coordinates.astype(np.float32).ravel())
+    mesh.update()
+
+    # The bevel changes the topology of the mesh, it stays a modifier
+    if p_options[deformation.OPTION_BEVEL]:
+        p_scene.objects.active = p_duplicated_object
         bevel = p_duplicated_object.modifiers.new('Bevel', 'BEVEL')
         bevel.segments = 10
         bevel.width = 2.5 / 10
 
-    if p_options[4]:
-        twist = p_duplicated_object.modifiers.new(name='twist', type='SIMPLE_DEFORM')
-        twist.deform_method = 'TWIST'
-        twist.angle = random.uniform(7, 10) * math.pi / 180
 
-    if p_options[5]:
-        bend = p_duplicated_object.modifiers.new(name='bend', type='SIMPLE_DEFORM')
-        bend.deform_method = 'BEND'
-        bend.angle = random.uniform(0, 30) * math.pi / 180
+def setup_compositor_nodes(p_scene):
+    """
+    Build the compositor nodes that save the depth map and the object indexes.
+    The nodes are only created the first time, they are kept in the scene for the next renders.
+    :param p_scene: scene
+    :return: compositor node tree
+    """
+    p_scene.use_nodes = True
+    nodes_tree = p_scene.node_tree
+    if COMPOSITOR_DEPTH_OUTPUT in nodes_tree.nodes and COMPOSITOR_INDEX_OUTPUT in nodes_tree.nodes:
+        return nodes_tree
+
+    render_layer = p_scene.render.layers['RenderLayer']
+    render_layer.use_pass_z = True
+    render_layer.use_pass_object_index = True
+    nodes_links = nodes_tree.links
+
+    # Retrieve default RenderLayers node ( it should exists by default)
+    render_layers_node = nodes_tree.nodes['Render Layers']
+
+    z_map_node = nodes_tree.nodes.new('CompositorNodeNormalize')
+    z_map_node.name = COMPOSITOR_DEPTH_NORMALIZE
+    nodes_links.new(render_layers_node.outputs['Depth'], z_map_node.inputs["Value"])
+
+    # create depth output node
+    depth_output_node = nodes_tree.nodes.new('CompositorNodeOutputFile')
+    depth_output_node.name = COMPOSITOR_DEPTH_OUTPUT
+    depth_output_node.location = 0, 0
+    depth_output_node.format.file_format = 'PNG'
+    depth_output_node.format.color_depth = '16'
+    depth_output_node.format.color_mode = 'BW'
+    nodes_links.new(z_map_node.outputs['Value'], depth_output_node.inputs[0])
+    # Composite node for regular rendering should already exist
+
+    # Count the number of dropped objects : those are the ones with object indices
+    print("NbObject : {}".format(g_nb_objects))
+    # Create a node to map objects indices to 16bit value
+    objectindex_mathnode = nodes_tree.nodes.new('CompositorNodeMath')
+    objectindex_mathnode.name = COMPOSITOR_INDEX_DIVIDE
+    objectindex_mathnode.operation = 'DIVIDE'
+    objectindex_mathnode.inputs[1].default_value = g_nb_objects
+    objectindex_mathnode.location = 200, -300
+    # objectindex_mathnode.size = [math.floor((2**16)/(nb_objects))/float(2**16)]
+    # Clamp values
+    nodes_links.new(render_layers_node.outputs["IndexOB"], objectindex_mathnode.inputs["Value"])
+
+    object_index_output_node = nodes_tree.nodes.new('CompositorNodeOutputFile')
+    object_index_output_node.name = COMPOSITOR_INDEX_OUTPUT
+    object_index_output_node.location = 600, -300
+    object_index_output_node.format.file_format = 'PNG'
+    object_index_output_node.format.color_depth = '16'
+    object_index_output_node.format.color_mode = 'BW'
+    nodes_links.new(objectindex_mathnode.outputs["Value"], object_index_output_node.inputs['Image'])
+    return nodes_tree
+
+
+def setup_label_viewer_nodes(p_scene):
+    """
+    Build the compositor nodes that send the depth (red) and the object indexes (green) to the viewer image,
+    its pixels are read after the render (see save_label_arrays)
+    :param p_scene: scene
+    :return: compositor node tree
+    """
+    nodes_tree = setup_compositor_nodes(p_scene)
+    if COMPOSITOR_LABEL_VIEWER in nodes_tree.nodes:
+        return nodes_tree
+    render_layers_node = nodes_tree.nodes['Render Layers']
+    combine_node = nodes_tree.nodes.new('CompositorNodeCombRGBA')
+    combine_node.name = COMPOSITOR_LABEL_COMBINE
+    combine_node.location = 200, -600
+    nodes_tree.links.new(render_layers_node.outputs['Depth'], combine_node.inputs['R'])
+    nodes_tree.links.new(render_layers_node.outputs['IndexOB'], combine_node.inputs['G'])
+    viewer_node = nodes_tree.nodes.new('CompositorNodeViewer')
+    viewer_node.name = COMPOSITOR_LABEL_VIEWER
+    viewer_node.location = 600, -600
+    viewer_node.use_alpha = False
+    nodes_tree.links.new(combine_node.outputs['Image'], viewer_node.inputs['Image'])
+    return nodes_tree
+
+
+def set_label_output_format(p_nodes_tree, p_depth_format):
+    """
+    Set the format of the files of the depth map and of the object indexes.
+    In EXR the raw depth and object indexes are saved, without the normalization and the division of the PNG.
+    :param p_nodes_tree: compositor node tree
+    :param p_depth_format: DEPTH_OUTPUT_PNG or DEPTH_OUTPUT_EXR
+    :return:
+    """
+    nodes = p_nodes_tree.nodes
+    depth_output_node = nodes[COMPOSITOR_DEPTH_OUTPUT]
+    object_index_output_node = nodes[COMPOSITOR_INDEX_OUTPUT]
+    file_format = 'OPEN_EXR' if p_depth_format == DEPTH_OUTPUT_EXR else 'PNG'
+    if depth_output_node.format.file_format == file_format:
+        return
+    for output_node in (depth_output_node, object_index_output_node):
+        output_node.format.file_format = file_format
+        output_node.format.color_depth = '32' if p_depth_format == DEPTH_OUTPUT_EXR else '16'
+        # The single channel EXR files of blender can't be read by opencv
+        output_node.format.color_mode = 'RGB' if p_depth_format == DEPTH_OUTPUT_EXR else 'BW'
+    # A new link to an input replaces the previous one
+    if p_depth_format == DEPTH_OUTPUT_EXR:
+        render_layers_node = nodes['Render Layers']
+        p_nodes_tree.links.new(render_layers_node.outputs['Depth'], depth_output_node.inputs[0])
+        p_nodes_tree.links.new(render_layers_node.outputs['IndexOB'], object_index_output_node.inputs[0])
+    else:
+        p_nodes_tree.links.new(nodes[COMPOSITOR_DEPTH_NORMALIZE].outputs['Value'], depth_output_node.inputs[0])
+        p_nodes_tree.links.new(nodes[COMPOSITOR_INDEX_DIVIDE].outputs['Value'], object_index_output_node.inputs[0])
+
+
+def save_label_arrays(p_folder_name, p_output_name, p_render_depth=True, p_render_ground_truth=True):
+    """
+    Save the depth map (float32, distance to the camera) and the object indexes (uint16) of the last render
+    in numpy files, the pixels are read from the viewer image (see setup_label_viewer_nodes).
+    The files are written by the output writer.
+    :param p_folder_name: folder where the files are saved
+    :param p_output_name: prefix of the file names
+    :param p_render_depth: save the depth map
+    :param p_render_ground_truth: save the object indexes
+    :return:
+    """
+    viewer_image = bpy.data.images[VIEWER_IMAGE_NAME]
+    width, height = viewer_image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    if hasattr(viewer_image.pixels, "foreach_get"):
+        viewer_image.pixels.foreach_get(pixels)
+    else:
+        pixels[:] = viewer_image.pixels[:]
+
+    def write_label_arrays():
+        # The rows of the blender images start from the bottom
+        image = pixels.reshape(height, width, 4)[::-1]
+        if p_render_depth:
+            np.save(os.path.join(p_folder_name, p_output_name + "_distance_map.npy"),
+                    np.ascontiguousarray(image[..., 0]))
+        if p_render_ground_truth:
+            np.save(os.path.join(p_folder_name, p_output_name + "_object_index.npy"),
+                    np.rint(image[..., 1]).astype(np.uint16))
+
+    submit_output(write_label_arrays)
+
+
+def submit_output(p_task):
+    """
+    Give a task to the output writer, the task is run immediately if there is no output writer
+    :param p_task: function without parameter, it must not use bpy
+    :return:
+    """
+    if g_output_writer is None:
+        p_task()
+    else:
+        g_output_writer.submit(p_task)
+
+
+@profiling.profiled("flush_outputs")
+def flush_outputs():
+    """
+    Wait until the output writer has written all the outputs
+    :return:
+    """
+    if g_output_writer is not None:
+        g_output_writer.flush()
 
-    if p_options[6]:
-        taper = p_duplicated_object.modifiers.new(name='taper', type='SIMPLE_DEFORM')
-        taper.deform_method = 'TAPER'
-        taper.factor = random.uniform(0.1, 0.8)
 
-    bpy.ops.object.visual_transform_apply()
+def get_blender_png_compression():
+    """
+    :return: compression of the PNG files saved by blender, none when they are compressed by the output writer
+    """
+    return BLENDER_PNG_COMPRESSION if g_output_writer is None else 0
 
-    # modifie l'échelle de manière isotropique
-    if p_options[7]:
-        p_duplicated_object.scale *= random.uniform(p_scale_min, p_scale_max)
-        bpy.ops.object.transform_apply(scale=True)
 
-    # modifie l'échelle de manière anisotropique
-    if p_options[8]:
-        p_duplicated_object.scale[0] *= random.uniform(p_scale_min, p_scale_max)
-        p_duplicated_object.scale[1] *= random.uniform(p_scale_min, p_scale_max)
-        p_duplicated_object.scale[2] *= random.uniform(p_scale_min, p_scale_max)
-        bpy.ops.object.transform_apply(scale=True)
+def write_render_outputs(p_outputs):
+    """
+    Give their final names to the files written by blender. With an output writer the PNG files are compressed
+    by this task (they are saved without compression by blender), the other files are renamed.
+    :param p_outputs: list of (name written by blender, final name), the files that have not been written are ignored
+    :return:
+    """
+    for blender_path, final_path in p_outputs:
+        if not os.path.exists(blender_path):
+            continue
+        if g_output_writer is not None and final_path.endswith(".png"):
+            output_writer.recompress_png(blender_path, final_path, g_png_compression_level)
+        else:
+            os.replace(blender_path, final_path)
+
+
+def configure_compositor_outputs(p_scene,
+                                 p_folder_name,
+                                 p_output_name,
+                                 p_render_depth=True,
+                                 p_render_ground_truth=True,
+                                 p_depth_format=DEPTH_OUTPUT_PNG):
+    """
+    Set the folder and the names of the files saved by the compositor for the next render.
+    The output nodes of the passes that are not needed are muted.
+    :param p_scene: scene
+    :param p_folder_name: folder where the files are saved
+    :param p_output_name: prefix of the file names
+    :param p_render_depth: save the depth map
+    :param p_render_ground_truth: save the object indexes
+    :param p_depth_format: format of the depth map and of the object indexes (DEPTH_OUTPUT_ constants).
+    In numpy the output nodes are muted, the arrays are saved after the render by save_label_arrays
+    :return:
+    """
+    nodes_tree = setup_compositor_nodes(p_scene)
+    if p_depth_format == DEPTH_OUTPUT_NPY:
+        setup_label_viewer_nodes(p_scene)
+        p_render_depth = False
+        p_render_ground_truth = False
+    else:
+        set_label_output_format(nodes_tree, p_depth_format)
+    nodes = nodes_tree.nodes
+    png_compression = get_blender_png_compression()
+    p_scene.render.image_settings.compression = png_compression
+    for node_name in (COMPOSITOR_DEPTH_OUTPUT, COMPOSITOR_INDEX_OUTPUT):
+        nodes[node_name].format.compression = png_compression
+    if COMPOSITOR_LABEL_VIEWER in nodes:
+        nodes[COMPOSITOR_LABEL_VIEWER].mute = p_depth_format != DEPTH_OUTPUT_NPY
+
+    depth_output_node = nodes[COMPOSITOR_DEPTH_OUTPUT]
+    depth_output_node.mute = not p_render_depth
+    depth_output_node.base_path = p_folder_name
+    depth_output_node.file_slots[0].path = p_output_name + "_distance_map"
+
+    object_index_output_node = nodes[COMPOSITOR_INDEX_OUTPUT]
+    object_index_output_node.mute = not p_render_ground_truth
+    object_index_output_node.base_path = p_folder_name
+    object_index_output_node.file_slots[0].path = p_output_name + "_object_index"
+    objectindex_mathnode = nodes[COMPOSITOR_INDEX_DIVIDE]
+    if objectindex_mathnode.inputs[1].default_value != g_nb_objects:
+        objectindex_mathnode.inputs[1].default_value = g_nb_objects
+
+
+def set_render_device(p_scene, p_use_gpu):
+    """
+    Choose the device and the tile size used by cycles
+    :param p_scene: scene
+    :param p_use_gpu: render on the GPU
+    :return:
+    """
+    if p_use_gpu:
+        p_scene.render.tile_x = 256
+        p_scene.render.tile_y = 256
+        p_scene.cycles.device = 'GPU'
+    else:
+        p_scene.render.tile_x = 64
+        p_scene.render.tile_y = 64
+        p_scene.cycles.device = 'CPU'
+
+
+def render_label_passes(p_scene, p_animation=False):
+    """
+    Render the depth map and the object indexes without path tracing : one sample, no bounce and
+    no denoising. Those passes only depend on the first hit of the camera rays.
+    The combined pass of a still render is not saved.
+    :param p_scene: scene
+    :param p_animation: render all the frames of the scene
+    :return:
+    """
+    render_layer = p_scene.render.layers['RenderLayer']
+    initial_samples = p_scene.cycles.samples
+    initial_max_bounces = p_scene.cycles.max_bounces
+    initial_denoising = getattr(render_layer.cycles, "use_denoising", None)
+    p_scene.cycles.samples = 1
+    p_scene.cycles.max_bounces = 0
+    if initial_denoising is not None:
+        render_layer.cycles.use_denoising = False
+    if p_animation:
+        bpy.ops.render.render(animation=True, scene=p_scene.name)
+    else:
+        bpy.ops.render.render(animation=False, write_still=False, scene=p_scene.name)
+    p_scene.cycles.samples = initial_samples
+    p_scene.cycles.max_bounces = initial_max_bounces
+    if initial_denoising is not None:
+        render_layer.cycles.use_denoising = initial_denoising
 
 
+@profiling.profiled("render_camera")
 def render_camera(p_context,
                   p_camera,
                   p_folder_name,
@@ -164,7 +525,10 @@ def render_camera(p_context,
                   p_render_rgb=True,
                   p_render_depth=True,
                   p_render_ground_truth=True,
-                  p_use_gpu=False):
+                  p_use_gpu=False,
+                  p_metrics_path=None,
+                  p_label_render_mode=LABEL_RENDER_MODE_CYCLES,
+                  p_depth_format=DEPTH_OUTPUT_PNG):
     a_scene = p_context.scene
 
     # Save initial render filepath to restore it at the end
@@ -174,100 +538,54 @@ def render_camera(p_context,
     if not p_render_rgb:
         render_layer.use_pass_combined = False
 
-        # Add composing nodes to render additional passes (depth and object_indexes)
-    if p_render_depth:
-        render_layer.use_pass_z = True
-
-        # Set composing nodes to render the different interesting passes
-        a_scene.use_nodes = True
-        nodes_tree = a_scene.node_tree
-        nodes_links = nodes_tree.links
-
-        # Retrieve default RenderLayers node ( it should exists by default)
-        render_layers_node = nodes_tree.nodes['Render Layers']
-        
-        z_map_node = nodes_tree.nodes.new('CompositorNodeNormalize')
-        nodes_links.new(render_layers_node.outputs['Depth'], z_map_node.inputs["Value"] )
-
-        # create depth output node
-        depth_output_node = nodes_tree.nodes.new('CompositorNodeOutputFile')
-        depth_output_node.location = 0, 0
-        depth_output_node.base_path = p_folder_name
-        depth_output_node.file_slots[0].path = p_output_name + "_distance_map"
-        depth_output_node.format.file_format = 'PNG'
-        depth_output_node.format.color_depth = '16'
-        depth_output_node.format.color_mode = 'BW'
-        nodes_links.new(z_map_node.outputs['Value'], depth_output_node.inputs[0])
-        # Composite node for regular rendering should already exist
-        
-    if p_render_ground_truth:
-        render_layer.use_pass_object_index = True
-
-        # Set composing nodes to render the different interesting passes
-        a_scene.use_nodes = True
-        nodes_tree = a_scene.node_tree
-        nodes_links = nodes_tree.links
-
-        # Retrieve default RenderLayers node ( it should exists by default)
-        render_layers_node = nodes_tree.nodes['Render Layers']
-
-        # Count the number of dropped objects : those are the ones with object indices
-        
-        nb_objects = g_nb_objects
-        # Create a node to map objects indices to 16bit value
-        objectindex_mathnode = nodes_tree.nodes.new('CompositorNodeMath')
-        objectindex_mathnode.operation = 'DIVIDE'
-        print("NbObject : {}".format(g_nb_objects))
-        objectindex_mathnode.inputs[1].default_value = nb_objects
-        objectindex_mathnode.location = 200, -300
-        # objectindex_mathnode.size = [math.floor((2**16)/(nb_objects))/float(2**16)]
-        # Clamp values
-        nodes_links.new(render_layers_node.outputs["IndexOB"], objectindex_mathnode.inputs["Value"])
-
-        object_index_output_node = nodes_tree.nodes.new('CompositorNodeOutputFile')
-        object_index_output_node.location = 600, -300
-        object_index_output_node.base_path = p_folder_name
-        object_index_output_node.file_slots[0].path = p_output_name + "_object_index"
-        object_index_output_node.format.file_format = 'PNG'
-        object_index_output_node.format.color_depth = '16'
-        object_index_output_node.format.color_mode = 'BW'
-        nodes_links.new(objectindex_mathnode.outputs["Value"], object_index_output_node.inputs['Image'])
     # Render
     a_scene.camera = p_camera
     a_scene.render.image_settings.file_format = 'PNG'
     a_scene.render.filepath = p_folder_name + '/' + p_output_name + "_image"
-    if p_use_gpu:
-        a_scene.render.tile_x = 256
-        a_scene.render.tile_y = 256
-        a_scene.cycles.device = 'GPU'
+    set_render_device(a_scene, p_use_gpu)
+    start_time = time.perf_counter()
+    if p_label_render_mode == LABEL_RENDER_MODE_CYCLES:
+        # The compositor nodes render the additional passes (depth and object_indexes)
+        configure_compositor_outputs(a_scene,
+                                     p_folder_name,
+                                     p_output_name,
+                                     p_render_depth,
+                                     p_render_ground_truth,
+                                     p_depth_format)
+        bpy.ops.render.render(animation=False, write_still=True, scene=a_scene.name)
     else:
-        a_scene.render.tile_x = 64
-        a_scene.render.tile_y = 64
-        a_scene.cycles.device = 'CPU'
-    bpy.ops.render.render(animation=False, write_still=True, scene=a_scene.name)
-
-    # Rename renders to their definitive name (Blender automatically appends the frame number in case of an animation)
-    def rename_blender_output(n):
-        wrong_names = [f for f in os.listdir(p_folder_name) if f.startswith(n)]
-        if len(wrong_names) == 1:
-            os.rename(p_folder_name + '/' + wrong_names[0], p_folder_name + '/' + n + '.png')
-
-    rename_blender_output(p_output_name + '_image')
-    rename_blender_output(p_output_name + '_distance_map')
-    rename_blender_output(p_output_name + '_object_index')
+        if p_label_render_mode == LABEL_RENDER_MODE_FAST:
+            configure_compositor_outputs(a_scene, p_folder_name, p_output_name, False, False, p_depth_format)
+            bpy.ops.render.render(animation=False, write_still=True, scene=a_scene.name)
+        configure_compositor_outputs(a_scene,
+                                     p_folder_name,
+                                     p_output_name,
+                                     p_render_depth,
+                                     p_render_ground_truth,
+                                     p_depth_format)
+        render_label_passes(a_scene)
+    if p_depth_format == DEPTH_OUTPUT_NPY:
+        save_label_arrays(p_folder_name, p_output_name, p_render_depth, p_render_ground_truth)
+    log_render_metrics(p_metrics_path, a_scene, p_output_name, time.perf_counter() - start_time)
+
+    # Blender appends the frame number to the names of the files, they are written with their definitive name
+    # by the output writer while the next step is rendered
+    outputs = []
+    for suffix, extension in (("_image", ".png"),
+                              ("_distance_map", DEPTH_OUTPUT_EXTENSIONS[p_depth_format]),
+                              ("_object_index", DEPTH_OUTPUT_EXTENSIONS[p_depth_format])):
+        if extension == DEPTH_OUTPUT_EXTENSIONS[DEPTH_OUTPUT_NPY]:
+            # The numpy files are written with their definitive name
+            continue
+        final_path = p_folder_name + '/' + p_output_name + suffix
+        outputs.append(("%s%04d%s" % (final_path, a_scene.frame_current, extension), final_path + extension))
+    submit_output(functools.partial(write_render_outputs, outputs))
 
     # Restore render filepath
     a_scene.render.filepath = initial_render_filepath
 
     if not p_render_rgb:
         render_layer.use_pass_combined = True
-    # Remove added nodes and links
-    if p_render_depth:
-        nodes_tree.nodes.remove(z_map_node)
-        nodes_tree.nodes.remove(depth_output_node)
-    if p_render_ground_truth:
-        nodes_tree.nodes.remove(objectindex_mathnode)
-        nodes_tree.nodes.remove(object_index_output_node)
 
 
 def generate_folder_scenario(p_iteration):
@@ -279,491 +597,6 @@ def generate_folder_scenario(p_iteration):
     return "output_" + str(p_iteration) + "_" + datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
 
 
-def generate_configuration(p_configuration: int,
-                           p_layer: int,
-                           p_config,
-                           p_objects_params):
-    """
-    Generate a configuration (placement of object) for the current configuration choose
-    :param p_configuration: configuration choose
-    :param p_layer: layer_level
-    :param p_config:  configuration
-    :param p_objects_params : array that contains object configuration
-    :return:
-    """
-    width = p_config["width"]
-    height = p_config["height"]
-    weight = p_config["weight"]
-    layer_name = p_config["pattern_layer"]
-    separator = p_config["separator"]
-    max_use_texture = p_config["max_texture_use"] - 1
-    if p_configuration == 0:
-        # The configuration 0 is composed by 4 vertical box, and 2 horizontal
-        for index_in_range in range(4):
-            # Cube 1
-            cube_x = -  width
-            cube_y = - 3 * width + index_in_range * (2 * width + separator)
-            # cube_y = index_in_range * (2 * width + separator)
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append((layer_name % (p_layer, index_in_range),
-                                     cube_x,
-                                     cube_y,
-                                     cube_z,
-                                     False,
-                                     p_configuration,
-                                     random.randint(0, max_use_texture)))
-
-        nb_object_created = 4
-        for index_in_range in range(2):
-            cube_x = height + separator
-            cube_y = - 3 * width + index_in_range * (2 * height + separator) + width + separator
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append((layer_name % (p_layer, index_in_range + nb_object_created),
-                                     cube_x,
-                                     cube_y,
-                                     cube_z,
-                                     True,
-                                     p_configuration,
-                                     random.randint(0, max_use_texture)))
-    elif p_configuration == 1:
-        for index_in_range in range(2):
-            cube_x = - 2 * width
-            cube_y = - 1 * height + index_in_range * (2 * height + separator) + separator
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append((layer_name % (p_layer, index_in_range),
-                                     cube_x,
-                                     cube_y,
-                                     cube_z,
-                                     True,
-                                     p_configuration,
-                                     random.randint(0, max_use_texture)))
-        nb_object_created = 2
-        for index_in_range in range(4):
-            cube_x = (3 * width + separator) - 2 * width
-            cube_y = - 1.5 * height + index_in_range * (2 * width + separator)
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append((layer_name % (p_layer, index_in_range + nb_object_created),
-                                     cube_x,
-                                     cube_y,
-                                     cube_z,
-                                     False,
-                                     p_configuration,
-                                     random.randint(0, max_use_texture)))
-    elif p_configuration == 2:
-        nb_object_created = 0
-        cube_x = -2 * width
-        cube_y = width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append((layer_name % (p_layer, nb_object_created),
-                                 cube_x,
-                                 cube_y,
-                                 cube_z,
-                                 True,
-                                 p_configuration,
-                                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 1
-        for index_in_range in range(2):
-            cube_x = (3 * width + separator) - 2 * width
-            cube_y = index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append((layer_name % (p_layer, index_in_range + nb_object_created),
-                                     cube_x,
-                                     cube_y,
-                                     cube_z,
-                                     False,
-                                     p_configuration,
-                                     random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-        for index_in_range in range(2):
-            cube_x = - 1 * width
-            cube_y = (2 * height + 2 * separator) + index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 5
-
-        cube_x = (2 * width + separator) + height - 2 * width
-        cube_y = (2 * height + separator) + width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-    elif p_configuration == 3:
-        nb_object_created = 0
-        for index_in_range in range(2):
-            cube_x = - width
-            cube_y = index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-        nb_object_created = 2
-
-        cube_x = (2 * width + separator) + height - 2 * width
-        cube_y = width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-
-        cube_x = -2 * width
-        cube_y = (2 * height + separator) + width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-        nb_object_created = 4
-        for index_in_range in range(2):
-            cube_x = (3 * width + separator) - 2 * width
-            cube_y = (2 * height + 2 * separator) + index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-    elif p_configuration == 4:
-        nb_object_created = 0
-        for index_in_range in range(3):
-            cube_x = index_in_range * (2 * width + separator) - 2 * width
-            cube_y = width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-        nb_object_created = 3
-
-        for index_in_range in range(3):
-            cube_x = index_in_range * (2 * width + separator) - 2 * width
-            cube_y = (2 * height + separator) + width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-    elif p_configuration == 5:
-        nb_object_created = 0
-
-        cube_x = - width
-        cube_y = 0 - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             False,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 1
-        for index_in_range in range(2):
-            cube_x = index_in_range * (2 * width + 0.5 * separator) - 2 * width
-            cube_y = (3 * width) + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-
-        cube_x = width - 2 * width
-        cube_y = (2 * width) + (2 * height) + (2 * separator) - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             False,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 4
-        for index_in_range in range(2):
-            cube_x = (height + 2 * width + separator) - 2 * width
-            cube_y = index_in_range * (2 * height + separator) + width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-    elif p_configuration == 6:
-        nb_object_created = 0
-        for index_in_range in range(2):
-            cube_x = - 2 * width
-            cube_y = index_in_range * (2 * height + separator) + width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 2
-
-        cube_x = width
-        cube_y = 0 - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             False,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-        for index_in_range in range(2):
-            cube_x = 2 * width + index_in_range * (2 * width + 0.5 * separator) - 2 * width
-            cube_y = (3 * width) + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 5
-        cube_x = 3 * width - 2 * width
-        cube_y = 2 * width + 2 * height + 2 * separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             False,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-    elif p_configuration == 7:
-        nb_object_created = 0
-        for index_in_range in range(3):
-            cube_x = index_in_range * (2 * width + separator) - 2 * width
-            cube_y = width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-        for index_in_range in range(2):
-            cube_x = width - 2 * width
-            cube_y = (2 * height + 2 * separator) + index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 5
-        cube_x = (2 * width + separator) + height - 2 * width
-        cube_y = (2 * height + separator) + width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-    elif p_configuration == 8:
-        nb_object_created = 0
-        for index_in_range in range(3):
-            cube_x = index_in_range * (2 * width + separator) - 2 * width
-            cube_y = width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, nb_object_created + index_in_range),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-
-        cube_x = -  2 * width
-        cube_y = (2 * height + separator) + width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 4
-        for index_in_range in range(2):
-            cube_x = (3 * width + separator) - 2 * width
-            cube_y = (2 * height + 2 * separator) + index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-    elif p_configuration == 9:
-        nb_object_created = 0
-        cube_x = 0 - 2 * width
-        cube_y = width + separator - 1.5 * height
-        cube_z = 2 * weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 1
-        for index_in_range in range(2):
-            cube_x = 3 * width + separator - 2 * width
-            cube_y = index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-        for index_in_range in range(3):
-            cube_x = index_in_range * (2 * width + separator) - 2 * width
-            cube_y = (2 * height + separator) + width + separator - 1.5 * height
-            cube_z = 2 * weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-    elif p_configuration == 10:
-        nb_object_created = 0
-        for index_in_range in range(2):
-            cube_x = width - 2 * width
-            cube_y = index_in_range * (2 * width + separator) - 1.5 * height
-            cube_z = 2 + weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 False,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-        nb_object_created = 2
-
-        cube_x = 2 * width + separator + height - 2 * width
-        cube_y = width + separator - 1.5 * height
-        cube_z = 2 + weight + p_layer * (2 * weight + separator)
-        p_objects_params.append(
-            (layer_name % (p_layer, nb_object_created),
-             cube_x,
-             cube_y,
-             cube_z,
-             True,
-             p_configuration,
-             random.randint(0, max_use_texture)))
-
-        nb_object_created = 3
-        for index_in_range in range(3):
-            cube_x = index_in_range * (2 * width + separator) - 2 * width
-            cube_y = (2 * height + separator) + width + separator - 1.5 * height
-            cube_z = 2 + weight + p_layer * (2 * weight + separator)
-            p_objects_params.append(
-                (layer_name % (p_layer, index_in_range + nb_object_created),
-                 cube_x,
-                 cube_y,
-                 cube_z,
-                 True,
-                 p_configuration,
-                 random.randint(0, max_use_texture)))
-
-    return p_objects_params
-
-
 def generate_texture_array(p_config):
     """
     Generate a list of texture
@@ -776,12 +609,53 @@ def generate_texture_array(p_config):
     return texture_choose
 
 
+def get_brick_prototype_mesh(p_config):
+    """
+    Get the prototype mesh of the bricks for the dimensions of the configuration.
+    The prototype is a cube at the size of the brick, UV unwrapped like bpy.ops.uv.reset and subdivided
+    if the deformations are enabled. It is only built the first time and kept in bpy.data with a fake user.
+    :param p_config: configuration
+    :return: prototype mesh
+    """
+    cuts = BRICK_SUBDIVISION_CUTS if p_config["deformation"] else 0
+    name = "BRICK_PROTOTYPE_%s_%s_%s_%s" % (p_config["height"], p_config["width"], p_config["weight"], cuts)
+    mesh = bpy.data.meshes.get(name)
+    if mesh is not None:
+        return mesh
+
+    bm = bmesh.new()
+    bmesh.ops.create_cube(bm, size=2.0)
+    # Each face use the whole texture (same as bpy.ops.uv.reset)
+    uv_layer = bm.loops.layers.uv.new("UVMap")
+    if hasattr(bm.faces.layers, "tex"):
+        bm.faces.layers.tex.verify()
+    for face in bm.faces:
+        for loop, uv in zip(face.loops, ((0, 0), (1, 0), (1, 1), (0, 1))):
+            loop[uv_layer].uv = uv
+    if cuts > 0:
+        bmesh.ops.subdivide_edges(bm,
+                                  seed=42,
+                                  edges=bm.edges,
+                                  use_grid_fill=True,
+                                  cuts=cuts)
+    bmesh.ops.scale(bm,
+                    vec=(p_config["height"], p_config["width"], p_config["weight"]),
+                    verts=bm.verts)
+    mesh = bpy.data.meshes.new(name)
+    bm.to_mesh(mesh)
+    bm.free()
+    mesh.use_fake_user = True
+    return mesh
+
+
+@profiling.profiled("generate_object")
 def generate_object(p_data,
                     p_scene,
                     p_config,
                     p_index_object,
                     p_iteration,
-                    p_textures_choose):
+                    p_textures_choose,
+                    p_scenario_seed=0):
     """
     Function that will create a object in the scene.
     :param p_data: Data need to create the object (name, x, y, z, rotation_need, configuration)
@@ -790,47 +664,35 @@ def generate_object(p_data,
     :param p_index_object index of the object
     :param p_iteration iteration
     :param p_textures_choose: array of texture
+    :param p_scenario_seed: seed of the scenario, used for the deformations of the object
     :return:
     """
-    bpy.ops.mesh.primitive_cube_add(radius=1, location=[0, 0, 0])
-    new_obj = bpy.context.object
-    new_obj.select = True
-    new_obj.name = p_data[0]
-    new_obj.scale = p_config["height"], p_config["width"], p_config["weight"]
+    mesh = get_brick_prototype_mesh(p_config).copy()
+    mesh.name = p_data[0]
+    mesh.use_fake_user = False
+    new_obj = bpy.data.objects.new(p_data[0], mesh)
+    p_scene.objects.link(new_obj)
     new_obj.location = [p_data[1], p_data[2], p_data[3]]
+    new_obj.select = True
     p_scene.objects.active = new_obj
     new_obj[("%s" % VIRTUAL_OBJECT)] = VIRTUAL_OBJECT
     new_obj[("%s" % CONFIGURATION_OBJECT)] = p_data[5]
-    bpy.context.scene.objects.active.pass_index = p_index_object
+    new_obj.pass_index = p_index_object
     if p_data[4]:
         new_obj.rotation_euler.rotate_axis("Z", radians(90))
     # bpy.ops.rigidbody.object_add(type="ACTIVE")
     # bpy.context.object.rigid_body.collision_shape = 'CONVEX_HULL'
-    bpy.ops.object.mode_set(mode='EDIT')
     make_rotation_through_x = random.randint(0, 1) == 0 if False else True
     if make_rotation_through_x:
         new_obj.rotation_euler.rotate_axis("X", radians(180))
 
     texture_index = p_textures_choose[p_data[6]]
     add_texture_to_object(p_data[0],
-                          str(p_index_object),
-                          str(p_iteration),
                           root_path_texture
                           + "\\"
                           + g_texture_files[texture_index])
 
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.uv.reset()
-    bpy.ops.object.mode_set(mode='OBJECT')
     if p_config["deformation"]:
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(new_obj.data)
-        bmesh.ops.subdivide_edges(bm,
-                                  seed=42,
-                                  edges=bm.edges,
-                                  use_grid_fill=True,
-                                  cuts=50)
-
         if g_debugMode is False:
             random_isotropic_scaling = random.randint(0, 1)
             random_anisotropic_scaling = random.randint(0, 1)
@@ -848,13 +710,13 @@ def generate_object(p_data,
                    (random_isotropic_scaling == 0) if False else True,
                    (random_anisotropic_scaling == 0) if False else True)
 
-        bpy.ops.object.mode_set(mode='OBJECT')
-
         add_deformations(new_obj,
                          p_scene,
                          0.99,
                          1.11,
-                         options)
+                         options,
+                         deformation.get_brick_seed(p_scenario_seed, p_data[0]))
+    new_obj.select = False
 
     return p_textures_choose
 
@@ -895,15 +757,197 @@ def un_select_all_object(p_scene):
         o.select = False
 
 
-def generate_image_folder(p_path):
-    intermediate_folder = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    full_path = os.path.join(p_path, intermediate_folder)
-    if not os.path.exists(full_path):
-        os.mkdir(full_path)
+def generate_image_folder(p_path, p_date=None):
+    """
+    Create the folder of a step, named after its date in the format read by the pre-processing.
+    A folder is never shared by two steps : when a step is captured in the same second as the previous one,
+    its date is moved to the next free second, so the names stay sorted in the order of the steps.
+    :param p_path: folder of the scenario
+    :param p_date: date of the step, now by default
+    :return: path of the folder of the step
+    """
+    if p_date is None:
+        p_date = datetime.datetime.now()
+    full_path = os.path.join(p_path, p_date.strftime("%Y-%m-%d-%H%M%S"))
+    while os.path.exists(full_path):
+        p_date += datetime.timedelta(seconds=1)
+        full_path = os.path.join(p_path, p_date.strftime("%Y-%m-%d-%H%M%S"))
+    os.mkdir(full_path)
     return full_path
 
 
-def picture_capture(p_camera, p_path, p_nb_level, p_folder_scenario, p_config, p_scene):
+def compute_removal_sequence(p_nb_level, p_config, p_rng=random):
+    """
+    Choose the order in which the bricks are removed, level by level from the top of the tower
+    :param p_nb_level: number of level
+    :param p_config: configuration
+    :param p_rng: random generator (seeded with the seed of the scenario so that a resumed scenario
+    removes the bricks in the same order)
+    :return: list of (step, name of the brick removed after the capture of this step)
+    """
+    step_count = p_nb_level * p_config["nbCubeByLevel"] + 1
+    counter_level = p_nb_level - 1
+    print(counter_level)
+    brick_random_to_remove = list(range(6))
+    p_rng.shuffle(brick_random_to_remove)
+    sequence = []
+    for step in range(1, step_count + 1):
+        if counter_level >= 0:
+            sequence.append((step, p_config["pattern_layer"] % (counter_level, brick_random_to_remove[step % 6])))
+        if step % 6 == 0:
+            counter_level -= 1
+            # the camera will "follow" the removing of the brick
+            p_rng.shuffle(brick_random_to_remove)
+    return sequence
+
+
+def choose_crop_regions(p_config, p_scene):
+    """
+    Choose the regions of the image that will be used by the pre processing
+    (same random windows as pre_processing.subdivide_image)
+    :param p_config: configuration
+    :param p_scene: scene
+    :return: list of regions (dictionary with top, left, height and width in pixels)
+    """
+    height, width = p_scene.render.resolution_y, p_scene.render.resolution_x
+    regions = []
+    for _ in range(p_config["nb_sub_divide_image"]):
+        regions.append({"top": random.randrange(0, height - p_config["sub_height_image"]),
+                        "left": random.randrange(0, width - p_config["sub_width_image"]),
+                        "height": p_config["sub_height_image"],
+                        "width": p_config["sub_width_image"]})
+    return regions
+
+
+def merge_crop_regions(p_regions, p_render_overhead=DEFAULT_RENDER_OVERHEAD_PIXELS):
+    """
+    Each region is a separate render, with its own synchronization of the scene and its own compositing.
+    When the regions with the fixed cost of their renders cost more than their bounding box with one fixed cost,
+    the bounding box is rendered once and the regions are cut from it by the pre processing.
+    :param p_regions: regions (see choose_crop_regions)
+    :param p_render_overhead: fixed cost of a render in rendered pixels (see DEFAULT_RENDER_OVERHEAD_PIXELS)
+    :return: bounding box of the regions, None if rendering the regions separately is cheaper
+    """
+    top = min(region["top"] for region in p_regions)
+    left = min(region["left"] for region in p_regions)
+    bounding_region = {"top": top,
+                       "left": left,
+                       "height": max(region["top"] + region["height"] for region in p_regions) - top,
+                       "width": max(region["left"] + region["width"] for region in p_regions) - left}
+    separate_cost = sum(p_render_overhead + region["height"] * region["width"] for region in p_regions)
+    if separate_cost < p_render_overhead + bounding_region["height"] * bounding_region["width"]:
+        return None
+    return bounding_region
+
+
+def set_render_border(p_scene, p_region):
+    """
+    Restrict the render to a region of the image, the saved images have the size of the region
+    :param p_scene: scene
+    :param p_region: region (see choose_crop_regions), None to render the whole image
+    :return:
+    """
+    if p_region is None:
+        p_scene.render.use_border = False
+        p_scene.render.use_crop_to_border = False
+        return
+    height, width = p_scene.render.resolution_y, p_scene.render.resolution_x
+    # The border is normalized and starts from the bottom of the image.
+    # A quarter of pixel is added so that blender find the same pixel whether it rounds or truncates
+    p_scene.render.border_min_x = (p_region["left"] + 0.25) / width
+    p_scene.render.border_max_x = (p_region["left"] + p_region["width"] + 0.25) / width
+    p_scene.render.border_min_y = (height - p_region["top"] - p_region["height"] + 0.25) / height
+    p_scene.render.border_max_y = (height - p_region["top"] + 0.25) / height
+    p_scene.render.use_border = True
+    p_scene.render.use_crop_to_border = True
+
+
+def save_crop_regions(p_folder_name, p_output_name, p_regions, p_source_region=None):
+    """
+    Save next to the images the regions that have been rendered
+    :param p_folder_name: folder of the images
+    :param p_output_name: prefix of the file names
+    :param p_regions: regions rendered
+    :param p_source_region: bounding box of the regions (see merge_crop_regions) if it has been rendered
+    instead of the regions, its images are named with the prefix
+    :return:
+    """
+    crops = []
+    for index_region, region in enumerate(p_regions):
+        crop = dict(region)
+        crop["name"] = p_output_name + CROP_NAME_SUFFIX % index_region
+        crops.append(crop)
+    crops_data = {"crops": crops}
+    if p_source_region is not None:
+        crops_data["source"] = dict(p_source_region, name=p_output_name)
+    with open(os.path.join(p_folder_name, p_output_name + CROP_REGIONS_FILE_SUFFIX), 'w') as crops_file:
+        json.dump(crops_data, crops_file)
+
+
+def read_progress(p_scenario_path):
+    """
+    Read the progress journal of a scenario
+    :param p_scenario_path: folder of the scenario
+    :return: dictionary step -> name of the folder of the step, for the steps completely rendered
+    """
+    completed_steps = {}
+    journal_path = os.path.join(p_scenario_path, PROGRESS_FILE)
+    if not os.path.isfile(journal_path):
+        return completed_steps
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line truncated by a crash, the step will be rendered again
+                continue
+            completed_steps[entry["step"]] = entry["folder"]
+    return completed_steps
+
+
+def append_progress(p_scenario_path, p_step, p_full_path):
+    """
+    Record in the progress journal of a scenario that a step is completely rendered
+    :param p_scenario_path: folder of the scenario
+    :param p_step: step rendered
+    :param p_full_path: folder of the images of the step
+    :return:
+    """
+    with open(os.path.join(p_scenario_path, PROGRESS_FILE), 'a') as journal_file:
+        journal_file.write(json.dumps({"step": p_step, "folder": os.path.basename(p_full_path)}) + "\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def remove_unjournaled_steps(p_scenario_path, p_completed_steps):
+    """
+    Delete the folders of the steps that were being rendered when the simulator stopped
+    :param p_scenario_path: folder of the scenario
+    :param p_completed_steps: completed steps (see read_progress)
+    :return:
+    """
+    completed_folders = set(p_completed_steps.values())
+    for folder in os.listdir(p_scenario_path):
+        path = os.path.join(p_scenario_path, folder)
+        if os.path.isdir(path) and folder not in completed_folders:
+            print("* Remove incomplete step : ", path)
+            shutil.rmtree(path)
+
+
+@profiling.profiled("picture_capture")
+def check_job_lease():
+    """
+    Stop the job of a worker whose lease has expired : the job has been given to another worker,
+    the two workers would render in the same folder
+    :return:
+    """
+    if g_job_lease is not None and g_job_lease["expired"]:
+        import job_server
+        raise job_server.LeaseExpiredError("The lease %s has expired" % g_job_lease["id"])
+
+
+def picture_capture(p_camera, p_path, p_nb_level, p_folder_scenario, p_config, p_scene,
+                    p_scenario_seed=0, p_completed_steps=None):
     """
     This method will allow to capture the view from the camera
     :param p_scene: scene
@@ -912,32 +956,194 @@ def picture_capture(p_camera, p_path, p_nb_level, p_folder_scenario, p_config, p
     :param p_nb_level: number of level
     :param p_folder_scenario path for storing data
     :param p_config : configuration
+    :param p_scenario_seed: seed of the scenario, used for the removal order
+    :param p_completed_steps: steps already rendered (see read_progress), their bricks are removed without render
     :return:
     """
-    step_count = p_nb_level * p_config["nbCubeByLevel"] + 1
-    counter_level = p_nb_level - 1
-    print(counter_level)
-    brick_random_to_remove = list(range(6))
-    random.shuffle(brick_random_to_remove)
-    for step in range(1, step_count + 1):
-        if counter_level >= 0:
-            full_path = generate_image_folder(p_path + p_folder_scenario + '\\')
-            
+    if p_completed_steps is None:
+        p_completed_steps = {}
+    scenario_path = p_path + p_folder_scenario + '\\'
+    sequence = compute_removal_sequence(p_nb_level, p_config, random.Random(p_scenario_seed))
+    if p_config.get("captureMode", CAPTURE_MODE_STEP) == CAPTURE_MODE_ANIMATION:
+        picture_capture_animation(p_camera, scenario_path, sequence, p_config, p_scene, p_completed_steps)
+        return
+
+    render_crop_regions = p_config.get("renderCropRegions", False)
+    label_render_mode = p_config.get("labelRenderMode", LABEL_RENDER_MODE_CYCLES)
+    depth_format = p_config.get("depthOutputFormat", DEPTH_OUTPUT_PNG)
+    for step, object_name in sequence:
+        if step in p_completed_steps:
+            p_scene.objects[object_name].select = True
+            bpy.ops.object.delete()
+            continue
+        check_job_lease()
+        full_path = generate_image_folder(scenario_path)
+        output_name = p_config["pattern_name_file_save"] % (step, p_scene.objects[object_name][CONFIGURATION_OBJECT])
+
+        if render_crop_regions:
+            regions = choose_crop_regions(p_config, p_scene)
+            source_region = merge_crop_regions(regions,
+                                               p_config.get("renderOverheadPixels", DEFAULT_RENDER_OVERHEAD_PIXELS))
+            if source_region is None:
+                renders = [(region, output_name + CROP_NAME_SUFFIX % index_region)
+                           for index_region, region in enumerate(regions)]
+            else:
+                renders = [(source_region, output_name)]
+            for region, render_name in renders:
+                set_render_border(p_scene, region)
+                render_camera(bpy.context,
+                              p_camera,
+                              full_path,
+                              render_name,
+                              p_use_gpu=p_config["use_gpu"],
+                              p_metrics_path=p_path + p_folder_scenario + '\\' + RENDER_METRICS_FILE,
+                              p_label_render_mode=label_render_mode,
+                              p_depth_format=depth_format)
+            set_render_border(p_scene, None)
+            save_crop_regions(full_path, output_name, regions, source_region)
+        else:
             render_camera(bpy.context,
                           p_camera,
                           full_path,
-                          p_config["pattern_name_file_save"] % (step, p_scene.objects[
-                              p_config["pattern_layer"] % (counter_level, brick_random_to_remove[step % 6])][
-                              CONFIGURATION_OBJECT]),
-                          p_use_gpu=p_config["use_gpu"])
-            p_scene.objects[p_config["pattern_layer"] % (counter_level, brick_random_to_remove[step % 6])].select = True
-            bpy.ops.object.delete()
-        if step % 6 == 0:
-            counter_level -= 1
-            # the camera will "follow" the removing of the brick
-            random.shuffle(brick_random_to_remove)
+                          output_name,
+                          p_use_gpu=p_config["use_gpu"],
+                          p_metrics_path=p_path + p_folder_scenario + '\\' + RENDER_METRICS_FILE,
+                          p_label_render_mode=label_render_mode,
+                          p_depth_format=depth_format)
+        # The step is journaled by the output writer once its files are written
+        submit_output(functools.partial(append_progress, scenario_path, step, full_path))
+        p_scene.objects[object_name].select = True
+        bpy.ops.object.delete()
+    flush_outputs()
 
 
+def picture_capture_animation(p_camera, p_scenario_path, p_sequence, p_config, p_scene, p_completed_steps=None):
+    """
+    Capture all the steps of the scenario with a single animation render.
+    The removal of each brick is keyframed on its hide_render property, the frame N shows the tower
+    of the step N. The frames are then moved in one folder per step with the same names as picture_capture.
+    If the crop regions are rendered, the animation is rendered once per region (the regions are the same
+    for all the steps of the scenario).
+    :param p_camera: Camera on the scene
+    :param p_scenario_path: folder of the scenario
+    :param p_sequence: removal sequence (see compute_removal_sequence)
+    :param p_config: configuration
+    :param p_scene: scene
+    :param p_completed_steps: steps already rendered (see read_progress), their frames are not rendered again
+    :return:
+    """
+    if p_completed_steps is None:
+        p_completed_steps = {}
+    # Only the frames after the last completed step are rendered
+    first_frame = 1
+    while first_frame <= len(p_sequence) and p_sequence[first_frame - 1][0] in p_completed_steps:
+        first_frame += 1
+    if first_frame > len(p_sequence):
+        return
+    frames_path = os.path.join(p_scenario_path, ANIMATION_FRAMES_FOLDER)
+    if not os.path.exists(frames_path):
+        os.mkdir(frames_path)
+
+    output_names = []
+    for frame, (step, object_name) in enumerate(p_sequence, 1):
+        brick = p_scene.objects[object_name]
+        output_names.append(p_config["pattern_name_file_save"] % (step, brick[CONFIGURATION_OBJECT]))
+        brick.hide_render = False
+        brick.keyframe_insert(data_path="hide_render", frame=frame)
+        brick.hide_render = True
+        brick.keyframe_insert(data_path="hide_render", frame=frame + 1)
+
+    crop_regions = None
+    source_region = None
+    if p_config.get("renderCropRegions", False):
+        crop_regions = choose_crop_regions(p_config, p_scene)
+        source_region = merge_crop_regions(crop_regions,
+                                           p_config.get("renderOverheadPixels", DEFAULT_RENDER_OVERHEAD_PIXELS))
+    if crop_regions is not None and source_region is None:
+        regions = crop_regions
+        frame_names = [ANIMATION_FRAME_NAME + CROP_NAME_SUFFIX % index_region for index_region in range(len(regions))]
+    else:
+        # Whole image, or bounding box of the crop regions
+        regions = [source_region]
+        frame_names = [ANIMATION_FRAME_NAME]
+
+    initial_render_filepath = p_scene.render.filepath
+    initial_frame = p_scene.frame_current
+    initial_frame_start = p_scene.frame_start
+    initial_frame_end = p_scene.frame_end
+    initial_persistent_data = p_scene.render.use_persistent_data
+    p_scene.frame_start = first_frame
+    p_scene.frame_end = len(p_sequence)
+    p_scene.render.use_persistent_data = True
+    p_scene.camera = p_camera
+    p_scene.render.image_settings.file_format = 'PNG'
+    set_render_device(p_scene, p_config["use_gpu"])
+    label_render_mode = p_config.get("labelRenderMode", LABEL_RENDER_MODE_CYCLES)
+    depth_format = p_config.get("depthOutputFormat", DEPTH_OUTPUT_PNG)
+    if depth_format == DEPTH_OUTPUT_NPY:
+        # The viewer image only keeps the last frame of an animation, the raw passes are saved in EXR
+        print("* The numpy output is not supported by the animation capture, the EXR output is used")
+        depth_format = DEPTH_OUTPUT_EXR
+    pass_extensions = {"_image": ".png",
+                       "_distance_map": DEPTH_OUTPUT_EXTENSIONS[depth_format],
+                       "_object_index": DEPTH_OUTPUT_EXTENSIONS[depth_format]}
+    for region, frame_name in zip(regions, frame_names):
+        check_job_lease()
+        set_render_border(p_scene, region)
+        p_scene.render.filepath = frames_path + '/' + frame_name + "_image"
+        start_time = time.perf_counter()
+        if label_render_mode == LABEL_RENDER_MODE_CYCLES:
+            configure_compositor_outputs(p_scene, frames_path, frame_name, p_depth_format=depth_format)
+            bpy.ops.render.render(animation=True, scene=p_scene.name)
+        else:
+            if label_render_mode == LABEL_RENDER_MODE_FAST:
+                configure_compositor_outputs(p_scene, frames_path, frame_name, False, False, depth_format)
+                bpy.ops.render.render(animation=True, scene=p_scene.name)
+            configure_compositor_outputs(p_scene, frames_path, frame_name, p_depth_format=depth_format)
+            # The combined frames of the label passes are not kept
+            p_scene.render.filepath = frames_path + '/' + frame_name + LABEL_PASS_FRAME_SUFFIX
+            render_label_passes(p_scene, p_animation=True)
+        log_render_metrics(os.path.join(p_scenario_path, RENDER_METRICS_FILE),
+                           p_scene,
+                           frame_name,
+                           time.perf_counter() - start_time,
+                           len(p_sequence) - first_frame + 1)
+
+    set_render_border(p_scene, None)
+    p_scene.render.filepath = initial_render_filepath
+    p_scene.render.use_persistent_data = initial_persistent_data
+    p_scene.frame_start = initial_frame_start
+    p_scene.frame_end = initial_frame_end
+    p_scene.frame_set(initial_frame)
+    check_job_lease()
+
+    # One folder per step. The frames are all rendered before this loop, so the names of the folders are not
+    # the render times : they are the end of the render + one second by frame. The names keep the timestamp
+    # format read by the pre-processing, they are unique and sorted in the order of the steps.
+    start_date = datetime.datetime.now()
+    for frame, output_name in enumerate(output_names, 1):
+        if frame < first_frame:
+            continue
+        full_path = generate_image_folder(p_scenario_path, start_date + datetime.timedelta(seconds=frame))
+        outputs = []
+        for frame_name in frame_names:
+            file_name = output_name + frame_name[len(ANIMATION_FRAME_NAME):]
+            for suffix, extension in pass_extensions.items():
+                outputs.append((os.path.join(frames_path, "%s%s%04d%s" % (frame_name, suffix, frame, extension)),
+                                os.path.join(full_path, file_name + suffix + extension)))
+            label_pass_file = os.path.join(frames_path, "%s%s%04d.png" % (frame_name, LABEL_PASS_FRAME_SUFFIX, frame))
+            if os.path.exists(label_pass_file):
+                os.remove(label_pass_file)
+        if crop_regions is not None:
+            save_crop_regions(full_path, output_name, crop_regions, source_region)
+        submit_output(functools.partial(write_render_outputs, outputs))
+        submit_output(functools.partial(append_progress, p_scenario_path, p_sequence[frame - 1][0], full_path))
+    flush_outputs()
+    if not os.listdir(frames_path):
+        os.rmdir(frames_path)
+
+
+@profiling.profiled("save_scenario_data")
 def save_scenario_data(p_path,
                        p_folder_scenario,
                        p_objects_params,
@@ -945,7 +1151,9 @@ def save_scenario_data(p_path,
                        p_textures_choose,
                        p_config):
     """
-    Save the data from the current scenario
+    Save the data from the current scenario.
+    The legacy text files are still written, scenario.jsonl (see scenario_format) is written last
+    so that its presence means that the scenario is completely saved.
     :param p_path: path of where the file will be stored
     :param p_folder_scenario path for storing data
     :param p_objects_params list of all object created
@@ -981,15 +1189,154 @@ def save_scenario_data(p_path,
         json.dump(p_config, json_file)
         json_file.close()
 
+    scenario_format.save_scenario(p_path + p_folder_scenario + '\\' + scenario_format.SCENARIO_FILE,
+                                  p_objects_params,
+                                  p_generation_configuration,
+                                  p_textures_choose,
+                                  p_config.get("scenarioSeed", 0),
+                                  p_config)
+
+
+def delete_virtual_objects(p_scene):
+    """
+    Delete the objects generated for the scenario (the bricks)
+    The static objects of the scene are kept
+    :param p_scene: scene
+    :return:
+    """
+    if bpy.context.active_object is not None:
+        bpy.ops.object.mode_set(mode='OBJECT')
+    object_to_delete = False
+    for o in p_scene.objects:
+        if o.get(VIRTUAL_OBJECT) is not None:
+            o.select = True
+            object_to_delete = True
+    # Call the operator only once
+    if object_to_delete:
+        bpy.ops.object.delete()
+
+
+def purge_orphan_data():
+    """
+    Delete the objects, actions, meshes, materials, textures and images that are not used anymore
+    (data with a fake user, like the brick prototypes and the pooled materials, are kept)
+    :return: number of data deleted
+    """
+    nb_deleted = 0
+    # The objects are purged first, the data they used become orphans
+    for collection in (bpy.data.objects, bpy.data.actions, bpy.data.meshes, bpy.data.materials,
+                       bpy.data.textures, bpy.data.images):
+        for data in list(collection):
+            if data.users == 0 and getattr(data, "type", None) not in ('RENDER_RESULT', 'COMPOSITING'):
+                collection.remove(data)
+                nb_deleted += 1
+    return nb_deleted
+
+
+def flush_material_pool():
+    """
+    Empty the material pool, the materials that are not used anymore are deleted
+    :return:
+    """
+    while g_material_pool:
+        _, material = g_material_pool.popitem(last=False)
+        material.use_fake_user = False
+        if material.users == 0:
+            bpy.data.materials.remove(material)
+
+
+def get_process_rss_mb():
+    """
+    Get the resident memory of the blender process
+    :return: resident memory in MB, None if it can't be read on this platform
+    """
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        if get_process_memory_info(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / (1024 * 1024)
+    return None
+
+
+def get_datablock_counts():
+    """
+    Count the data of the blend file
+    :return: dictionary with the number of objects, meshes, materials, textures and images
+    """
+    return {"objects": len(bpy.data.objects),
+            "meshes": len(bpy.data.meshes),
+            "materials": len(bpy.data.materials),
+            "textures": len(bpy.data.textures),
+            "images": len(bpy.data.images)}
+
+
+def count_scene_vertices(p_scene):
+    """
+    Count the vertices of the meshes of the scene
+    :param p_scene: scene
+    :return: number of vertices
+    """
+    return sum(len(scene_object.data.vertices) for scene_object in p_scene.objects if scene_object.type == 'MESH')
+
+
+@profiling.profiled("collect_garbage")
+def collect_garbage(p_iteration, p_memory_budget_mb=None):
+    """
+    Delete the orphan data left by the iteration and report the memory used.
+    If the resident memory is above the budget the material pool is emptied too.
+    :param p_iteration: iteration
+    :param p_memory_budget_mb: memory budget in MB (None for no budget)
+    :return:
+    """
+    nb_deleted = purge_orphan_data()
+    rss_mb = get_process_rss_mb()
+    if p_memory_budget_mb is not None and rss_mb is not None and rss_mb > p_memory_budget_mb:
+        print("WARNING : memory used %.0f MB above the budget of %s MB, the material pool is emptied"
+              % (rss_mb, p_memory_budget_mb))
+        flush_material_pool()
+        nb_deleted += purge_orphan_data()
+        rss_mb = get_process_rss_mb()
+    counts = get_datablock_counts()
+    print("* Iteration %s : %s orphan data deleted, %s, memory %s" % (
+        p_iteration,
+        nb_deleted,
+        ", ".join("%s %s" % (count, name) for name, count in sorted(counts.items())),
+        "n/a" if rss_mb is None else "%.0f MB" % rss_mb))
+
 
 def reset_data(p_scene):
     """
-    Reset all the data on the scene
+    Reset the data of the scenario on the scene
     :param p_scene: blender scene
     :return:
     """
     un_select_all_object(p_scene)
-    delete_old_object_from_scene(p_scene)
+    delete_virtual_objects(p_scene)
 
 
 def iteration_runner(p_config,
@@ -997,7 +1344,9 @@ def iteration_runner(p_config,
                      p_replay_mode=False,
                      p_objects_params=None,
                      p_texture_choose=None,
-                     p_iteration_number=None):
+                     p_iteration_number=None,
+                     p_folder_scenario=None,
+                     p_skip_iterations=()):
     """
     Iteration Runner
     Function that will run the scenario
@@ -1009,7 +1358,9 @@ def iteration_runner(p_config,
     :param p_texture_choose: Array that contains textures id  for the scene creation.
     Not none if this function is call by the replay mode
     :param p_iteration_number: Number of iteration
-    :return:
+    :param p_folder_scenario: existing folder of the scenario (resume mode), its completed steps are not rendered
+    :param p_skip_iterations: iterations already finished (resume mode)
+    :return: folders of the scenarios finished
     """
 
     if p_objects_params is None:
@@ -1024,19 +1375,27 @@ def iteration_runner(p_config,
     weight = p_config["weight"]
     separator = p_config["separator"]
     a_scene = bpy.context.scene
+    folders_scenario = []
     for iteration in range(iteration_number):
+        if iteration + p_config.get("iterationOffset", 0) in p_skip_iterations:
+            continue
+        iteration_start_time, iteration_start_cpu = time.perf_counter(), time.process_time()
 
         print("=============================================")
         print("==============Iteration     %s================" % str(iteration))
         print("==============Initialisation ================")
-        initialize_scene()
+        texture_box = initialize_scene(p_config)
         a_scene.render.resolution_x = 1280
         a_scene.render.resolution_y = 1024
         a_scene.render.resolution_percentage = 100
         print("=============================================")
-        folder_scenario = generate_folder_scenario(iteration)
-        if g_debugMode is False and not os.path.exists(p_config["root_path_data"] + folder_scenario):
-            os.mkdir(p_config["root_path_data"] + folder_scenario)
+        if p_folder_scenario is None:
+            folder_scenario = generate_folder_scenario(iteration + p_config.get("iterationOffset", 0))
+        else:
+            folder_scenario = p_folder_scenario
+        # Same folder as the renders, the root_path_data of a replayed scenario is the one of its first run
+        if g_debugMode is False and not os.path.exists(root_path_data + folder_scenario):
+            os.mkdir(root_path_data + folder_scenario)
 
         areas = [a_scene.objects["Lamp1"],
                  a_scene.objects["Lamp2"]]
@@ -1057,13 +1416,25 @@ def iteration_runner(p_config,
 
         # delete_old_object_from_scene(a_scene)
         objects_params = p_objects_params.copy()
+        scenario_seed = p_config.get("scenarioSeed", 0)
         configuration_generation = []
         textures_choose = p_texture_choose.copy()
         # If debug mode is activated we generate always the same configuration
         # and only one level.
         # It allow to have always the same data in order to compare
 
-        if p_replay_mode is False:
+        if p_replay_mode is False and g_plan is not None and not g_debugMode:
+            # The scenario has been planned before the run (see layout_planner)
+            objects_params, configuration_generation, textures_choose, scenario_seed = \
+                layout_planner.get_planned_scenario(g_plan, iteration + p_config.get("iterationOffset", 0), p_config)
+            save_scenario_data(p_path=root_path_data,
+                               p_folder_scenario=folder_scenario,
+                               p_objects_params=objects_params,
+                               p_generation_configuration=configuration_generation,
+                               p_textures_choose=textures_choose,
+                               p_config=dict(p_config, scenarioSeed=scenario_seed, boxTexture=texture_box))
+        elif p_replay_mode is False:
+            scenario_seed = random.randint(0, 2 ** 31 - 1)
             textures_choose = generate_texture_array(p_config)
             if g_debugMode:
                 for i in range(1):
@@ -1087,8 +1458,9 @@ def iteration_runner(p_config,
                                    p_objects_params=objects_params,
                                    p_generation_configuration=configuration_generation,
                                    p_textures_choose=textures_choose,
-                                   p_config=p_config)
+                                   p_config=dict(p_config, scenarioSeed=scenario_seed, boxTexture=texture_box))
 
+        profile_counts = {}
         if p_replay_mode or p_config["scriptGeneration"] is False:
             # Generate object into the scene
             for index_object in range(len(objects_params)):
@@ -1097,14 +1469,31 @@ def iteration_runner(p_config,
                                 p_config=p_config,
                                 p_index_object=len(objects_params) - index_object,
                                 p_iteration=iteration,
-                                p_textures_choose=textures_choose)
+                                p_textures_choose=textures_choose,
+                                p_scenario_seed=scenario_seed)
             un_select_all_object(a_scene)
             print("NbObject : {}".format(g_nb_objects))
+            if profiling.is_enabled():
+                profile_counts = {"bricks": len(objects_params), "vertices": count_scene_vertices(a_scene)}
             if g_debugMode is False:
+                completed_steps = {}
+                if p_folder_scenario is not None:
+                    completed_steps = read_progress(root_path_data + folder_scenario + '\\')
+                    remove_unjournaled_steps(root_path_data + folder_scenario + '\\', completed_steps)
                 picture_capture(p_camera=camera, p_path=root_path_data, p_nb_level=nbLevel,
-                                p_folder_scenario=folder_scenario, p_config=p_config, p_scene=a_scene)
+                                p_folder_scenario=folder_scenario, p_config=p_config, p_scene=a_scene,
+                                p_scenario_seed=scenario_seed, p_completed_steps=completed_steps)
         reset_data(a_scene)
+        collect_garbage(iteration, p_config.get("memoryBudgetMB"))
         create_end_file(root_path_data, folder_scenario)
+        folders_scenario.append(folder_scenario)
+        if profiling.is_enabled():
+            profile_counts.update(get_datablock_counts())
+            profiling.record_iteration(iteration + p_config.get("iterationOffset", 0),
+                                       time.perf_counter() - iteration_start_time,
+                                       time.process_time() - iteration_start_cpu,
+                                       profile_counts)
+    return folders_scenario
 
 
 def create_end_file(p_path, p_folder_scenario):
@@ -1128,78 +1517,366 @@ def replay_runner(p_config):
     """
     path_replay_mode = p_config["pathReplay"]
     # get the variable root folder
-    # is true that means we have three file :
-    # scenario.txt
-    # scenario_data.txt
-    # config.json
+    # is true that means that pathReplay is the folder of one scenario
+    # (scenario.jsonl, or the legacy files scenario.txt, scenario_data.txt and config.json)
     is_root_folder = p_config["isRootFolderReplayMode"]
     if is_root_folder:
-        process_replay_mode_folder(path_replay_mode)
+        process_replay_mode_folder(path_replay_mode, p_run_config=p_config)
     else:
-        for root, dirs, files in os.walk(path_replay_mode):
-            if "scenario.txt" in str(files) and "config.json" in str(files) and "scenario_data.txt" in str(files):
-                process_replay_mode_folder(root, p_iteration_number=1)
+        scenarios = scenario_format.load_scenarios(scenario_format.discover_replay_folders(path_replay_mode))
+        print("* Scenarios to replay : ", len(scenarios))
+        for scenario in scenarios:
+            replay_scenario(scenario, p_iteration_number=1, p_run_config=p_config)
+
+
+def replay_scenario(p_scenario, p_iteration_number=None, p_folder_scenario=None, p_run_config=None, p_resume=False):
+    """
+    Replay a scenario loaded by scenario_format
+    :param p_scenario: scenario
+    :param p_iteration_number: number of iteration
+    :param p_folder_scenario: folder where the scenario is rendered, its completed steps are not rendered again.
+    None to create a new folder
+    :param p_run_config: configuration of the run, its render settings (see REPLAY_OVERRIDE_KEYS)
+    replace the ones of the scenario
+    :param p_resume: the scenario is finished in its own folder (resume mode)
+    :return: folders of the scenarios rendered
+    """
+    # The journal of the source would mark its steps as done and its unjournaled steps would be deleted
+    if (p_folder_scenario is not None and not p_resume and "folder" in p_scenario
+            and os.path.realpath(root_path_data + p_folder_scenario) == os.path.realpath(p_scenario["folder"])):
+        raise ValueError("The scenario %s can't be replayed into its own folder, choose another output folder"
+                         % p_scenario["folder"])
+    scenario_config = dict(p_scenario["config"], scenarioSeed=p_scenario["seed"])
+    if p_run_config is not None:
+        override_keys = p_run_config.get("replayOverrideKeys", REPLAY_OVERRIDE_KEYS)
+        scenario_config.update((key, p_run_config[key]) for key in override_keys if key in p_run_config)
+    return iteration_runner(p_config=scenario_config,
+                     p_number_level=scenario_config["nbLevel"],
+                     p_replay_mode=True,
+                     p_objects_params=p_scenario["bricks"],
+                     p_texture_choose=p_scenario["textures"],
+                     p_iteration_number=p_iteration_number,
+                     p_folder_scenario=p_folder_scenario)
 
 
 def process_replay_mode_folder(p_path_replay_mode,
-                               p_iteration_number=None):
+                               p_iteration_number=None,
+                               p_folder_scenario=None,
+                               p_run_config=None):
     """
     Process with the replay mode a folder
-    This folder must contains scenario.txt, scenario_data.txt, and config.json
+    This folder must contains scenario.jsonl, or the legacy files scenario.txt, scenario_data.txt and config.json
     :param p_path_replay_mode: path to the folder to process in replay mode
     :param p_iteration_number: number of iteration
-    :return:
+    :param p_folder_scenario: folder where the scenario is rendered (see replay_scenario)
+    :param p_run_config: configuration of the run (see replay_scenario)
+    :return: folders of the scenarios rendered
     """
-    object_params = []
-    with open(os.path.join(p_path_replay_mode, 'config.json')) as config_file:
-        scenario_config = json.load(config_file)
-    with open(os.path.join(p_path_replay_mode, "scenario.txt")) as scenario_txt_file:
-        next(scenario_txt_file)
-        for line in scenario_txt_file:
-            temp_line = line[1:-2]
-            data = temp_line.split(",")
-            object_params.append((data[0],
-                                  float(data[1]),
-                                  float(data[2]),
-                                  float(data[3]),
-                                  strtobool(data[4].strip().lower()),
-                                  int(data[5]),
-                                  int(data[6])))
-    with open(os.path.join(p_path_replay_mode, "scenario_data.txt")) as scenario_data_file:
-        next(scenario_data_file)
-        for line in scenario_data_file:
-            texture_choose = list(map(int, line[2:-3].split(",")))
-    iteration_runner(p_config=scenario_config,
-                     p_number_level=scenario_config["nbLevel"],
-                     p_replay_mode=True,
-                     p_objects_params=object_params,
-                     p_texture_choose=texture_choose,
-                     p_iteration_number=p_iteration_number)
+    return replay_scenario(scenario_format.load_scenario(p_path_replay_mode),
+                           p_iteration_number,
+                           p_folder_scenario,
+                           p_run_config)
 
 
-def initialize_scene():
+def resume_runner(p_config, p_number_level):
+    """
+    Resume mode
+    Finish the scenarios of an interrupted run of the iteration mode, then run the iterations not started.
+    The scenarios with OK.txt are skipped, the others are rebuilt from their files and only the steps
+    missing from their progress journal are rendered.
+    :param p_config: configuration
+    :param p_number_level: nb of level
+    :return:
+    """
+    finished_iterations = set()
+    for folder_scenario in sorted(os.listdir(root_path_data)):
+        scenario_path = os.path.join(root_path_data, folder_scenario)
+        if not folder_scenario.startswith("output_") or not os.path.isdir(scenario_path):
+            continue
+        try:
+            scenario_index = int(folder_scenario.split("_")[1])
+        except ValueError:
+            continue
+        if os.path.isfile(os.path.join(scenario_path, "OK.txt")):
+            finished_iterations.add(scenario_index)
+            continue
+        scenario = None
+        if scenario_format.is_scenario_folder(scenario_path):
+            try:
+                scenario = scenario_format.load_scenario(scenario_path)
+            except ValueError as error:
+                print("* Unreadable scenario : ", error)
+        if scenario is None:
+            # Interrupted before the save of the scenario, the iteration is generated again
+            print("* Remove incomplete scenario : ", scenario_path)
+            shutil.rmtree(scenario_path)
+            continue
+        print("* Resume scenario : ", folder_scenario)
+        replay_scenario(scenario,
+                        p_iteration_number=1,
+                        p_folder_scenario=folder_scenario,
+                        p_run_config=p_config,
+                        p_resume=True)
+        finished_iterations.add(scenario_index)
+    print("* Scenarios already finished : ", len(finished_iterations))
+    iteration_runner(p_config, p_number_level, p_skip_iterations=finished_iterations)
+
+
+def job_worker_runner(p_config, p_number_level, p_server_url):
+    """
+    Worker mode
+    Run the jobs handed out by a job server (see job_server.py) until all the jobs of the run are completed.
+    The lease of the job is renewed after each render, the job is stopped if its lease has expired.
+    :param p_config: configuration, the paths of this machine are used for all the jobs
+    :param p_number_level: nb of level
+    :param p_server_url: url of the job server
+    :return:
+    """
+    # Only the workers need the client of the job server
+    import job_server
+    client = job_server.JobClient(p_server_url)
+    heartbeat_interval = p_config.get("jobLeaseTimeout", job_server.DEFAULT_LEASE_TIMEOUT) / 4.0
+
+    def send_heartbeat(p_scene):
+        # The exceptions of the handlers are not raised by blender, the job is stopped by check_job_lease
+        if g_job_lease is not None and time.time() - g_job_lease["time"] > heartbeat_interval:
+            if not client.heartbeat(g_job_lease["id"]):
+                print("WARNING : the lease of the job has expired, the job is stopped")
+                g_job_lease["expired"] = True
+            g_job_lease["time"] = time.time()
+
+    def run_job(p_job, p_lease_id):
+        global g_job_lease
+        g_job_lease = {"id": p_lease_id, "time": time.time(), "expired": False}
+        start_time = time.time()
+        print("* Job : ", p_job["id"])
+        try:
+            if "scenario" in p_job:
+                folders_scenario = replay_scenario(p_job["scenario"],
+                                                   p_iteration_number=1,
+                                                   p_folder_scenario=p_job["output_folder"],
+                                                   p_run_config=p_config)
+            else:
+                random.seed(p_job["seed"])
+                folders_scenario = iteration_runner(dict(p_config, iterationOffset=p_job["iteration"]),
+                                                    p_number_level,
+                                                    p_iteration_number=1)
+        except job_server.LeaseExpiredError as error:
+            print("* Job %s stopped : %s" % (p_job["id"], error))
+            flush_outputs()
+            reset_data(bpy.context.scene)
+            return None
+        finally:
+            g_job_lease = None
+        return {"output_folders": [root_path_data + folder for folder in folders_scenario],
+                "duration": time.time() - start_time}
+
+    bpy.app.handlers.render_post.append(send_heartbeat)
+    try:
+        print("* Jobs completed : ", job_server.run_worker(client, run_job))
+    finally:
+        bpy.app.handlers.render_post.remove(send_heartbeat)
+
+
+def parse_arguments():
+    """
+    Parse the arguments given to the script after the "--" separator of the blender command line
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Blender simulator")
+    parser.add_argument("--config",
+                        default='D:\\Simulator\\config.json',
+                        help="path of the configuration file")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="finish the scenarios of an interrupted run of the iteration mode")
+    parser.add_argument("--replay-folder",
+                        default=None,
+                        help="replay only this scenario folder (used by the replay workers of the launcher)")
+    parser.add_argument("--output-folder",
+                        default=None,
+                        help="name of the folder of root_path_data where the replayed scenario is rendered")
+    parser.add_argument("--record",
+                        default=None,
+                        help="file where the result of the replay of --replay-folder is written")
+    parser.add_argument("--job-server",
+                        default=None,
+                        help="url of a job server (see job_server.py), the simulator runs the jobs of the server")
+    parser.add_argument("--profile",
+                        default=None,
+                        help="JSON Lines file where the time of each stage of the iterations is written "
+                             "(default : profileTrace of the configuration, no profiling if it is not defined)")
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    return parser.parse_args(argv)
+
+
+@profiling.profiled("initialize_scene")
+def initialize_scene(p_config):
+    """
+    Prepare the scene for a new iteration.
+    The static part of the scene (box, potence and lamps) is only built (or loaded from the template)
+    the first time, the next iterations only change the texture of the box.
+    :param p_config: configuration, the texture of the box is boxTexture if it is defined (replay and resume)
+    :return: file name of the texture of the box
+    """
     # Change the render engine
     bpy.context.scene.render.engine = "CYCLES"
     bpy.context.scene.render.image_settings.color_depth = '16'
     bpy.context.scene.render.resolution_x = 1280
     bpy.context.scene.render.resolution_y = 1024
-    bpy.context.scene.cycles.max_bounces = 12
     bpy.context.scene.cycles.use_square_samples = False
     bpy.context.scene.cycles.preview_samples = 32
-    bpy.context.scene.cycles.samples = 256
     bpy.context.scene.cycles.device = 'GPU'
 
+    texture_box = p_config.get("boxTexture")
+    if texture_box is None:
+        texture_box = g_texture_files_box[random.randint(0, len(g_texture_files_box) - 1)]
+    path_texture_box = root_path_texture_box + "\\" + texture_box
+    a_scene = bpy.context.scene
+    if is_static_scene_ready(a_scene):
+        set_box_texture(a_scene, path_texture_box)
+        apply_render_profile(a_scene, get_render_profile(p_config))
+        return texture_box
+
+    template_path = p_config.get("sceneTemplate")
+    delete_old_object_from_scene(a_scene)
+    if template_path and os.path.exists(template_path):
+        print("* Load static scene from template : ", template_path)
+        load_static_scene_template(a_scene, template_path)
+        set_box_texture(a_scene, path_texture_box)
+    else:
+        build_static_scene(path_texture_box)
+        if template_path:
+            print("* Save static scene template : ", template_path)
+            save_static_scene_template(a_scene, template_path)
+    apply_render_profile(a_scene, get_render_profile(p_config))
+    return texture_box
+
+
+def get_render_profile(p_config):
+    """
+    Get the render quality profile chosen by the configuration.
+    The profiles of the configuration ("renderProfiles") complete or override the default profiles.
+    :param p_config: configuration
+    :return: dictionary with the name and the settings of the profile
+    """
+    name = p_config.get("renderProfile", DEFAULT_RENDER_PROFILE)
+    if name not in RENDER_PROFILES and name not in p_config.get("renderProfiles", {}):
+        raise ValueError("Unknown render profile : %s (profiles : %s)"
+                         % (name, ", ".join(sorted(set(RENDER_PROFILES) | set(p_config.get("renderProfiles", {}))))))
+    profile = dict(RENDER_PROFILES.get(name, RENDER_PROFILES[DEFAULT_RENDER_PROFILE]))
+    profile.update(p_config.get("renderProfiles", {}).get(name, {}))
+    profile["name"] = name
+    return profile
+
+
+def apply_render_profile(p_scene, p_profile):
+    """
+    Apply the settings of a render quality profile to the scene and the lamps
+    The adaptive sampling and the denoiser are only set if the version of cycles supports them
+    :param p_scene: scene
+    :param p_profile: render quality profile (see get_render_profile)
+    :return:
+    """
+    p_scene[RENDER_PROFILE_PROPERTY] = p_profile["name"]
+    p_scene.cycles.samples = p_profile["samples"]
+    p_scene.cycles.max_bounces = p_profile["max_bounces"]
+    if hasattr(p_scene.cycles, "use_adaptive_sampling"):
+        p_scene.cycles.use_adaptive_sampling = p_profile["adaptive_threshold"] > 0
+        p_scene.cycles.adaptive_threshold = p_profile["adaptive_threshold"]
+    render_layer = p_scene.render.layers['RenderLayer']
+    if hasattr(render_layer.cycles, "use_denoising"):
+        render_layer.cycles.use_denoising = p_profile["denoising"]
+    for lamp in bpy.data.lamps:
+        lamp.cycles.max_bounces = p_profile["lamp_max_bounces"]
+
+
+def log_render_metrics(p_metrics_path, p_scene, p_name, p_render_time, p_nb_images=1):
+    """
+    Append the render time and the sampling settings of a render to the metrics file (JSON lines)
+    :param p_metrics_path: path of the metrics file (nothing is logged if None)
+    :param p_scene: scene
+    :param p_name: name of the render
+    :param p_render_time: render time in seconds
+    :param p_nb_images: number of images rendered
+    :return:
+    """
+    if p_metrics_path is None:
+        return
+    record = {"name": p_name,
+              "profile": p_scene.get(RENDER_PROFILE_PROPERTY),
+              "nb_images": p_nb_images,
+              "render_time": p_render_time,
+              "render_time_by_image": p_render_time / p_nb_images,
+              "samples": p_scene.cycles.samples,
+              "max_bounces": p_scene.cycles.max_bounces,
+              "adaptive_threshold": getattr(p_scene.cycles, "adaptive_threshold", None)
+              if getattr(p_scene.cycles, "use_adaptive_sampling", False) else None}
+    with open(p_metrics_path, 'a') as metrics_file:
+        metrics_file.write(json.dumps(record) + "\n")
+
+
+def is_static_scene_ready(p_scene):
+    """
+    Check if all the static objects of the scene already exist
+    :param p_scene: scene
+    :return: True if the static scene can be reused
+    """
+    return all(name in p_scene.objects for name in STATIC_OBJECT_NAMES)
+
+
+def set_box_texture(p_scene, p_texture_path):
+    """
+    Change the texture of the static objects
+    :param p_scene: scene
+    :param p_texture_path: path of the new texture
+    :return:
+    """
+    for name in STATIC_OBJECT_NAMES:
+        if p_scene.objects[name].type == 'MESH':
+            add_texture_to_object(name, p_texture_path)
+
 
-    texture_index = random.randint(0, len(g_texture_files_box) - 1)
-    path_texture_box = root_path_texture_box + "\\" + g_texture_files_box[texture_index]
-    delete_old_object_from_scene(bpy.context.scene)
+def load_static_scene_template(p_scene, p_template_path):
+    """
+    Append the static objects saved in a template .blend file and link them to the scene
+    :param p_scene: scene
+    :param p_template_path: path of the template
+    :return:
+    """
+    with bpy.data.libraries.load(p_template_path) as (data_from, data_to):
+        data_to.objects = [name for name in data_from.objects if name in STATIC_OBJECT_NAMES]
+    for obj in data_to.objects:
+        if obj is not None:
+            p_scene.objects.link(obj)
+            obj[STATIC_OBJECT] = STATIC_OBJECT
+    un_select_all_object(p_scene)
+
+
+def save_static_scene_template(p_scene, p_template_path):
+    """
+    Save the static objects of the scene (and the data they use) in a template .blend file
+    :param p_scene: scene
+    :param p_template_path: path of the template
+    :return:
+    """
+    bpy.data.libraries.write(p_template_path,
+                             set(p_scene.objects[name] for name in STATIC_OBJECT_NAMES))
+
+
+def build_static_scene(p_path_texture_box):
+    """
+    Build the static objects of the scene : the box, the potence and the lamps
+    :param p_path_texture_box: path of the texture used for the box
+    :return:
+    """
     bpy.ops.mesh.primitive_cube_add(radius=1, location=[0, 0, 0])
     left_border = bpy.context.object
     left_border.name = "LEFT_BORDER"
     left_border.scale = [1, 1, 1]
     left_border.dimensions = [0.5, 15, 8]
     left_border.location = [-5.0, 0, 3.9]
-    add_texture_to_object(left_border.name, 4005, 4005, path_texture_box)
+    add_texture_to_object(left_border.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1213,7 +1890,7 @@ def initialize_scene():
     right_border.dimensions = [0.5, 15, 8]
     right_border.location = [+5.0, 0, 3.9]
 
-    add_texture_to_object(right_border.name, 4004, 4004, path_texture_box)
+    add_texture_to_object(right_border.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1226,7 +1903,7 @@ def initialize_scene():
     bottom_border.scale = [1, 1, 1]
     bottom_border.dimensions = [11.25, 0.5, 8]
     bottom_border.location = [0, -7, 3.9]
-    add_texture_to_object(bottom_border.name, 4003, 4003, path_texture_box)
+    add_texture_to_object(bottom_border.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1239,7 +1916,7 @@ def initialize_scene():
     top_border.scale = [1, 1, 1]
     top_border.dimensions = [11.25, 0.5, 8]
     top_border.location = [0, +7, 3.9]
-    add_texture_to_object(top_border.name, 4002, 4002, path_texture_box)
+    add_texture_to_object(top_border.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1252,7 +1929,7 @@ def initialize_scene():
     ground.scale = [1, 1, 1]
     ground.dimensions = [11.25, 15, 0.5]
 
-    add_texture_to_object(ground.name, 4001, 4001, path_texture_box)
+    add_texture_to_object(ground.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1267,7 +1944,7 @@ def initialize_scene():
     potence.dimensions = [2, 2, 28]
     potence.location = [-9, 0, 14]
 
-    add_texture_to_object(potence.name, 4001, 4001, path_texture_box)
+    add_texture_to_object(potence.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1279,7 +1956,7 @@ def initialize_scene():
     arm_potence.dimensions = [8, 1, 1]
     arm_potence.location = [-4.5, 0, 27.5]
 
-    add_texture_to_object(arm_potence.name, 4001, 4001, path_texture_box)
+    add_texture_to_object(arm_potence.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1291,7 +1968,7 @@ def initialize_scene():
     i_core.dimensions = [1, 7, 1]
     i_core.location = [0, 0, 27.5]
 
-    add_texture_to_object(i_core.name, 4001, 4001, path_texture_box)
+    add_texture_to_object(i_core.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1303,7 +1980,7 @@ def initialize_scene():
     i_branch_1.dimensions = [4, 1, 1]
     i_branch_1.location = [0, -3.5, 27.5]
 
-    add_texture_to_object(i_branch_1.name, 4001, 4001, path_texture_box)
+    add_texture_to_object(i_branch_1.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1315,7 +1992,7 @@ def initialize_scene():
     i_branch_2.dimensions = [4, 1, 1]
     i_branch_2.location = [0, 3.5, 27.5]
 
-    add_texture_to_object(i_branch_2.name, 4001, 4001, path_texture_box)
+    add_texture_to_object(i_branch_2.name, p_path_texture_box)
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.uv.reset()
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1329,7 +2006,6 @@ def initialize_scene():
     lamp_data.energy = 100
     lamp_data.size = 1
     lamp_data.size_y = 12
-    lamp_data.cycles.max_bounces = 1024
     # Create new object with our lamp datablock
     lamp_object = bpy.data.objects.new(name="Lamp1", object_data=lamp_data)
     # Link lamp object to the scene so it'll appear in this scene
@@ -1345,7 +2021,6 @@ def initialize_scene():
     lamp_data.energy = 100
     lamp_data.size = 1
     lamp_data.size_y = 12
-    lamp_data.cycles.max_bounces = 1024
     # Create new object with our lamp datablock
     lamp_object = bpy.data.objects.new(name="Lamp2", object_data=lamp_data)
     # Link lamp object to the scene so it'll appear in this scene
@@ -1353,13 +2028,16 @@ def initialize_scene():
     lamp_object.location = [-1.5, 0, 27]
     bpy.data.lamps[lamp_data.name].use_nodes = True
     bpy.data.lamps[lamp_data.name].node_tree.nodes["Emission"].inputs[1].default_value = 3000
+    for name in STATIC_OBJECT_NAMES:
+        bpy.context.scene.objects[name][STATIC_OBJECT] = STATIC_OBJECT
     un_select_all_object(bpy.context.scene)
 
 
 if __name__ == '__main__':
 
+    arguments = parse_arguments()
     # Load configuration JSON file that contains all the configuration for the scenarii
-    with open('D:\\Simulator\\config.json') as f:
+    with open(arguments.config) as f:
     #with open('C:\\Users\\k.giroux\\Documents\\blender\\config.json') as f:
         config = json.load(f)
         print("=============================================")
@@ -1381,6 +2059,10 @@ if __name__ == '__main__':
     print("* Iteration Mode : ", iteration_mode)
     replay_mode = config["replayMode"]
     print("* Replay Mode : ", replay_mode)
+    print("* Render Profile : ", config.get("renderProfile", DEFAULT_RENDER_PROFILE))
+    if config.get("seed") is not None:
+        random.seed(config["seed"])
+        print("* Seed : ", config["seed"])
     g_texture_files = [pos_img
                        for pos_img in os.listdir(root_path_texture)
                        if pos_img.endswith('.jpg')]
@@ -1391,6 +2073,21 @@ if __name__ == '__main__':
     print("* Number of texture file detected for box: ", len(g_texture_files_box))
     print("=============================================")
     g_nb_objects = config["nbCubeByLevel"] *  config["nbLevel"] * 2
+    # The pool keeps at least the material being assigned
+    g_material_pool_size = max(1, config.get("materialPoolSize", DEFAULT_MATERIAL_POOL_SIZE))
+    # The output writer is opt-in (outputQueueSize > 0, output_writer.DEFAULT_QUEUE_SIZE is a good value) :
+    # with it blender saves the PNG files without compression and the writer compresses them in python
+    output_queue_size = config.get("outputQueueSize", 0)
+    if output_queue_size > 0:
+        g_output_writer = output_writer.OutputWriter(output_queue_size)
+        g_png_compression_level = config.get("pngCompressionLevel", output_writer.DEFAULT_PNG_COMPRESSION_LEVEL)
+    profile_trace = arguments.profile or config.get("profileTrace")
+    if profile_trace:
+        profiling.enable(profile_trace)
+        print("* Profile Trace : ", profile_trace)
+    if config.get("planFile"):
+        g_plan = layout_planner.load_plan(config["planFile"])
+        print("* Plan : ", config["planFile"])
     # defined some caracteristic for the debug mode.
     if g_debugMode:
         picture_enabled = False
@@ -1401,6 +2098,23 @@ if __name__ == '__main__':
         nbLevel = config["nbLevel"]
         deformations = True
 
+    if arguments.replay_folder is not None:
+        start_time = time.time()
+        folders_replayed = process_replay_mode_folder(arguments.replay_folder,
+                                                      p_iteration_number=1,
+                                                      p_folder_scenario=arguments.output_folder,
+                                                      p_run_config=config)
+        if arguments.record is not None:
+            with open(arguments.record, 'w') as record_file:
+                json.dump({"replay_folder": arguments.replay_folder,
+                           "output_folders": [root_path_data + folder for folder in folders_replayed],
+                           "duration": time.time() - start_time}, record_file)
+        sys.exit(0)
+
+    if arguments.job_server is not None:
+        job_worker_runner(config, nbLevel, arguments.job_server)
+        sys.exit(0)
+
     if iteration_mode and replay_mode:
         print("ERROR : Invalid Configuration : Iteration Mode can't be activated with the replay mode")
         exit(-1)
@@ -1410,7 +2124,9 @@ if __name__ == '__main__':
               "activate the iteration mode and set the iteration value to 1")
         exit(-1)
 
-    if iteration_mode:
+    if iteration_mode and arguments.resume:
+        resume_runner(config, nbLevel)
+    elif iteration_mode:
         iteration_runner(config, nbLevel)
     if replay_mode:
         replay_runner(config)